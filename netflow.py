@@ -1,12 +1,42 @@
 from tools import Tools
 import os
+import sys
 from geopy.distance import vincenty
 import pprint
 import pickle
+import multiprocessing
+import heapq
+import itertools
+import time
+import sqlite3
 import math
+import csv
+import socket
+import struct
+import bisect
+import json
+import mmap
+import zlib
+import bz2
+import threading
+import Queue
+from array import array
+import select
+from collections import OrderedDict, deque
 
 path = os.getcwd() + '\\'
 db_file = path + 'netflow.db'
+sqlite_file = path + 'netflow.sqlite'
+geo_cache_file = path + 'netflow_geo.db'
+report_spill_file = path + 'netflow_report.spill'
+stats_file = path + 'netflow_stats.json'
+column_dir = path + 'columns' + '\\'
+anomaly_file = path + 'netflow_anomalies.csv'
+blackhole_file = path + 'blackhole.txt'
+whitelist_file = path + 'whitelist.txt'
+blacklist_file = path + 'blacklist.txt'
+country_file = path + 'country.txt'
+archive_dir = path + 'archive' + '\\'
 
 try: 
     import pygeoip
@@ -16,446 +46,3379 @@ try:
     geoip_asn = pygeoip.GeoIP(cfile)
 except: pass
 
+#numpy is optional, the range index falls back to bisect over array.array when it is not installed
+try: import numpy
+except ImportError: numpy = None
 
-class Inetflow(Tools):
-    def __init__(self, verbose=0):
+#asyncio, or the trollius backport, runs the UDP collector - collect() falls back to a select loop without either
+try: import asyncio
+except ImportError:
+    try: import trollius as asyncio
+    except ImportError: asyncio = None
+
+#lzma, or the backports.lzma package, reads xz compressed load files
+try: import lzma
+except ImportError:
+    try: from backports import lzma
+    except ImportError: lzma = None
+
+
+def ip2int(ip):
+    return struct.unpack('!I', socket.inet_aton(ip))[0]
+    
+    
+def int2ip(num):
+    return socket.inet_ntoa(struct.pack('!I', num))
+    
+    
+def peak_rss():
+    """
+    peak resident memory of this process in MB, 0 if it can not be read
+    """
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    except ImportError: pass
+    try:
+        import psutil
+        return psutil.Process(os.getpid()).memory_info().peak_wset / 1048576
+    except: return 0
+
+
+def read_header(raw, field_map):
+    """
+    build the field mapping from the first line of the csv data
+    """
+    for item in raw:
+        for key in field_map:
+            if key == item: field_map[key] = raw.index(item)
+            
+            
+def parse_flow(raw, field_map, source_filter):
+    """
+    convert a split csv row into a flow tuple using the field_map from read_header
+    (DestinationAddress, Protocol, SourceAddress, SourcePort, DestinationPort, BytesInVolume, BytesInRatePerDuration, FlowDuration, PacketsInRatePerDuration)
+    
+    SourceAddress is swapped for DestinationAddress when it matches source_filter
+    """
+    #define the csv data from NetQoS
+    DestinationAddress = raw[field_map['DestinationAddress']]
+    Protocol = int(raw[field_map['Protocol']])
+    SourceAddress = raw[field_map['SourceAddress']]
+    SourcePort = int(raw[field_map['SourcePort']])
+    DestinationPort = int(raw[field_map['DestinationPort']])
+    BytesInVolume = int(raw[field_map['BytesInVolume']])
+    BytesInRatePerDuration = float(raw[field_map['BytesInRatePerDuration']])
+    BytesInRatePerDuration = round(BytesInRatePerDuration, 2)
+    FlowDuration = int(raw[field_map['FlowDuration']])
+    PacketsInRatePerDuration = float(raw[field_map['PacketsInRatePerDuration']])
+    
+    #swap around SourceAddress and DestinationAddress for outbound flow analysis
+    if source_filter in SourceAddress: 
+        SourceAddress = DestinationAddress
+        
+    return DestinationAddress, Protocol, SourceAddress, SourcePort, DestinationPort, BytesInVolume, BytesInRatePerDuration, FlowDuration, PacketsInRatePerDuration
+
+
+def compressed_kind(fname):
+    """
+    'gzip', 'bz2' or 'xz' from the magic bytes at the start of fname, None for an uncompressed file
+    """
+    try:
+        file = open(fname, 'rb')
+        head = file.read(6)
+        file.close()
+    except IOError: return None
+    if head[:2] == '\x1f\x8b': return 'gzip'
+    if head[:3] == 'BZh': return 'bz2'
+    if head == '\xfd7zXZ\x00': return 'xz'
+    return None
+    
+    
+class DecompressReader(object):
+    def __init__(self, fname, codec, block=1048576, depth=8):
         """
-        Analyse netflow data and establish baselines according to the ASN# and county of origin, duration, size of flows
+        Lines of a gzip, bz2 or xz load file decompressed on a reader thread
         
-        netflow reports will load from \netflow\ folder
+        the thread reads block bytes at a time and queues the decompressed data cut at the last newline, up to
+        depth blocks ahead of the parser - zlib, bz2 and lzma release the GIL while they work so decompression
+        overlaps with parsing the rows, concatenated streams (pigz, pbzip2) are read as one file
+        """
+        if codec == 'xz' and lzma is None: raise IOError('xz load file needs the lzma module: ' + fname)
+        self.fname = fname
+        self.codec = codec
+        self.block = block
+        self.queue = Queue.Queue(depth)
+        self.stopped = 0
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
         
-        a load file logging list will record each file opened
         
-        new files will be opened according to file age
+    def decompressor(self):
+        if self.codec == 'gzip': return zlib.decompressobj(16 + zlib.MAX_WBITS)
+        if self.codec == 'bz2': return bz2.BZ2Decompressor()
+        return lzma.LZMADecompressor()
         
-        Format of netflow load file will be csv with the following fields:
-        RouterAddress,InterfaceIn,Protocol,SourceAddress,SourcePort,DestinationAddress,DestinationPort,TypeOfService,BytesInVolume,BytesInRatePerDuration,BytesInPercentOfTotalTraffic,FlowCount,FlowDuration,PacketsInVolume,PacketsInRatePerDuration,PacketsInPercentOfTotalTraffic
         
-        Only specified interesting fileds will be loaded:
-        Protocol
-        SourceAddress
-        SourcePort
-        DestinationAddress
-        DestinationPort
-        BytesInVolume
-        BytesInRatePerDuration
-        FlowDuration
-        PacketsInVolume
-        PacketsInRatePerDuration
+    def run(self):
+        try:
+            file = open(self.fname, 'rb')
+            try:
+                dec = self.decompressor()
+                tail = ''
+                while not self.stopped:
+                    raw = file.read(self.block)
+                    if not raw: break
+                    while raw:
+                        #a new stream starts after the end of the last one
+                        try: data = dec.decompress(raw)
+                        except EOFError:
+                            dec = self.decompressor()
+                            continue
+                        raw = dec.unused_data
+                        if raw: dec = self.decompressor()
+                        data = tail + data
+                        cut = data.rfind('\n') + 1
+                        if cut: 
+                            self.put(data[:cut])
+                            tail = data[cut:]
+                        else: tail = data
+                if tail: self.put(tail)
+            finally: file.close()
+        except: self.put(sys.exc_info()[1])
+        self.put(None)
         
-             
-        format of dictionary will be based on the fact that this is an inbound flow report that is manually created so each flow will be to the same destination - i.e. 193.127.210.129
         
-        ['destination_ip'] = {}
-        [destination_ip]['Protocol'] = {}
-        [destination_ip][Protocol]['src'] = {}
-        [destination_ip][Protocol][src] = SourceAddress + '_' + SourcePort
-        [destination_ip][Protocol][src]['DestinationPort'] = DestinationPort
+    def put(self, item):
+        while not self.stopped:
+            try: 
+                self.queue.put(item, timeout=0.5)
+                return
+            except Queue.Full: pass
+            
+            
+    def blocks(self):
+        while 1:
+            item = self.queue.get()
+            if item is None: return
+            if isinstance(item, Exception): raise item
+            yield item
+            
+            
+    def __iter__(self): return itertools.chain.from_iterable(data.splitlines() for data in self.blocks())
+            
+            
+    def read(self): return ''.join(self.blocks())
+    
+    
+    def close(self):
+        self.stopped = 1
+        while self.thread.is_alive():
+            try: self.queue.get(timeout=0.1)
+            except Queue.Empty: pass
+            
+            
+def iter_rows(file, field_map):
+    """
+    generator of split csv rows, the first line is used to build field_map
+    """
+    init = 0
+    for row in file:
+        if not row: continue
+        raw = row.split(',')
+        if init == 0:
+            read_header(raw, field_map)
+            init = 1
+            continue
+        yield raw
         
-        [destination_ip][Protocol][src]['TotalFlowCount'] = (1 if first entry but will increment for each flow seen for this src addrd and port to destination)
-        [destination_ip][Protocol][src]['BytesInVolume'] = BytesInVolume + will increment for future matching flows
-        [destination_ip][Protocol][src]['BytesInRatePerDuration'] = BytesInRatePerDuration + will increment for future matching flows
         
-        Etc for remaining fields, they will increment for future matching flows
+def iter_rows_offset(file, field_map, state, offset=None):
+    """
+    iter_rows for a file opened 'rb' that keeps the byte offset of the next row in state['offset']
+    the header is always read for field_map, reading then starts at offset when it is given
+    """
+    header = file.readline()
+    read_header(header.split(','), field_map)
+    state['offset'] = len(header)
+    if offset:
+        file.seek(offset)
+        state['offset'] = offset
+    for row in file:
+        state['offset'] += len(row)
+        yield row.split(',')
         
         
-        GeoIP lookups will be perfromed to provide the following fields:
-        AS Number
-        AS Org Name
-        Country Code
-        Latitude
-        Longitude
+def chunk_rows(rows, size):
+    """
+    generator of lists of up to size items
+    """
+    chunk = []
+    for raw in rows:
+        chunk.append(raw)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk: yield chunk
+    
+    
+def to_columns(rows, field_map, source_filter):
+    """
+    convert a list of split csv rows into a dict of typed column arrays keyed by field name
+    rows that would fail parse_flow are dropped, SourceAddress is swapped the same way as parse_flow
+    """
+    try: cols = rows_to_columns(rows, field_map)
+    except:
+        #at least one bad row, drop the rows that do not parse and convert the rest
+        good = []
+        for raw in rows:
+            try: 
+                parse_flow(raw, field_map, source_filter)
+                good.append(raw)
+            except: pass
+        cols = rows_to_columns(good, field_map)
         
+    #swap around SourceAddress and DestinationAddress for outbound flow analysis
+    cols['SourceAddress'] = [dst if source_filter in src else src for src, dst in zip(cols['SourceAddress'], cols['DestinationAddress'])]
+    return cols
+    
+    
+def rows_to_columns(rows, field_map):
+    cols = {}
+    for key in ('DestinationAddress', 'SourceAddress'):
+        i = field_map[key]
+        cols[key] = [raw[i] for raw in rows]
+    for key in ('Protocol', 'SourcePort', 'DestinationPort', 'FlowDuration'):
+        i = field_map[key]
+        cols[key] = array('l', [int(raw[i]) for raw in rows])
+    #BytesInVolume is a float array so large counters do not overflow a 32 bit long
+    i = field_map['BytesInVolume']
+    cols['BytesInVolume'] = array('d', [int(raw[i]) for raw in rows])
+    i = field_map['BytesInRatePerDuration']
+    cols['BytesInRatePerDuration'] = array('d', [round(float(raw[i]), 2) for raw in rows])
+    i = field_map['PacketsInRatePerDuration']
+    cols['PacketsInRatePerDuration'] = array('d', [float(raw[i]) for raw in rows])
+    return cols
+
+
+#field_map for the raw flow tuples from NetflowDecoder, in the same order as the tuples from parse_flow
+FLOW_FIELDS = {'DestinationAddress': 0, 'Protocol': 1, 'SourceAddress': 2, 'SourcePort': 3, 'DestinationPort': 4, 'BytesInVolume': 5,
+    'BytesInRatePerDuration': 6, 'FlowDuration': 7, 'PacketsInRatePerDuration': 8}
+
+#NetFlow v9 / IPFIX information elements used by NetflowDecoder
+NETFLOW_ELEMENTS = {1: 'bytes', 2: 'packets', 4: 'proto', 7: 'sport', 8: 'src', 11: 'dport', 12: 'dst', 21: 'last', 22: 'first',
+    150: 'start_s', 151: 'end_s', 152: 'start_ms', 153: 'end_ms'}
+NETFLOW_CODES = {1: 'B', 2: 'H', 4: 'I', 8: 'Q'}
+
+NF5_HEADER = struct.Struct('!HHIIIIBBH')
+NF5_RECORD = struct.Struct('!4s4s4sHHIIIIHHBBBBHHBBH')
+NF9_HEADER = struct.Struct('!HHIIII')
+IPFIX_HEADER = struct.Struct('!HHIII')
+SET_HEADER = struct.Struct('!HH')
+UINT16 = struct.Struct('!H')
+UINT32 = struct.Struct('!I')
+
+
+def flow_tuple(src, dst, proto, sport, dport, byts, packets, duration):
+    """
+    raw flow tuple in FLOW_FIELDS order, the rates are per second of FlowDuration
+    """
+    seconds = float(duration or 1)
+    return (socket.inet_ntoa(dst), proto, socket.inet_ntoa(src), sport, dport, byts, round(byts / seconds, 2), duration, packets / seconds)
+
+
+class NetflowDecoder(object):
+    def __init__(self):
+        """
+        Decode NetFlow v5, v9 and IPFIX export packets into raw flow tuples (see FLOW_FIELDS)
         
-        flow [src] fields will be checked for the AS# and arrays will be built for BytesinVolume, FlowDuration, TotalFlowCount & PacketsInRatePerDuration for each AS#
-        when records are parsed each flow will be first compared to the existing array data and checked for anomolys, then the data will be added.
+        records are read with struct unpack_from at fixed offsets in the packet buffer, which can be a
+        memory map of the capture file, so there is no copy of a packet or record
+        v9 and IPFIX templates are compiled to a Struct once and cached per exporter, source id and template id
+        for the following packets and files, templates with variable length fields or without IPv4 addresses are skipped
+        """
+        self.templates = {}
+        self.stats = {'packets': 0, 'flows': 0, 'templates': 0, 'no_template': 0, 'skipped': 0}
         
-        An AS# dict entry will be created for each AS#
-        AS = {}
-        AS[CIDR_Size] = num of possible hosts
-        AS[src_ip] = []    each src ip will be added to the dict to give a count of unique IP's seen from each AS#
         
-        Calculate the difference between Milton Keynes Latitude 52.0175    Longitude -.7896  and the source IP in miles
+    def compile_template(self, fields):
+        """
+        Struct and positions of the wanted elements for a list of (element id, length), None if the records can not be decoded
+        """
+        fmt = '!'
+        index = {}
+        n = 0
+        for element, length in fields:
+            if length == 65535: return None
+            name = NETFLOW_ELEMENTS.get(element)
+            if name in ('src', 'dst') and length == 4: fmt += '4s'
+            elif name and length in NETFLOW_CODES: fmt += NETFLOW_CODES[length]
+            else:
+                fmt += '%dx' % length
+                continue
+            index[name] = n
+            n += 1
+        if 'src' not in index or 'dst' not in index: return None
+        if 'start_ms' in index and 'end_ms' in index: timing = ('start_ms', 'end_ms', 1000, 0)
+        elif 'start_s' in index and 'end_s' in index: timing = ('start_s', 'end_s', 1, 0)
+        elif 'first' in index and 'last' in index: timing = ('first', 'last', 1000, 1)
+        else: timing = None
+        return struct.Struct(fmt), index, timing
         
-        Shenley = (52.0175, -0.7896)
         
-        GeoIP city lookup - 'latitude' and 'longitude'
+    def decode_record(self, template, buf, pos):
+        record, index, timing = template
+        values = record.unpack_from(buf, pos)
+        get = lambda name: values[index[name]] if name in index else 0
+        duration = 0
+        if timing:
+            duration = values[index[timing[1]]] - values[index[timing[0]]]
+            #sysuptime counters wrap at 32 bits
+            if timing[3]: duration &= 0xffffffff
+            duration /= timing[2]
+        return flow_tuple(values[index['src']], values[index['dst']], get('proto'), get('sport'), get('dport'), get('bytes'), get('packets'), duration)
         
-        Get an everage of the source distance in miles for each netflow sample and save to the dict at the end
         
-        [destination_ip]['Protocol']['Avg_Distance'] = Avg_Distance
+    def decode(self, buf, offset, length=None, exporter=''):
+        """
+        list of raw flow tuples from the export packet at offset
+        length is the packet length if known, without it the end of the packet is found from its header
+        returns (flows, end offset)
+        """
+        if length is None: end = len(buf)
+        else: end = offset + length
+        version = UINT16.unpack_from(buf, offset)[0]
+        self.stats['packets'] += 1
+        out = []
+        if version == 5: end = self.decode_v5(buf, offset, end, out)
+        elif version == 9: end = self.decode_v9(buf, offset, end, exporter, out, length is None)
+        elif version == 10: end = self.decode_ipfix(buf, offset, end, exporter, out)
+        else: 
+            self.stats['skipped'] += 1
+            if length is None: raise ValueError('unknown netflow version %d at %d' % (version, offset))
+        self.stats['flows'] += len(out)
+        return out, end
         
-        Use BytesInVolume distrubution per ASN to determine how trustworthy the AS# is
         
-        Use distance to AS# as another measure of trust
+    def decode_v5(self, buf, offset, end, out):
+        count = NF5_HEADER.unpack_from(buf, offset)[1]
+        pos = offset + NF5_HEADER.size
+        end = min(end, pos + count * NF5_RECORD.size)
+        while pos + NF5_RECORD.size <= end:
+            rec = NF5_RECORD.unpack_from(buf, pos)
+            out.append(flow_tuple(rec[0], rec[1], rec[13], rec[9], rec[10], rec[6], rec[5], ((rec[8] - rec[7]) & 0xffffffff) / 1000))
+            pos += NF5_RECORD.size
+        return end
         
-        Country reputation can be manually fixed per country - i.e. mark down China, Russia, Nork, USA
         
-        Use whitelists for known good AS# & black lists for known bad AS#
+    def read_fields(self, buf, pos, count, enterprise):
+        """
+        list of (element id, length) for count template fields at pos, returns (fields, end offset)
+        enterprise specific IPFIX elements are given an id that is never wanted
+        """
+        fields = []
+        for n in xrange(count):
+            element, length = SET_HEADER.unpack_from(buf, pos)
+            pos += 4
+            if enterprise and element & 0x8000:
+                element = -1
+                pos += 4
+            fields.append((element, length))
+        return fields, pos
         
-        Use Avg_BytesPerFlow for the highest distrubution AS# to deterine the expected rates
         
+    def add_templates(self, buf, pos, end, key, enterprise):
+        """
+        compile the templates of a template set, returns the number of templates
+        """
+        count = 0
+        while pos + 4 <= end:
+            template_id, field_count = SET_HEADER.unpack_from(buf, pos)
+            if field_count == 0: 
+                #template withdrawal
+                self.templates.pop(key + (template_id,), None)
+                pos += 4
+                continue
+            fields, pos = self.read_fields(buf, pos + 4, field_count, enterprise)
+            self.templates[key + (template_id,)] = self.compile_template(fields)
+            self.stats['templates'] += 1
+            count += 1
+        return count
         
-        Tested with Python ver 2.7.2 on Win7
-        (c) 2012 - 2016 Intelligent Planet Ltd
         
+    def add_data(self, buf, pos, end, key, out):
         """
-        Tools.__init__(self)
-        self.verbose = verbose
-        self.path = 'h:\\backup\\' + 'netflow' + '\\'
+        decode the records of a data set with its cached template, returns the number of records
+        """
+        try: template = self.templates[key]
+        except KeyError:
+            self.stats['no_template'] += 1
+            return 0
+        if template is None:
+            self.stats['skipped'] += 1
+            return 0
+        size = template[0].size
+        count = 0
+        while pos + size <= end:
+            out.append(self.decode_record(template, buf, pos))
+            pos += size
+            count += 1
+        return count
         
-        self.netflow_dict = {}
-        self.netflow_dict['load_file_history'] = {}
         
+    def decode_v9(self, buf, offset, end, exporter, out, framed):
+        """
+        NetFlow v9 packet, framed is set when the packet length is not known and the header record count
+        is used to find the end of the packet, which needs the templates to come before their data in the file
+        """
+        version, count, uptime, secs, sequence, source_id = NF9_HEADER.unpack_from(buf, offset)
+        key = (exporter, source_id)
+        pos = offset + NF9_HEADER.size
+        records = 0
+        while pos + 4 <= end:
+            if framed and records >= count: break
+            set_id, length = SET_HEADER.unpack_from(buf, pos)
+            if length < 4: break
+            set_end = min(pos + length, end)
+            if set_id == 0: records += self.add_templates(buf, pos + 4, set_end, key, 0)
+            elif set_id == 1:
+                #options templates are not decoded, their data sets are skipped
+                template_id = UINT16.unpack_from(buf, pos + 4)[0]
+                self.templates[key + (template_id,)] = None
+                records += 1
+            elif set_id >= 256: records += self.add_data(buf, pos + 4, set_end, key + (set_id,), out)
+            elif framed: break
+            pos += length
+        return pos
         
-        self.netflow_dict['ASN_Stats'] = {}
-        self.netflow_dict['ASN_Stats']['Total_TotalFlowCount'] = 0
-        self.netflow_dict['ASN_Stats']['Total_BytesInVolume'] = 0
-        self.netflow_dict['ASN_Stats']['Avg_BytesPerFlow'] = 0
-        self.netflow_dict['ASN_Stats']['Dist_TotalFlowCount'] = []
-        self.netflow_dict['ASN_Stats']['Dist_BytesInVolume'] = []
-        self.netflow_dict['ASN_Stats']['Dist_FlowCutOff'] = 0.
-        self.netflow_dict['ASN_Stats']['Dist_BytesCutOff'] = 0.
         
-        self.DistFlowCutOffFactor  = 0.0005
-        self.DistBytesCutOffFactor = 0.000005
+    def decode_ipfix(self, buf, offset, end, exporter, out):
+        version, length, export_time, sequence, domain = IPFIX_HEADER.unpack_from(buf, offset)
+        end = min(end, offset + length)
+        key = (exporter, domain)
+        pos = offset + IPFIX_HEADER.size
+        while pos + 4 <= end:
+            set_id, length = SET_HEADER.unpack_from(buf, pos)
+            if length < 4: break
+            set_end = min(pos + length, end)
+            if set_id == 2: self.add_templates(buf, pos + 4, set_end, key, 1)
+            elif set_id == 3:
+                template_id = UINT16.unpack_from(buf, pos + 4)[0]
+                self.templates[key + (template_id,)] = None
+            elif set_id >= 256: self.add_data(buf, pos + 4, set_end, key + (set_id,), out)
+            pos += length
+        return end
         
         
-        self.field_map = {'Protocol':-1, 'SourceAddress':-1, 'SourcePort':-1, 'DestinationAddress':-1, 'DestinationPort':-1, 'BytesInVolume':-1, 'BytesInRatePerDuration':-1, 'FlowDuration':-1, 'PacketsInVolume':-1, 'PacketsInRatePerDuration':-1}
+def iter_pcap(buf):
+    """
+    generator of (exporter, offset, length) for the UDP payloads in a libpcap capture held in buf
+    the exporter is the packed source address, IP fragments and non UDP packets are skipped
+    """
+    magic = buf[:4]
+    if magic in ('\xd4\xc3\xb2\xa1', '\x4d\x3c\xb2\xa1'): order = '<'
+    elif magic in ('\xa1\xb2\xc3\xd4', '\xa1\xb2\x3c\x4d'): order = '>'
+    else: raise ValueError('not a libpcap capture')
+    record = struct.Struct(order + 'IIII')
+    linktype = struct.unpack_from(order + 'I', buf, 20)[0]
+    size = len(buf)
+    pos = 24
+    while pos + record.size <= size:
+        incl_len = record.unpack_from(buf, pos)[2]
+        pkt = pos + record.size
+        pos = pkt + incl_len
+        if pos > size: break
         
-        #Set the reference point for distance calculations
-        self.home_city = (52.0175, -0.7896)
+        #link layer
+        if linktype == 1:
+            ethertype = UINT16.unpack_from(buf, pkt + 12)[0]
+            l3 = pkt + 14
+            while ethertype in (0x8100, 0x88a8):
+                ethertype = UINT16.unpack_from(buf, l3 + 2)[0]
+                l3 += 4
+        elif linktype == 113:
+            ethertype = UINT16.unpack_from(buf, pkt + 14)[0]
+            l3 = pkt + 16
+        elif linktype in (0, 12, 101, 228):
+            l3 = pkt + (4 if linktype == 0 else 0)
+            ethertype = {4: 0x0800, 6: 0x86dd}.get(ord(buf[l3]) >> 4)
+        else: raise ValueError('unsupported pcap link type %d' % linktype)
         
-        #Use the source filter to enable mapping of outbound flows from this IP / Prefix using text matching only
-        self.SourceFilter = '193.127.210'
+        #network and transport layer
+        if ethertype == 0x0800:
+            first = ord(buf[l3])
+            if ord(buf[l3 + 9]) != 17: continue
+            if UINT16.unpack_from(buf, l3 + 6)[0] & 0x3fff: continue
+            exporter = buf[l3 + 12:l3 + 16]
+            udp = l3 + (first & 0xf) * 4
+        elif ethertype == 0x86dd:
+            if ord(buf[l3 + 6]) != 17: continue
+            exporter = buf[l3 + 8:l3 + 24]
+            udp = l3 + 40
+        else: continue
+        length = min(UINT16.unpack_from(buf, udp + 4)[0], pos - udp) - 8
+        if length > 0: yield exporter, udp + 8, length
+        
+        
+def exporter_key(addr):
+    """
+    packed exporter address for the template cache, the same form iter_pcap gives
+    """
+    try: return socket.inet_aton(addr[0])
+    except: return str(addr[0])
+    
+    
+def export_packets(fname):
+    """
+    list of the export packets in a capture or datagram file
+    """
+    buf = open(fname, 'rb').read()
+    try: return [buf[offset:offset + length] for exporter, offset, length in iter_pcap(buf)]
+    except ValueError: pass
+    out = []
+    decoder = NetflowDecoder()
+    pos = 0
+    while pos < len(buf):
+        end = decoder.decode(buf, pos)[1]
+        out.append(buf[pos:end])
+        pos = end
+    return out
+    
+    
+def replay_sender(fname, host='127.0.0.1', port=2055, rate=0, loops=1):
+    """
+    send the export packets in a capture or datagram file to a collector, rate is packets per second, 0 for no limit
+    returns the number of packets sent
+    """
+    packets = export_packets(fname)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sent = 0
+    for n in xrange(loops):
+        for packet in packets:
+            sock.sendto(packet, (host, port))
+            sent += 1
+            if rate: time.sleep(1. / rate)
+    sock.close()
+    return sent
+    
+    
+if asyncio is not None:
+    class CollectorProtocol(asyncio.DatagramProtocol):
+        """
+        hands each datagram to Inetflow.collector_receive, decoding is left to the collector tick
+        """
+        def __init__(self, nf):
+            self.nf = nf
+            self.transport = None
+            
+        def connection_made(self, transport):
+            self.transport = transport
+            
+        def datagram_received(self, data, addr):
+            self.nf.collector_receive(data, addr)
+            
+        def error_received(self, exc):
+            self.nf.collector_stats['errors'] += 1
+            
+            
+#typecode of each cached column, the addresses are stored as ints and the SourceFilter swap is done on replay
+COLUMN_TYPES = (('DestinationAddress', 'I'), ('SourceAddress', 'I'), ('Protocol', 'B'), ('SourcePort', 'H'), ('DestinationPort', 'H'),
+    ('FlowDuration', 'I'), ('BytesInVolume', 'd'), ('BytesInRatePerDuration', 'd'), ('PacketsInRatePerDuration', 'd'))
+COLUMN_MAGIC = 'NFCOL1\n'
+
+
+class ColumnWriter(object):
+    def __init__(self, field_map):
+        """
+        Collects the typed columns of a load file for the binary column cache
+        rows are added as split csv rows before the SourceFilter swap, rows that do not convert are dropped
+        """
+        self.field_map = field_map
+        self.cols = dict((name, array(code)) for name, code in COLUMN_TYPES)
         
-        #The threshold where flows above this are recorded in detail
-        self.TrustThreshold = 200
         
-        self.open_db()
+    def convert(self, rows):
+        fm = self.field_map
+        out = {}
+        for name, code in COLUMN_TYPES:
+            i = fm[name]
+            if code == 'I' and name != 'FlowDuration': out[name] = array(code, [ip2int(raw[i]) for raw in rows])
+            elif code == 'd' and name != 'BytesInVolume': out[name] = array(code, [float(raw[i]) for raw in rows])
+            else: out[name] = array(code, [int(raw[i]) for raw in rows])
+        out['BytesInRatePerDuration'] = array('d', [round(value, 2) for value in out['BytesInRatePerDuration']])
+        return out
         
         
-
+    def append(self, rows):
+        try: cols = self.convert(rows)
+        except:
+            good = []
+            for raw in rows:
+                try: 
+                    self.convert([raw])
+                    good.append(raw)
+                except: pass
+            cols = self.convert(good)
+        for name, code in COLUMN_TYPES: self.cols[name].extend(cols[name])
         
-    def get_next_file(self):
+        
+    def addresses(self):
         """
-        Get the oldest file that has not loaded before.
+        set of the addresses in both address columns
         """
-        #list the files in the directory
-        #print self.path
-        files = os.listdir(self.path)
-        #print files
+        return set(self.cols['DestinationAddress']) | set(self.cols['SourceAddress'])
         
-        if len(files) == 1: out = files[0]
         
-        #add files not previously loaded to a new list
-        new_files = []
-        keys = self.netflow_dict['load_file_history']
-        #pprint.pprint(keys)
-        for cfile in files:
-            if cfile not in keys: new_files.append(cfile)
-        
-        #Find the oldest new_file
-        age = []
-        for cfile in new_files: 
-            path_cfile = self.path + cfile
-            age.append(os.path.getmtime(path_cfile))
-        age.sort()
-        max = age[-1]    #newest file age
-        
-        #sort the oldest file first
-        for cfile in new_files:
-            path_cfile = self.path + cfile
-            if os.path.getmtime(path_cfile) <= max:
-                out = cfile
-                max = os.path.getmtime(path_cfile)
+    def write(self, fname, age, geo):
+        """
+        write the columns to fname
+        layout is COLUMN_MAGIC, the header length, a pickled header, then each column as raw machine values
+        at an 8 byte aligned offset so ColumnFile can map it straight from the file
+        geo is a list of (address, GeoIP cache record) for the enrichment of the addresses
+        """
+        rows = len(self.cols['SourceAddress'])
+        columns = []
+        offset = 0
+        for name, code in COLUMN_TYPES:
+            columns.append((name, code, offset, rows))
+            offset += (rows * self.cols[name].itemsize + 7) & ~7
+        header = pickle.dumps({'rows': rows, 'age': age, 'columns': columns, 'geo': geo, 'byteorder': sys.byteorder}, -1)
+        start = (len(COLUMN_MAGIC) + 8 + len(header) + 7) & ~7
         
-        #out is the oldest cfile not previously loaded so add it to the load history
-        self.netflow_dict['load_file_history'][out] = {}
-        #save the age now as we have the value
-        self.netflow_dict['load_file_history'][out]['age'] = max
-        #print 'out =', out
+        tmp = fname + '.tmp'
+        cfile = open(tmp, 'wb')
+        cfile.write(COLUMN_MAGIC)
+        cfile.write(struct.pack('<Q', len(header)))
+        cfile.write(header)
+        for name, code, col_offset, count in columns:
+            cfile.seek(start + col_offset)
+            self.cols[name].tofile(cfile)
+        cfile.write('\0' * 8)
+        cfile.close()
+        if os.path.exists(fname): os.remove(fname)
+        os.rename(tmp, fname)
+        
+        
+class ColumnFile(object):
+    def __init__(self, fname):
+        """
+        Read only memory map of a file written by ColumnWriter
+        column() is a numpy view of the mapped file when numpy is installed, otherwise a copy into an array
+        """
+        self.file = open(fname, 'rb')
+        if self.file.read(len(COLUMN_MAGIC)) != COLUMN_MAGIC: 
+            self.file.close()
+            raise ValueError('not a column cache file ' + fname)
+        size = struct.unpack('<Q', self.file.read(8))[0]
+        header = pickle.loads(self.file.read(size))
+        self.start = (len(COLUMN_MAGIC) + 8 + size + 7) & ~7
+        self.rows = header['rows']
+        self.age = header['age']
+        self.geo = header['geo']
+        self.swap = header['byteorder'] != sys.byteorder
+        self.columns = dict((name, (code, offset, count)) for name, code, offset, count in header['columns'])
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        
+        
+    def column(self, name, start=0, end=None):
+        code, offset, count = self.columns[name]
+        if end is None or end > count: end = count
+        itemsize = array(code).itemsize
+        first = self.start + offset + start * itemsize
+        if numpy is not None and not self.swap: return numpy.frombuffer(self.map, dtype=numpy.dtype(code), count=end - start, offset=first)
+        out = array(code, self.map[first:first + (end - start) * itemsize])
+        if self.swap: out.byteswap()
         return out
         
         
-    def load(self):
-        try: cfile = self.get_next_file()
-        except: #exit load as no new file to parse
-            #refresh the ASN trust metrics
-            ignore = self.asn_metric()
-            print 'All file stats'
-            self.view_stats()
-            return 'nothing to load'
-        self.load_file = self.path + cfile
-        print '##### loading ', self.load_file
+    def to_columns(self, start, end, source_filter, names=None):
+        """
+        dict of columns for rows start to end in the form returned by to_columns, with the SourceFilter swap applied
+        names is an optional dict used to memoise the address strings
+        """
+        if names is None: names = {}
+        cols = {}
+        for name, code in COLUMN_TYPES:
+            col = self.column(name, start, end)
+            if name.endswith('Address'):
+                out = []
+                for num in col.tolist():
+                    try: out.append(names[num])
+                    except KeyError:
+                        names[num] = int2ip(num)
+                        out.append(names[num])
+                cols[name] = out
+            elif code == 'd': cols[name] = array('d', col.tolist())
+            else: cols[name] = array('l', col.tolist())
+        cols['SourceAddress'] = [dst if source_filter in src else src for src, dst in zip(cols['SourceAddress'], cols['DestinationAddress'])]
+        return cols
         
-        #initialise stats for the current load_file
-        self.netflow_dict['load_file_history'][cfile]['Total_TotalFlowCount'] = 0
-        self.netflow_dict['load_file_history'][cfile]['Total_BytesInVolume'] = 0
-        self.netflow_dict['load_file_history'][cfile]['Avg_BytesPerFlow'] = 0
-        self.netflow_dict['load_file_history'][cfile]['Avg_AsnMetric'] = 0
         
-        #create a dictionary for recording the flows above self.TrustThreshold
-        self.netflow_dict['Report'] = {}
+    def close(self):
+        self.map.close()
+        self.file.close()
         
-        #identify the first line with the data label
-        init = 0
         
-        file = open(self.load_file, 'rU')
-        for row in file:
-            if row:
-                try:
-                    raw = row.split(',')
-                    #build the filed mapping from the first line of the csv data
-                    if init ==0:
-                        for item in raw:
-                            for key in self.field_map:
-                                if key == item: self.field_map[key] = raw.index(item)
-                        init = 1
-                        #print self.field_map
-                        continue
-                        
-                    #read first line of data
-                    #print raw
-                    
-                    #define the csv data from NetQoS
-                    DestinationAddress = raw[self.field_map['DestinationAddress']]
-                    Protocol = int(raw[self.field_map['Protocol']])
-                    SourceAddress = raw[self.field_map['SourceAddress']]
-                    SourcePort = int(raw[self.field_map['SourcePort']])
-                    DestinationPort = int(raw[self.field_map['DestinationPort']])
-                    BytesInVolume = int(raw[self.field_map['BytesInVolume']])
-                    BytesInRatePerDuration = float(raw[self.field_map['BytesInRatePerDuration']])
-                    BytesInRatePerDuration = round(BytesInRatePerDuration, 2)
-                    FlowDuration = int(raw[self.field_map['FlowDuration']])
-                    PacketsInRatePerDuration = float(raw[self.field_map['PacketsInRatePerDuration']])
-                    
-                    #test
-                    #print DestinationAddress, Protocol, SourceAddress, SourcePort, DestinationPort, BytesInVolume, BytesInRatePerDuration, FlowDuration, PacketsInRatePerDuration
-                    #print BytesInVolume, BytesInRatePerDuration, FlowDuration, PacketsInRatePerDuration
-                    
-                    #source filter to ignore any return packets - Inbound only
-                    #if self.SourceFilter in SourceAddress: continue
-                    
-                    #swap around SourceAddress and DestinationAddress for outbound flow analysis
-                    if self.SourceFilter in SourceAddress: 
-                        SourceAddress = DestinationAddress
-                    
-                    #source filter to ignore any inbound packets - Outbound only
-                    #if self.SourceFilter not in SourceAddress: continue
-                    
-                    #GeoIP lookups will be perfromed to provide the following fields:
-                    #AS Number, AS Org Name, Country Code, Latitude, Longitude
-                    
-                    #city lookup
-                    #print 'city lookup', SourceAddress
-                    #city_res = geoip_city.record_by_addr(SourceAddress)
-                    #print city_res
-                    #CountryCode = city_res['country_code']
-                    #Latitude = city_res['latitude']
-                    #Longitude = city_res['longitude']
-                    #print CountryCode, Latitude, Longitude
-                    
-                    #AS lookup
-                    #print 'asn lookup', SourceAddress
-                    asn_res = geoip_asn.asn_by_addr(SourceAddress)
-                    #print asn_res
-                    asn_raw = asn_res.split(' ')
-                    AS_Number = asn_raw[0]
-                    
+def trust_metric(distance, avg_bpf, flows, std_dev, std_avg, cutoff):
+    """
+    TrustMetric of one AS, the same arithmetic as Inetflow.metric_as
+    """
+    DistanceMetric = (distance / 2500.)
+    if DistanceMetric < 1: DistanceMetric = 1.
+    if DistanceMetric > 2: DistanceMetric = 2.
+    NegByteMetric = float(avg_bpf) - (std_avg + (std_dev / 2))
+    if NegByteMetric < 1: NegByteMetric = 1.
+    PosByteMetric = float(std_avg - (std_dev / 2.)) - avg_bpf
+    if PosByteMetric < 1: PosByteMetric = 1.
+    TotalByteMetric = NegByteMetric + PosByteMetric
+    if TotalByteMetric > 50000: TotalByteMetric = 50000
+    FlowCountMetric = (cutoff / flows)
+    if FlowCountMetric > 5: FlowCountMetric = 5.
+    TrustMetric = ((((FlowCountMetric) * TotalByteMetric) * DistanceMetric) / 500000) * 1000
+    if TrustMetric < 1: TrustMetric = 1.
+    return TrustMetric
+    
+    
+def trust_columns(distance, avg_bpf, flows, std_dev, std_avg, cutoff):
+    """
+    TrustMetric for columns of SourceAddressDistance, Avg_BytesPerFlow and TotalFlowCount
+    the columns are float arrays, every TotalFlowCount must be above 0
+    numpy evaluates the whole batch at once, the float64 operations are the same as trust_metric
+    """
+    if numpy is None or not isinstance(cutoff, float) or len(flows) < 64:
+        return [trust_metric(distance[i], avg_bpf[i], flows[i], std_dev, std_avg, cutoff) for i in xrange(len(flows))]
+    distance = numpy.frombuffer(distance, dtype=numpy.float64)
+    avg_bpf = numpy.frombuffer(avg_bpf, dtype=numpy.float64)
+    flows = numpy.frombuffer(flows, dtype=numpy.float64)
+    DistanceMetric = numpy.clip(distance / 2500., 1., 2.)
+    NegByteMetric = numpy.maximum(avg_bpf - (std_avg + (std_dev / 2)), 1.)
+    PosByteMetric = numpy.maximum(float(std_avg - (std_dev / 2.)) - avg_bpf, 1.)
+    TotalByteMetric = numpy.minimum(NegByteMetric + PosByteMetric, 50000.)
+    FlowCountMetric = numpy.minimum(cutoff / flows, 5.)
+    TrustMetric = ((((FlowCountMetric) * TotalByteMetric) * DistanceMetric) / 500000) * 1000
+    return numpy.maximum(TrustMetric, 1.).tolist()
+    
+    
+class GeoCache(object):
+    def __init__(self, size=100000, cfile=''):
+        """
+        LRU cache of GeoIP enrichment results keyed by IP address
+        
+        each entry is a dict with the fields AS_Number, ASN_Org and when a city lookup has been made
+        CountryCode, Latitude, Longitude and SourceAddressDistance
+        
+        an entry of None records an address that could not be resolved so it is not looked up again
+        
+        the least recently used entry is evicted once size entries are held
+        hits and misses are counted for view_cache
+        
+        when cfile is set the cache can be saved and reopened so a restart starts warm
+        """
+        self.size = size
+        self.cfile = cfile
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.cache = OrderedDict()
+        
+        
+    def get(self, ip):
+        """
+        return the cached record for ip and mark it as recently used
+        raise KeyError if ip is not cached
+        """
+        try: rec = self.cache.pop(ip)
+        except KeyError:
+            self.misses += 1
+            raise
+        self.cache[ip] = rec
+        self.hits += 1
+        return rec
+        
+        
+    def put(self, ip, rec):
+        try: self.cache.pop(ip)
+        except KeyError: pass
+        self.cache[ip] = rec
+        while len(self.cache) > self.size:
+            self.cache.popitem(last=False)
+            self.evictions += 1
+            
+            
+    def stats(self):
+        total = self.hits + self.misses
+        if total: ratio = self.hits * 100. / total
+        else: ratio = 0.
+        return {'size': len(self.cache), 'max_size': self.size, 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'hit_ratio': round(ratio, 2)}
+        
+        
+    def save(self):
+        if not self.cfile: return
+        cfile = open(self.cfile, 'wb')
+        pickle.dump(self.cache.items(), cfile, -1)
+        cfile.close()
+        
+        
+    def open(self):
+        if not self.cfile: return
+        try: cfile = open(self.cfile, 'rb')
+        except IOError: return
+        try: 
+            for ip, rec in pickle.load(cfile): self.put(ip, rec)
+        except: pass
+        cfile.close()
 
-                    #calculate distance from self.home_city to the SourceAddress in Miles
-                    #SourceAddressCity = (Latitude, Longitude)
-                    #SourceAddressDistance = int(vincenty(self.home_city, SourceAddressCity).miles)
-                    #print 'distance', SourceAddressDistance
-                    
-                    #create a dict structre to hold the data for AS_Number comparison
-                    #self.netflow_dict[AS_Number] = {}
-                    #self.netflow_dict[AS_Number]['CountryCode'] = []    #add each unique country code to a list
-                    #self.netflow_dict[AS_Number]['ASN_Org'] = ASN_Org
-                    #self.netflow_dict[AS_Number]['SourceAddressDistance'] = []    #add each distance to a list
-                    #self.netflow_dict[AS_Number]['BytesinVolume'] = []    #add each BytesinVolume to a list
-                    #self.netflow_dict[AS_Number]['PacketsInRatePerDuration'] = []    #add each PacketsInRatePerDuration to a list
-                    
-                    #FlowDuration and TotalFlowCount are not being added as 15 min data will not give anything meaningfull
-                    #data will be added to the lists and will form a baseline, once there is sufficient data statistical anylsis can 
-                    #be perfomred to compare the base data to new flows.
-                    
-                    #check if the AS_Number dict exists, if not then create the entries for it
-                    try: self.netflow_dict[AS_Number]
-                    except: 
-                        try:
-                            start = len(AS_Number) + 1
-                            ASN_Org = asn_res[start:]
-                            print AS_Number, ASN_Org
-                            
-                            #city lookup
-                            #print 'city lookup', SourceAddress
-                            city_res = geoip_city.record_by_addr(SourceAddress)
-                            #print city_res
-                            CountryCode = city_res['country_code']
-                            Latitude = city_res['latitude']
-                            Longitude = city_res['longitude']
-                            #print CountryCode, Latitude, Longitude
-                        
-                            #calculate distance from self.home_city to the SourceAddress in Miles
-                            SourceAddressCity = (Latitude, Longitude)
-                            SourceAddressDistance = int(vincenty(self.home_city, SourceAddressCity).miles)
-                            #print 'distance', SourceAddressDistance
-                        
-                        except:
-                            CountryCode = 'unknown'
-                            SourceAddressCity = 'unknown'
-                            SourceAddressDistance = 100
-                        
-                        self.netflow_dict[AS_Number] = {}
-                        self.netflow_dict[AS_Number]['CountryCode'] = CountryCode
-                        self.netflow_dict[AS_Number]['ASN_Org'] = ASN_Org
-                        self.netflow_dict[AS_Number]['SourceAddressDistance'] = SourceAddressDistance
-                        self.netflow_dict[AS_Number]['BytesInVolume'] = 0
-                        self.netflow_dict[AS_Number]['PacketsInRatePerDuration'] = 0.0
-                        self.netflow_dict[AS_Number]['TotalFlowCount'] = 0
-                        self.netflow_dict[AS_Number]['Avg_BytesPerFlow'] = 0
-                        self.netflow_dict[AS_Number]['Avg_PacketsInRatePerDuration'] = 0
-                        self.netflow_dict[AS_Number]['DistanceMetric'] = DistanceMetric
-                        
-                    
-                    try: self.netflow_dict[AS_Number]['TotalFlowCount'] += 1
-                    except: pass
-                    
-                    try: self.netflow_dict[AS_Number]['BytesInVolume'] += BytesInVolume
-                    except: pass
-                    
-                    try: self.netflow_dict[AS_Number]['Avg_BytesPerFlow'] = self.netflow_dict[AS_Number]['BytesInVolume'] / self.netflow_dict[AS_Number]['TotalFlowCount']
-                    except: pass
-                    
-                    try: self.netflow_dict[AS_Number]['PacketsInRatePerDuration'] += round(PacketsInRatePerDuration, 4)
-                    except: pass
-                    
-                    try: self.netflow_dict[AS_Number]['Avg_PacketsInRatePerDuration'] = self.netflow_dict[AS_Number]['PacketsInRatePerDuration'] / self.netflow_dict[AS_Number]['TotalFlowCount']
-                    except: pass
-                    
-                    #update the Avg_AsnMetric for the file history
-                    #self.netflow_dict['ASN_Metrics']['Trust'][ASN]
-                    try: trust_res = self.netflow_dict['ASN_Metrics']['Trust'][AS_Number]
-                    except: trust_res = self.metric_as(AS_Number, verbose=0)
-                    try: self.netflow_dict['load_file_history'][cfile]['Avg_AsnMetric'] += int(trust_res)
-                    except: pass
-                    
-                    #global and load_file ASN stats
-                    try: 
-                        self.netflow_dict['ASN_Stats']['Total_TotalFlowCount'] += 1
-                        self.netflow_dict['load_file_history'][cfile]['Total_TotalFlowCount'] += 1
-                    except: pass
-                    
-                    try: 
-                        self.netflow_dict['ASN_Stats']['Total_BytesInVolume'] += BytesInVolume
-                        self.netflow_dict['load_file_history'][cfile]['Total_BytesInVolume'] += BytesInVolume
-                    except: pass
 
-               
-                    #store flows that have trust_res > self.TrustThreshold
-                    #if trust_res < self.TrustThreshold: continue
-                    
-                    #flows will be stored by the following format to provide a reasenable level of data compression:
-                    #self.netflow_dict['Report'][DestinationAddress] = {}
-                    #self.netflow_dict['Report'][DestinationAddress][protocol] = {}
-                    #self.netflow_dict['Report'][DestinationAddress][protocol][DestinationPort] = {}
-                    #self.netflow_dict['Report'][DestinationAddress][protocol][DestinationPort][SourceAddress] = {}
-                    #self.netflow_dict['Report'][DestinationAddress][protocol][DestinationPort][SourceAddress][SourcePort] = {}
-                    
-                    #self.netflow_dict['Report'][DestinationAddress][protocol][DestinationPort][SourceAddress][SourcePort]['TotalFlowCount'] = 1    #if the first otherwise will increment by +1
-                    
-                    #self.netflow_dict['Report'][DestinationAddress][protocol][DestinationPort][SourceAddress][SourcePort]['BytesInVolume'] = BytesInVolume    #if the first otherwise will increment by sum
-                    
-                    #self.netflow_dict['Report'][DestinationAddress][protocol][DestinationPort][SourceAddress][SourcePort]['FlowDuration'] = FlowDuration    #if the first otherwise will increment by sum
-                    
-                    #self.netflow_dict['Report'][DestinationAddress][protocol][DestinationPort][SourceAddress][SourcePort]['PacketsInRatePerDuration'] = PacketsInRatePerDuration    #if the first otherwise will increment by sum
-                    
-                    #check if the destination dict exists, if not then create it
-                    try: self.netflow_dict['Report'][DestinationAddress]
-                    except: self.netflow_dict['Report'][DestinationAddress] = {}
-                    
-                    #check if the protocol dict exists, if not then create it
-                    try: self.netflow_dict['Report'][DestinationAddress][Protocol]
-                    except: self.netflow_dict['Report'][DestinationAddress][Protocol] = {}
-                    
-                    #check if the DestinationPort dict exists, if not then create it
-                    try: self.netflow_dict['Report'][DestinationAddress][Protocol][DestinationPort]
-                    except: self.netflow_dict['Report'][DestinationAddress][Protocol][DestinationPort] = {}
-                    
-                    #check if the SourceAddress dict exists, if not then create it
-                    try: self.netflow_dict['Report'][DestinationAddress][Protocol][DestinationPort][SourceAddress]
-                    except: self.netflow_dict['Report'][DestinationAddress][Protocol][DestinationPort][SourceAddress] = {}
-                    
-                    #check if the SourcePort dict exists, if not then create it
-                    try: self.netflow_dict['Report'][DestinationAddress][Protocol][DestinationPort][SourceAddress][SourcePort]
-                    except: self.netflow_dict['Report'][DestinationAddress][Protocol][DestinationPort][SourceAddress][SourcePort] = {}
-                    
-                    #check if the TrustMetric dict exists, if not create it
-                    try: self.netflow_dict['Report'][DestinationAddress][Protocol][DestinationPort][SourceAddress]['TrustMetric']
-                    except: self.netflow_dict['Report'][DestinationAddress][Protocol][DestinationPort][SourceAddress]['TrustMetric'] = trust_res
-                    
-                    #check if the TotalFlowCount entry exists, if so increment the total by 1
-                    try: self.netflow_dict['Report'][DestinationAddress][Protocol][DestinationPort][SourceAddress][SourcePort]['TotalFlowCount'] += 1
-                    except: self.netflow_dict['Report'][DestinationAddress][Protocol][DestinationPort][SourceAddress][SourcePort]['TotalFlowCount'] = 1
-                    
-                    #check if the BytesInVolume entry exists, if so increment the total by sum
-                    try: self.netflow_dict['Report'][DestinationAddress][Protocol][DestinationPort][SourceAddress][SourcePort]['BytesInVolume'] += BytesInVolume
-                    except: self.netflow_dict['Report'][DestinationAddress][Protocol][DestinationPort][SourceAddress][SourcePort]['BytesInVolume'] = BytesInVolume
-                    
-                    #check if the IPBytesInVolume entry exists for per IP, if so increment the total
-                    try: self.netflow_dict['Report'][DestinationAddress][Protocol]['IPBytesInVolume'] += BytesInVolume
-                    except: self.netflow_dict['Report'][DestinationAddress][Protocol]['IPBytesInVolume'] = BytesInVolume
-                    
-                    #check if the FlowDuration entry exists, if so increment the total by sum
-                    try: self.netflow_dict['Report'][DestinationAddress][Protocol][DestinationPort][SourceAddress][SourcePort]['FlowDuration'] += FlowDuration
-                    except: self.netflow_dict['Report'][DestinationAddress][Protocol][DestinationPort][SourceAddress][SourcePort]['FlowDuration'] = FlowDuration
-                    
-                    #check if the PacketsInRatePerDuration entry exists, if so increment the total by sum
-                    try: self.netflow_dict['Report'][DestinationAddress][Protocol][DestinationPort][SourceAddress][SourcePort]['PacketsInRatePerDuration'] += PacketsInRatePerDuration
-                    except: self.netflow_dict['Report'][DestinationAddress][Protocol][DestinationPort][SourceAddress][SourcePort]['PacketsInRatePerDuration'] = PacketsInRatePerDuration
+class GeoRangeIndex(object):
+    def __init__(self, asn_file='', blocks_file='', location_file=''):
+        """
+        Sorted integer range index of the MaxMind legacy CSV editions, loaded once and searched in batches
+        
+        GeoIPASNum2.csv             startIpNum,endIpNum,"AS# Org"
+        GeoLiteCity-Blocks.csv      startIpNum,endIpNum,locId
+        GeoLiteCity-Location.csv    locId,country,region,city,postalCode,latitude,longitude,...
+        
+        each edition is held as start and end arrays plus a value array, lookup_batch resolves a column
+        of addresses with one binary search (numpy.searchsorted when numpy is available)
+        """
+        self.asn_names = []
+        self.locations = []
+        self.asn_start, self.asn_end, self.asn_id = self.load_ranges(asn_file, self.asn_names)
+        
+        loc_map = {}
+        try:
+            for row in csv.reader(open(location_file, 'rb')):
+                try: 
+                    loc_map[int(row[0])] = len(self.locations)
+                    self.locations.append((row[1], float(row[5]), float(row[6])))
+                except: pass
+        except IOError: pass
+        self.city_start, self.city_end, self.city_id = self.load_ranges(blocks_file, loc_map)
+        
+        
+    def load_ranges(self, cfile, values):
+        """
+        read startIpNum,endIpNum,value rows sorted by startIpNum
+        values is either a list that new names are appended to or a dict mapping the value to an index
+        """
+        start = array('L')
+        end = array('L')
+        ids = array('l')
+        names = {}
+        rows = []
+        try:
+            for row in csv.reader(open(cfile, 'rb')):
+                try: rows.append((int(row[0]), int(row[1]), row[2]))
+                except: pass
+        except IOError: pass
+        rows.sort()
+        for row in rows:
+            if isinstance(values, dict): 
+                try: idx = values[int(row[2])]
+                except: continue
+            else:
+                try: idx = names[row[2]]
+                except KeyError:
+                    idx = names[row[2]] = len(values)
+                    values.append(row[2])
+            start.append(row[0])
+            end.append(row[1])
+            ids.append(idx)
+        if numpy is not None:
+            return numpy.array(start, dtype=numpy.int64), numpy.array(end, dtype=numpy.int64), numpy.array(ids, dtype=numpy.int64)
+        return start, end, ids
+        
+        
+    def search(self, nums, start, end, ids):
+        if not len(start): return [-1] * len(nums)
+        if numpy is not None:
+            nums = numpy.array(nums, dtype=numpy.int64)
+            pos = numpy.searchsorted(start, nums, 'right') - 1
+            found = (pos >= 0) & (nums <= end[pos.clip(0)])
+            return numpy.where(found, ids[pos.clip(0)], -1).tolist()
+        out = []
+        for num in nums:
+            pos = bisect.bisect_right(start, num) - 1
+            if pos >= 0 and num <= end[pos]: out.append(ids[pos])
+            else: out.append(-1)
+        return out
+        
+        
+    def search_ranges(self, ranges, start, end, ids):
+        """
+        the set of ids of every range overlapping one of ranges, a list of (first, last) integer address pairs
+        the index ranges are sorted and disjoint, so the overlaps of one pair are a slice starting at the range holding first
+        """
+        out = set()
+        if not len(start): return out
+        firsts = [first for first, last in ranges]
+        lasts = [last for first, last in ranges]
+        if numpy is not None:
+            lo = (numpy.searchsorted(start, firsts, 'right') - 1).tolist()
+            hi = numpy.searchsorted(start, lasts, 'right').tolist()
+        else:
+            lo = [bisect.bisect_right(start, num) - 1 for num in firsts]
+            hi = [bisect.bisect_right(start, num) for num in lasts]
+        for first, pos, stop in zip(firsts, lo, hi):
+            if pos < 0 or end[pos] < first: pos += 1
+            for i in xrange(pos, stop): out.add(int(ids[i]))
+        return out
+        
+        
+    def lookup_batch(self, ips):
+        """
+        resolve a list of dotted quad addresses
+        returns a list of ASN ids into self.asn_names and a list of city ids into self.locations, -1 for no match
+        """
+        nums = []
+        for ip in ips:
+            try: nums.append(ip2int(ip))
+            except: nums.append(-1)
+        return self.search(nums, self.asn_start, self.asn_end, self.asn_id), self.search(nums, self.city_start, self.city_end, self.city_id)
+
+
+class Instruments(object):
+    def __init__(self, enabled=0):
+        """
+        Wall time, call counts and swallowed exceptions per pipeline stage
+        
+        start() returns a timestamp to pass back to stop(), when disabled both return straight away so the
+        cost is one attribute check per call
+        error() counts an exception caught by a bare except in the stage
+        """
+        self.enabled = enabled
+        self.reset()
+        
+        
+    def reset(self):
+        self.seconds = {}
+        self.calls = {}
+        self.errors = {}
+        
+        
+    def start(self):
+        if self.enabled: return time.time()
+        return 0
+        
+        
+    def stop(self, stage, t0, calls=1):
+        if not self.enabled: return
+        self.seconds[stage] = self.seconds.get(stage, 0.) + time.time() - t0
+        self.calls[stage] = self.calls.get(stage, 0) + calls
+        
+        
+    def error(self, stage):
+        if self.enabled: self.errors[stage] = self.errors.get(stage, 0) + 1
+        
+        
+    def totals(self):
+        """
+        dict of stage to seconds, calls and errors
+        """
+        out = {}
+        for stage in set(self.seconds) | set(self.errors):
+            out[stage] = {'seconds': round(self.seconds.get(stage, 0.), 4), 'calls': self.calls.get(stage, 0), 'errors': self.errors.get(stage, 0)}
+        return out
+        
+        
+    def view(self):
+        totals = self.totals()
+        print '%-14s %10s %12s %8s' % ('stage', 'seconds', 'calls', 'errors')
+        for stage in sorted(totals, key=lambda stage: -totals[stage]['seconds']):
+            print '%-14s %10.3f %12s %8d' % (stage, totals[stage]['seconds'], '{:0,d}'.format(totals[stage]['calls']), totals[stage]['errors'])
+            
+            
+#reputation_of() result for a whitelist AS#, which skips the anomaly, trust and Report work and counts as the best trust of 1
+WHITELIST = 'whitelist'
+
+#load files are 15 minute reports, the windows are counted in these intervals
+WINDOW_INTERVAL = 900
+WINDOWS = {'hour': 4, 'day': 96, 'week': 672}
+
+
+class AsnWindow(object):
+    __slots__ = ('ring',)
+    
+    def __init__(self, size):
+        """
+        Ring buffer of (interval, TotalFlowCount, BytesInVolume, PacketsInRatePerDuration) per 15 minute interval
+        with flows, at most size entries and none older than size intervals before the newest
+        """
+        self.ring = deque(maxlen=size)
+        
+        
+    def push(self, interval, flows, byts, packets, size):
+        ring = self.ring
+        if ring.maxlen != size: self.ring = ring = deque(ring, maxlen=size)
+        if ring and ring[-1][0] >= interval:
+            #same interval again, or an older one from a backfill, merge it into place
+            entries = dict((entry[0], list(entry[1:])) for entry in ring)
+            entry = entries.setdefault(interval, [0, 0, 0.])
+            entry[0] += flows
+            entry[1] += byts
+            entry[2] += packets
+            ring.clear()
+            for key in sorted(entries)[-size:]: ring.append((key,) + tuple(entries[key]))
+        else: ring.append((interval, flows, byts, packets))
+        newest = ring[-1][0]
+        while ring[0][0] <= newest - size: ring.popleft()
+        
+        
+    def totals(self, now, intervals):
+        """
+        (TotalFlowCount, BytesInVolume, PacketsInRatePerDuration) for the intervals up to and including now
+        """
+        flows = byts = 0
+        packets = 0.
+        for entry in reversed(self.ring):
+            if entry[0] <= now - intervals: break
+            if entry[0] > now: continue
+            flows += entry[1]
+            byts += entry[2]
+            packets += entry[3]
+        return flows, byts, packets
+        
+        
+    def __eq__(self, other): return isinstance(other, AsnWindow) and list(self.ring) == list(other.ring)
+    def __ne__(self, other): return not self == other
+    
+    
+    def __repr__(self):
+        if not self.ring: return 'AsnWindow()'
+        return 'AsnWindow(%d intervals, %s to %s)' % (len(self.ring), time.strftime('%Y-%m-%d %H:%M', time.localtime(self.ring[0][0] * WINDOW_INTERVAL)),
+            time.strftime('%Y-%m-%d %H:%M', time.localtime(self.ring[-1][0] * WINDOW_INTERVAL)))
+            
+            
+class RunningStats(object):
+    __slots__ = ('n', 'mean', 'm2', 's1', 's2')
+    
+    def __init__(self):
+        """
+        Single pass mean and variance (Welford), mergeable with another RunningStats
+        
+        the integer sum and sum of squares are also kept so legacy() gives the same result as the two pass
+        integer arithmetic of Inetflow.std_dev for integer values
+        """
+        self.n = 0
+        self.mean = 0.
+        self.m2 = 0.
+        self.s1 = 0
+        self.s2 = 0
+        
+        
+    def push(self, x):
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (x - self.mean)
+        self.s1 += x
+        self.s2 += x * x
+        
+        
+    def merge(self, other):
+        if not other.n: return
+        n = self.n + other.n
+        delta = other.mean - self.mean
+        self.m2 += other.m2 + delta * delta * self.n * other.n / n
+        self.mean += delta * other.n / n
+        self.n = n
+        self.s1 += other.s1
+        self.s2 += other.s2
+        
+        
+    def variance(self):
+        if not self.n: return 0.
+        return self.m2 / self.n
+        
+        
+    def std_dev(self): return math.sqrt(self.variance())
+    
+    
+    def legacy(self):
+        """
+        (standard deviation, average) as returned by Inetflow.std_dev, None if there are no values
+        """
+        if not self.n: return None
+        avg = self.s1 / self.n
+        sq_mean = self.s2 - 2 * avg * self.s1 + self.n * avg * avg
+        return math.sqrt(sq_mean / self.n), avg
+        
+        
+class PrefixSet(object):
+    def __init__(self):
+        """
+        Longest prefix match of IPv4 addresses against a set of networks and single addresses
+        
+        the networks are kept in a dict per prefix length keyed by the network bits, a match tries the
+        lengths in use from the longest down, at most 33 dict lookups and usually only a few
+        """
+        self.nets = {}
+        self.lengths = []
+        
+        
+    def add(self, prefix):
+        """
+        add 'a.b.c.d' or 'a.b.c.d/len', raises ValueError or socket.error for anything else
+        """
+        ip, slash, length = prefix.partition('/')
+        if slash: length = int(length)
+        else: length = 32
+        if not 0 <= length <= 32: raise ValueError(prefix)
+        ip = ip2int(ip)
+        if length < 32: prefix = int2ip(ip >> (32 - length) << (32 - length)) + '/' + str(length)
+        if length not in self.nets:
+            self.nets[length] = {}
+            self.lengths = sorted(self.nets, reverse=True)
+        self.nets[length][ip >> (32 - length)] = prefix
+        
+        
+    def match(self, ip):
+        """
+        the longest prefix holding the integer address ip, None if there is none
+        """
+        for length in self.lengths:
+            prefix = self.nets[length].get(ip >> (32 - length))
+            if prefix is not None: return prefix
+        return None
+        
+        
+    def ranges(self):
+        """
+        the (first, last) integer addresses of each prefix
+        """
+        return [(key << (32 - length), ((key + 1) << (32 - length)) - 1) for length in self.lengths for key in self.nets[length]]
+        
+        
+    def __len__(self): return sum([len(nets) for nets in self.nets.itervalues()])
+    
+    
+class BloomFilter(object):
+    def __init__(self, count, bits_per_key=10, hashes=7):
+        """
+        Bloom filter of integer keys sized for count keys, about 1% false positives at 10 bits and 7 hashes per key
+        the positions are h1 + i * h2 from two multiplicative hashes of the key
+        """
+        self.size = max(64, count * bits_per_key)
+        self.hashes = hashes
+        self.bits = bytearray((self.size + 7) // 8)
+        
+        
+    def positions(self, key):
+        h1 = (key * 2654435761) & 0xffffffff
+        h2 = (((key >> 16) ^ key) * 2246822519) & 0xffffffff | 1
+        return [(h1 + i * h2) % self.size for i in xrange(self.hashes)]
+        
+        
+    def add(self, key):
+        bits = self.bits
+        for pos in self.positions(key): bits[pos >> 3] |= 1 << (pos & 7)
+        
+        
+    def __contains__(self, key):
+        bits = self.bits
+        for pos in self.positions(key):
+            if not bits[pos >> 3] & (1 << (pos & 7)): return False
+        return True
+        
+        
+class FlowBaseline(object):
+    __slots__ = ('n', 'bytes_mean', 'bytes_m2', 'duration_mean', 'duration_m2', 'packets_mean', 'packets_m2')
+    
+    def __init__(self):
+        """
+        Running mean and variance (Welford) of BytesInVolume, FlowDuration and PacketsInRatePerDuration for the flows of an AS#
+        """
+        self.n = 0
+        self.bytes_mean = self.duration_mean = self.packets_mean = 0.
+        self.bytes_m2 = self.duration_m2 = self.packets_m2 = 0.
+        
+        
+    def score(self, byts, duration, packets, warmup, limit):
+        """
+        compare a flow to the baseline then add it, returns the (bytes, duration, packets) z-scores
+        if the baseline has warmup flows and any z-score is over limit, otherwise None
+        the limit is checked on the squares so the square root is only taken for an anomaly
+        """
+        n = self.n
+        res = None
+        if n >= warmup:
+            limit = limit * limit
+            db = byts - self.bytes_mean
+            dd = duration - self.duration_mean
+            dp = packets - self.packets_mean
+            if db * db * n > limit * self.bytes_m2 or dd * dd * n > limit * self.duration_m2 or dp * dp * n > limit * self.packets_m2:
+                res = (self.z(db, self.bytes_m2), self.z(dd, self.duration_m2), self.z(dp, self.packets_m2))
+        n += 1
+        self.n = n
+        delta = byts - self.bytes_mean
+        self.bytes_mean += delta / n
+        self.bytes_m2 += delta * (byts - self.bytes_mean)
+        delta = duration - self.duration_mean
+        self.duration_mean += delta / n
+        self.duration_m2 += delta * (duration - self.duration_mean)
+        delta = packets - self.packets_mean
+        self.packets_mean += delta / n
+        self.packets_m2 += delta * (packets - self.packets_mean)
+        return res
+        
+        
+    def z(self, delta, m2):
+        if not m2: return 0.
+        return round(delta / math.sqrt(m2 / self.n), 2)
+        
+        
+    def merge(self, other):
+        if not other.n: return
+        n = self.n + other.n
+        for name in ('bytes', 'duration', 'packets'):
+            mean = getattr(self, name + '_mean')
+            delta = getattr(other, name + '_mean') - mean
+            setattr(self, name + '_m2', getattr(self, name + '_m2') + getattr(other, name + '_m2') + delta * delta * self.n * other.n / n)
+            setattr(self, name + '_mean', mean + delta * other.n / n)
+        self.n = n
+        
+        
+    def unmerge(self, other):
+        """
+        take out the flows of other, a baseline that was merged into this one
+        """
+        if not other.n: return
+        n = self.n - other.n
+        if n <= 0:
+            self.__init__()
+            return
+        for name in ('bytes', 'duration', 'packets'):
+            mean = getattr(other, name + '_mean')
+            rest = (getattr(self, name + '_mean') * self.n - mean * other.n) / n
+            delta = rest - mean
+            setattr(self, name + '_m2', max(0., getattr(self, name + '_m2') - getattr(other, name + '_m2') - delta * delta * other.n * n / self.n))
+            setattr(self, name + '_mean', rest)
+        self.n = n
+        
+        
+    def __eq__(self, other): return isinstance(other, FlowBaseline) and all(getattr(self, key) == getattr(other, key) for key in self.__slots__)
+    def __ne__(self, other): return not self == other
+    
+    
+    def __repr__(self):
+        return 'FlowBaseline(%d flows, bytes %.0f +/- %.0f)' % (self.n, self.bytes_mean, self.n and math.sqrt(self.bytes_m2 / self.n))
+        
+        
+class TDigest(object):
+    def __init__(self, compression=100):
+        """
+        Mergeable quantile sketch (t-digest)
+        
+        values are buffered and merged into centroids sorted by mean, centroids near the median may hold more
+        weight than those in the tails so extreme quantiles stay accurate
+        quantile() is a binary search over the cumulative centroid weights
+        """
+        self.compression = compression
+        self.means = []
+        self.weights = []
+        self.centers = []
+        self.buffer = []
+        self.n = 0
+        
+        
+    def push(self, x, w=1):
+        self.buffer.append((x, w))
+        self.n += w
+        if len(self.buffer) >= self.compression * 5: self.compress()
+        
+        
+    def merge(self, other):
+        self.buffer.extend(zip(other.means, other.weights))
+        self.buffer.extend(other.buffer)
+        self.n += other.n
+        self.compress()
+        
+        
+    def compress(self):
+        if not self.buffer: return
+        points = sorted(zip(self.means, self.weights) + self.buffer)
+        self.buffer = []
+        total = float(self.n)
+        means = []
+        weights = []
+        before = 0.
+        mean, weight = points[0]
+        for m, w in points[1:]:
+            q = (before + weight + w / 2.) / total
+            if weight + w <= max(1., 4 * total * q * (1 - q) / self.compression):
+                weight += w
+                mean += (m - mean) * w / weight
+            else:
+                means.append(mean)
+                weights.append(weight)
+                before += weight
+                mean, weight = m, w
+        means.append(mean)
+        weights.append(weight)
+        self.means = means
+        self.weights = weights
+        
+        #cumulative weight at the center of each centroid for quantile()
+        self.centers = []
+        before = 0.
+        for w in weights:
+            self.centers.append(before + w / 2.)
+            before += w
+            
+            
+    def quantile(self, q):
+        """
+        estimated value at quantile q from 0.0 to 1.0, None if there are no values
+        """
+        self.compress()
+        if not self.means: return None
+        target = q * self.n
+        i = bisect.bisect_right(self.centers, target)
+        if i == 0: return self.means[0]
+        if i == len(self.means): return self.means[-1]
+        c0 = self.centers[i - 1]
+        c1 = self.centers[i]
+        return self.means[i - 1] + (self.means[i] - self.means[i - 1]) * (target - c0) / (c1 - c0)
+        
+        
+class TopK(object):
+    def __init__(self):
+        """
+        Running totals per key with a max heap for top k queries
+        
+        add() updates the total and pushes the new value, heap entries that no longer match the total are stale
+        and are dropped when top() reaches them, the heap is rebuilt from the totals when stale entries build up
+        """
+        self.totals = {}
+        self.heap = []
+        self.sum = 0
+        
+        
+    def add(self, key, value):
+        total = self.totals.get(key, 0) + value
+        self.totals[key] = total
+        self.sum += value
+        heapq.heappush(self.heap, (-total, key))
+        if len(self.heap) > 2 * len(self.totals) + 1024: self.rebuild()
+        
+        
+    def rebuild(self):
+        self.heap = [(-total, key) for key, total in self.totals.iteritems()]
+        heapq.heapify(self.heap)
+        
+        
+    def merge(self, other):
+        for key, value in other.totals.iteritems(): self.totals[key] = self.totals.get(key, 0) + value
+        self.sum += other.sum
+        self.rebuild()
+        
+        
+    def top(self, k, ties=0):
+        """
+        list of the k (key, total) with the largest totals, largest first and equal totals in key order
+        all the keys are returned if there are fewer than k, with ties set the keys with the same total as the k-th follow it
+        """
+        out = []
+        keep = []
+        seen = set()
+        while self.heap and (ties or len(out) < k):
+            entry = heapq.heappop(self.heap)
+            key = entry[1]
+            if key in seen or self.totals.get(key) != -entry[0]: continue
+            seen.add(key)
+            keep.append(entry)
+            if len(out) >= k and (not out or -entry[0] != out[-1][1]): break
+            out.append((key, -entry[0]))
+        for entry in keep: heapq.heappush(self.heap, entry)
+        return out
+        
+        
+class FlowStore(object):
+    def __init__(self):
+        """
+        Compact store of the Report flows for a load file
+        
+        each flow DestinationAddress, Protocol, DestinationPort, SourceAddress, SourcePort is one record held across
+        parallel arrays, about 64 bytes per flow (90 once find() has built its indexes) rather than the 850 of the
+        nested dict of dicts per flow of the old Report
+        
+        self.index maps the packed flow key to the record number while flows are being added and is dropped by compact()
+        self.by_dst maps each DestinationAddress to the array of its record numbers for lookups and by_asn does the same
+        for the source AS#, by_src, by_dport and by_proto for SourceAddress, DestinationPort and Protocol are None until
+        find() first needs one and are then kept up to date
+        the AS# of each record is an id into self.asn_names, 0 is None for flows added without one
+        
+        store[ip] gives the same nested dict view of a destination that the old Report dict held, iterating the store
+        gives the destination addresses
+        """
+        self.dst = array('I')
+        self.proto = array('B')
+        self.dport = array('H')
+        self.src = array('I')
+        self.sport = array('H')
+        self.flows = array('I')
+        self.bytes = array('d')
+        self.duration = array('d')
+        self.packets = array('d')
+        self.trust = array('d')
+        self.asn = array('I')
+        self.asn_names = [None]
+        self.asn_ids = {None: 0}
+        self.index = {}
+        self.by_dst = {}
+        self.by_src = self.by_dport = self.by_proto = None
+        self.by_asn = {}
+        self.dst_flows = TopK()
+        self.dst_bytes = TopK()
+        
+        
+    def add(self, DestinationAddress, Protocol, DestinationPort, SourceAddress, SourcePort, BytesInVolume, FlowDuration, PacketsInRatePerDuration, trust_res=None, AS_Number=None):
+        #the flow is checked before anything is changed, a value the arrays can not hold would leave them out of step
+        if not (0 <= Protocol < 256 and 0 <= DestinationPort < 65536 and 0 <= SourcePort < 65536): 
+            raise ValueError('Protocol or port out of range %r %r %r' % (Protocol, DestinationPort, SourcePort))
+        dst = ip2int(DestinationAddress)
+        src = ip2int(SourceAddress)
+        key = (dst << 72) | (Protocol << 64) | (DestinationPort << 48) | (src << 16) | SourcePort
+        if self.index is None: self.build_index()
+        self.dst_flows.add(dst, 1)
+        self.dst_bytes.add(dst, BytesInVolume)
+        try: 
+            n = self.index[key]
+            self.flows[n] += 1
+            self.bytes[n] += BytesInVolume
+            self.duration[n] += FlowDuration
+            self.packets[n] += PacketsInRatePerDuration
+        except KeyError:
+            n = self.index[key] = len(self.flows)
+            self.dst.append(dst)
+            self.proto.append(Protocol)
+            self.dport.append(DestinationPort)
+            self.src.append(src)
+            self.sport.append(SourcePort)
+            self.flows.append(1)
+            self.bytes.append(BytesInVolume)
+            self.duration.append(FlowDuration)
+            self.packets.append(PacketsInRatePerDuration)
+            if trust_res is None: self.trust.append(float('nan'))
+            else: self.trust.append(trust_res)
+            try: asn = self.asn_ids[AS_Number]
+            except KeyError:
+                asn = self.asn_ids[AS_Number] = len(self.asn_names)
+                self.asn_names.append(AS_Number)
+            self.asn.append(asn)
+            self.add_indexes(n)
+            
+            
+    def add_indexes(self, n):
+        indexes = [(self.by_dst, self.dst[n]), (self.by_asn, self.asn[n])]
+        if self.by_src is not None: indexes.extend([(self.by_src, self.src[n]), (self.by_dport, self.dport[n]), (self.by_proto, self.proto[n])])
+        for index, key in indexes:
+            try: index[key].append(n)
+            except KeyError: index[key] = array('I', [n])
+            
+            
+    def build_find_index(self):
+        """
+        build by_src, by_dport and by_proto for find()
+        """
+        self.by_src, self.by_dport, self.by_proto = {}, {}, {}
+        for index, column in ((self.by_src, self.src), (self.by_dport, self.dport), (self.by_proto, self.proto)):
+            for n in xrange(len(column)):
+                try: index[column[n]].append(n)
+                except KeyError: index[column[n]] = array('I', [n])
+            
+            
+    def build_index(self):
+        self.index = {}
+        for n in xrange(len(self.flows)):
+            key = (self.dst[n] << 72) | (self.proto[n] << 64) | (self.dport[n] << 48) | (self.src[n] << 16) | self.sport[n]
+            self.index[key] = n
+            
+            
+    def compact(self):
+        """
+        drop the flow key index once the load file is complete, it is rebuilt if more flows are added
+        """
+        self.index = None
+        
+        
+    def __getstate__(self):
+        return dict((key, getattr(self, key)) for key in ('dst', 'proto', 'dport', 'src', 'sport', 'flows', 'bytes', 'duration', 'packets', 'trust', 'asn', 'asn_names'))
+        
+        
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if 'asn' not in state:
+            self.asn = array('I', [0]) * len(self.dst)
+            self.asn_names = [None]
+        if self.trust.typecode != 'd': self.trust = array('d', self.trust)
+        self.asn_ids = dict((name, asn) for asn, name in enumerate(self.asn_names))
+        self.index = None
+        self.by_dst = {}
+        self.by_src = self.by_dport = self.by_proto = None
+        self.by_asn = {}
+        self.dst_flows = TopK()
+        self.dst_bytes = TopK()
+        for n in xrange(len(self.dst)):
+            self.add_indexes(n)
+            self.dst_flows.totals[self.dst[n]] = self.dst_flows.totals.get(self.dst[n], 0) + self.flows[n]
+            self.dst_bytes.totals[self.dst[n]] = self.dst_bytes.totals.get(self.dst[n], 0) + int(self.bytes[n])
+        self.dst_flows.sum = sum(self.dst_flows.totals.values())
+        self.dst_bytes.sum = sum(self.dst_bytes.totals.values())
+        self.dst_flows.rebuild()
+        self.dst_bytes.rebuild()
+            
+            
+    def __len__(self): return len(self.by_dst)
+    def __iter__(self): return iter(self.keys())
+    def keys(self): return [int2ip(dst) for dst in self.by_dst]
+    
+    
+    def __contains__(self, ip):
+        try: return ip2int(ip) in self.by_dst
+        except: return False
+        
+        
+    def get_trust(self, n):
+        trust = self.trust[n]
+        if trust != trust: return None
+        return trust
+        
+        
+    def records(self, ip=None):
+        """
+        generator of (DestinationAddress, Protocol, DestinationPort, SourceAddress, SourcePort, TotalFlowCount, BytesInVolume, FlowDuration, PacketsInRatePerDuration, TrustMetric)
+        for every flow or for the flows to ip
+        """
+        if ip is None: rows = xrange(len(self.flows))
+        else: 
+            try: rows = self.by_dst[ip2int(ip)]
+            except: rows = []
+        for n in rows: yield self.record(n)
+            
+            
+    def record(self, n):
+        return int2ip(self.dst[n]), self.proto[n], self.dport[n], int2ip(self.src[n]), self.sport[n], self.flows[n], int(self.bytes[n]), int(self.duration[n]), self.packets[n], self.get_trust(n)
+        
+        
+    def find(self, dst=None, src=None, dport=None, proto=None, asn=None):
+        """
+        record numbers of the flows matching every key given, addresses are dotted quads and asn is an AS# string
+        the smallest of the matching indexes is read and the records in it checked against the other keys
+        """
+        keys = []
+        if self.by_src is None and (src is not None or dport is not None or proto is not None): self.build_find_index()
+        try:
+            if dst is not None: keys.append((self.by_dst, self.dst, ip2int(dst)))
+            if src is not None: keys.append((self.by_src, self.src, ip2int(src)))
+        except: return []
+        if dport is not None: keys.append((self.by_dport, self.dport, dport))
+        if proto is not None: keys.append((self.by_proto, self.proto, proto))
+        if asn is not None: 
+            if asn not in self.asn_ids: return []
+            keys.append((self.by_asn, self.asn, self.asn_ids[asn]))
+        if not keys: return range(len(self.flows))
+        
+        found = []
+        for index, column, key in keys:
+            rows = index.get(key)
+            if rows is None: return []
+            found.append((len(rows), rows, column, key))
+        found.sort()
+        rows = found[0][1]
+        others = [(column, key) for size, rows_, column, key in found[1:]]
+        return [n for n in rows if all(column[n] == key for column, key in others)]
+        
+        
+    def asns(self):
+        """
+        the source AS# with flows in the store
+        """
+        return [self.asn_names[asn] for asn in self.by_asn if asn]
+        
+        
+    def fill_asn(self, lookup):
+        """
+        set the AS# of flows added without one to lookup(SourceAddress), used for a Report from an older db
+        """
+        rows = self.by_asn.pop(0, [])
+        for n in rows:
+            try: AS_Number = lookup(int2ip(self.src[n]))
+            except: AS_Number = None
+            try: asn = self.asn_ids[AS_Number]
+            except KeyError:
+                asn = self.asn_ids[AS_Number] = len(self.asn_names)
+                self.asn_names.append(AS_Number)
+            self.asn[n] = asn
+            try: self.by_asn[asn].append(n)
+            except KeyError: self.by_asn[asn] = array('I', [n])
+            
+            
+            
+    def __getitem__(self, ip):
+        """
+        nested dict of the flows to ip in the old Report format
+        [Protocol]['IPBytesInVolume'] and [Protocol][DestinationPort][SourceAddress]['TrustMetric'] and [SourcePort] counters
+        """
+        try: rows = self.by_dst[ip2int(ip)]
+        except: raise KeyError(ip)
+        out = {}
+        for n in rows:
+            proto = out.setdefault(self.proto[n], {})
+            src = proto.setdefault(self.dport[n], {}).setdefault(int2ip(self.src[n]), {})
+            src.setdefault('TrustMetric', self.get_trust(n))
+            src[self.sport[n]] = {'TotalFlowCount': self.flows[n], 'BytesInVolume': int(self.bytes[n]), 'FlowDuration': int(self.duration[n]), 'PacketsInRatePerDuration': self.packets[n]}
+            proto['IPBytesInVolume'] = proto.get('IPBytesInVolume', 0) + int(self.bytes[n])
+        return out
+        
+        
+    def ip_flows(self):
+        """
+        TotalFlowCount per DestinationAddress
+        """
+        return dict((int2ip(dst), total) for dst, total in self.dst_flows.totals.iteritems())
+        
+        
+    def ip_bytes(self):
+        """
+        BytesInVolume per DestinationAddress
+        """
+        return dict((int2ip(dst), total) for dst, total in self.dst_bytes.totals.iteritems())
+        
+        
+    def top_flows(self, k):
+        """
+        the k DestinationAddress with the highest TotalFlowCount as (ip, TotalFlowCount)
+        """
+        return [(int2ip(dst), total) for dst, total in self.dst_flows.top(k)]
+        
+        
+    def top_bytes(self, k):
+        """
+        the k DestinationAddress with the highest BytesInVolume as (ip, BytesInVolume)
+        """
+        return [(int2ip(dst), total) for dst, total in self.dst_bytes.top(k)]
+        
+        
+    def fill_trust(self, lookup):
+        """
+        set the TrustMetric of flows that have none to lookup(SourceAddress), a None result is left unset
+        """
+        for n in xrange(len(self.trust)):
+            if self.trust[n] == self.trust[n]: continue
+            try: trust = lookup(int2ip(self.src[n]))
+            except: trust = None
+            if trust is not None: self.trust[n] = trust
+            
+            
+    def from_tree(cls, tree):
+        """
+        build a FlowStore from an old Report dict
+        """
+        store = cls()
+        for ip in tree:
+            for Protocol in tree[ip]:
+                for DestinationPort in tree[ip][Protocol]:
+                    if DestinationPort == 'IPBytesInVolume': continue
+                    for SourceAddress, rec in tree[ip][Protocol][DestinationPort].items():
+                        for SourcePort in rec:
+                            if SourcePort == 'TrustMetric': continue
+                            flow = rec[SourcePort]
+                            try: 
+                                store.add(ip, Protocol, DestinationPort, SourceAddress, SourcePort, flow['BytesInVolume'], flow['FlowDuration'], flow['PacketsInRatePerDuration'], rec.get('TrustMetric'))
+                                n = len(store.flows) - 1
+                                store.flows[n] = flow['TotalFlowCount']
+                            except: pass
+        store.compact()
+        return store
+    from_tree = classmethod(from_tree)
+
+
+class LazyDict(dict):
+    def __init__(self, keys, fetch):
+        """
+        dict that starts with only the keys of a sqlite_file section, each value is read with fetch(key)
+        the first time it is used and is then held as a normal dict item
+        
+        iterating the keys or testing membership does not read any values, items() and values() read them all
+        pickling gives a plain dict
+        """
+        dict.__init__(self)
+        self.unloaded = set(keys)
+        self.fetch = fetch
+        
+        
+    def __missing__(self, key):
+        if key not in self.unloaded: raise KeyError(key)
+        value = self.fetch(key)
+        self.unloaded.discard(key)
+        dict.__setitem__(self, key, value)
+        return value
+        
+        
+    def load_all(self):
+        for key in list(self.unloaded): self[key]
+        
+        
+    def __setitem__(self, key, value):
+        self.unloaded.discard(key)
+        dict.__setitem__(self, key, value)
+        
+        
+    def __delitem__(self, key):
+        if key in self.unloaded: self.unloaded.discard(key)
+        else: dict.__delitem__(self, key)
+        
+        
+    def __contains__(self, key): return dict.__contains__(self, key) or key in self.unloaded
+    def has_key(self, key): return key in self
+    def __len__(self): return dict.__len__(self) + len(self.unloaded)
+    def __iter__(self): return iter(self.keys())
+    def iterkeys(self): return iter(self.keys())
+    def keys(self): return dict.keys(self) + list(self.unloaded)
+    
+    
+    def get(self, key, default=None):
+        try: return self[key]
+        except KeyError: return default
+        
+        
+    def pop(self, key, *default):
+        if key in self.unloaded: self[key]
+        return dict.pop(self, key, *default)
+        
+        
+    def items(self):
+        self.load_all()
+        return dict.items(self)
+        
+        
+    def values(self):
+        self.load_all()
+        return dict.values(self)
+        
+        
+    def iteritems(self): return iter(self.items())
+    def itervalues(self): return iter(self.values())
+    def copy(self): return dict(self.items())
+    def __eq__(self, other): return dict(self.items()) == other
+    def __ne__(self, other): return not self == other
+    def __reduce__(self): return (dict, (dict(self.items()),))
+
+
+class Inetflow(Tools):
+    def __init__(self, verbose=0, db=1, backend=None):
+        """
+        Analyse netflow data and establish baselines according to the ASN# and county of origin, duration, size of flows
+        
+        netflow reports will load from \netflow\ folder
+        
+        a load file logging list will record each file opened
+        
+        new files will be opened according to file age
+        
+        Format of netflow load file will be csv with the following fields:
+        RouterAddress,InterfaceIn,Protocol,SourceAddress,SourcePort,DestinationAddress,DestinationPort,TypeOfService,BytesInVolume,BytesInRatePerDuration,BytesInPercentOfTotalTraffic,FlowCount,FlowDuration,PacketsInVolume,PacketsInRatePerDuration,PacketsInPercentOfTotalTraffic
+        
+        NetFlow v5, v9 and IPFIX export packets are also loaded, from libpcap captures (self.PcapExt) or files of the
+        packets written back to back (self.DatagramExt), and give the same fields as the csv
+        
+        Only specified interesting fileds will be loaded:
+        Protocol
+        SourceAddress
+        SourcePort
+        DestinationAddress
+        DestinationPort
+        BytesInVolume
+        BytesInRatePerDuration
+        FlowDuration
+        PacketsInVolume
+        PacketsInRatePerDuration
+        
+             
+        format of dictionary will be based on the fact that this is an inbound flow report that is manually created so each flow will be to the same destination - i.e. 193.127.210.129
+        
+        ['destination_ip'] = {}
+        [destination_ip]['Protocol'] = {}
+        [destination_ip][Protocol]['src'] = {}
+        [destination_ip][Protocol][src] = SourceAddress + '_' + SourcePort
+        [destination_ip][Protocol][src]['DestinationPort'] = DestinationPort
+        
+        [destination_ip][Protocol][src]['TotalFlowCount'] = (1 if first entry but will increment for each flow seen for this src addrd and port to destination)
+        [destination_ip][Protocol][src]['BytesInVolume'] = BytesInVolume + will increment for future matching flows
+        [destination_ip][Protocol][src]['BytesInRatePerDuration'] = BytesInRatePerDuration + will increment for future matching flows
+        
+        Etc for remaining fields, they will increment for future matching flows
+        
+        
+        GeoIP lookups will be perfromed to provide the following fields:
+        AS Number
+        AS Org Name
+        Country Code
+        Latitude
+        Longitude
+        
+        
+        flow [src] fields will be checked for the AS# and arrays will be built for BytesinVolume, FlowDuration, TotalFlowCount & PacketsInRatePerDuration for each AS#
+        when records are parsed each flow will be first compared to the existing array data and checked for anomolys, then the data will be added.
+        
+        An AS# dict entry will be created for each AS#
+        AS = {}
+        AS[CIDR_Size] = num of possible hosts
+        AS[src_ip] = []    each src ip will be added to the dict to give a count of unique IP's seen from each AS#
+        
+        Calculate the difference between Milton Keynes Latitude 52.0175    Longitude -.7896  and the source IP in miles
+        
+        Shenley = (52.0175, -0.7896)
+        
+        GeoIP city lookup - 'latitude' and 'longitude'
+        
+        Get an everage of the source distance in miles for each netflow sample and save to the dict at the end
+        
+        [destination_ip]['Protocol']['Avg_Distance'] = Avg_Distance
+        
+        Use BytesInVolume distrubution per ASN to determine how trustworthy the AS# is
+        
+        Use distance to AS# as another measure of trust
+        
+        Country reputation can be manually fixed per country - i.e. mark down China, Russia, Nork, USA
+        
+        Use whitelists for known good AS# & black lists for known bad AS#
+        
+        Use Avg_BytesPerFlow for the highest distrubution AS# to deterine the expected rates
+        
+        
+        db=0 starts with an empty self.netflow_dict rather than opening db_file
+        
+        Tested with Python ver 2.7.2 on Win7
+        (c) 2012 - 2016 Intelligent Planet Ltd
+        
+        """
+        Tools.__init__(self)
+        self.verbose = verbose
+        self.path = 'h:\\backup\\' + 'netflow' + '\\'
+        
+        self.new_db()
+        
+        self.DistFlowCutOffFactor  = 0.0005
+        self.DistBytesCutOffFactor = 0.000005
+        
+        
+        self.field_map = {'Protocol':-1, 'SourceAddress':-1, 'SourcePort':-1, 'DestinationAddress':-1, 'DestinationPort':-1, 'BytesInVolume':-1, 'BytesInRatePerDuration':-1, 'FlowDuration':-1, 'PacketsInVolume':-1, 'PacketsInRatePerDuration':-1}
+        
+        #files queued for loading by mtime and the names already scanned in self.path, a file modified in the last
+        #FileSettle seconds may still be being written and is left for a later scan
+        self.file_heap = []
+        self.scanned = set()
+        self.FileSettle = 30
+        
+        #Set the reference point for distance calculations
+        self.home_city = (52.0175, -0.7896)
+        
+        #Use the source filter to enable mapping of outbound flows from this IP / Prefix using text matching only
+        self.SourceFilter = '193.127.210'
+        
+        #The threshold where flows above this are recorded in detail
+        self.TrustThreshold = 200
+        
+        #GeoIP enrichment cache, persisted next to db_file when GeoCachePersist is set
+        self.GeoCacheSize = 100000
+        self.GeoCachePersist = 1
+        if self.GeoCachePersist: self.geo_cache = GeoCache(self.GeoCacheSize, geo_cache_file)
+        else: self.geo_cache = GeoCache(self.GeoCacheSize)
+        self.geo_cache.open()
+        
+        #range index of the MaxMind CSV editions for batch lookups, pygeoip is used per address if the files are missing
+        self.GeoIndex = 1
+        self.geo_index = None
+        self.asn_csv = path + 'GeoIPASNum2.csv'
+        self.blocks_csv = path + 'GeoLiteCity-Blocks.csv'
+        self.location_csv = path + 'GeoLiteCity-Location.csv'
+        
+        #number of csv rows parsed before the batch is enriched and added
+        self.BatchSize = 5000
+        
+        #gzip, bz2 and xz load files are found by their magic bytes and decompressed by a reader thread
+        #DecompressBlock bytes at a time with up to DecompressQueue blocks waiting for the parser
+        self.DecompressBlock = 1048576
+        self.DecompressQueue = 8
+        
+        #ingest mode for load - 'row', 'columnar' or 'stream', ColumnChunk is the number of rows per set of column arrays
+        self.IngestMode = 'row'
+        self.ColumnChunk = 100000
+        
+        #stream mode memory budget in MB for the Report, estimated at ReportRowBytes per flow row,
+        #StreamFilter set keeps only the flows from AS# with a trust above TrustThreshold in the stream Report
+        self.StreamChunk = 20000
+        self.StreamMemory = 256
+        self.ReportRowBytes = 200
+        self.StreamFilter = 0
+        self.stream_stats = {}
+        self.spill_file = report_spill_file
+        
+        #per stage timing and swallowed exception counts, off by default - see instrument()
+        self.inst = Instruments()
+        
+        #the Inetflow of the last replay() without save
+        self.replayed = None
+        
+        #binary NetFlow v5/v9/IPFIX load files, by file extension - libpcap captures of the export packets
+        #or the export packets written back to back, other files are read as NetQoS csv
+        self.PcapExt = ('.pcap', '.cap')
+        self.DatagramExt = ('.nfd', '.nf')
+        self.nf_decoder = NetflowDecoder()
+        self.row_map = self.field_map
+        
+        #live UDP collector - see collect(), packets wait in a queue of CollectorQueue and are dropped when it is full,
+        #each tick decodes up to CollectorBatch flows, the trust metrics are refreshed every CollectorMetric seconds,
+        #the db saved every CollectorCheckpoint seconds and the flows are kept as a load file per CollectorBucket seconds
+        self.CollectorHost = '127.0.0.1'
+        self.CollectorPort = 2055
+        self.CollectorQueue = 10000
+        self.CollectorBatch = 5000
+        self.CollectorTick = 0.5
+        self.CollectorMetric = 60
+        self.CollectorCheckpoint = 300
+        self.CollectorBucket = 900
+        self.CollectorRecvBuffer = 4194304
+        self.collector_queue = deque()
+        self.collector_stats = {}
+        self.collector_file = None
+        
+        #save the typed columns and GeoIP results of each load file to column_dir for replay()
+        self.ColumnCache = 0
+        self.column_writer = None
+        
+        #each flow is scored against the running mean and variance of BytesInVolume, FlowDuration and PacketsInRatePerDuration
+        #for its AS# before it is added, once the AS# has AnomalyWarmup flows a z-score over AnomalyZ is an anomaly event,
+        #the newest AnomalyQueue events are kept in self.anomalies and appended to anomaly_file if AnomalyLog is set
+        self.AnomalyScore = 1
+        self.AnomalyZ = 4.
+        self.AnomalyWarmup = 30
+        self.AnomalyQueue = 10000
+        self.AnomalyLog = 0
+        self.anomalies = deque(maxlen=self.AnomalyQueue)
+        self.anomaly_count = 0
+        self.anomaly_log = None
+        
+        #the Baseline per AS# of the db a backfill worker scores against, the worker starts each AS# from a copy of it
+        self.baseline_seed = {}
+        
+        #prefixes from load_blackhole(), flows with a source or destination in them are counted per prefix in blackhole_hits
+        #and the newest BlackholeQueue of them kept in self.blackhole_flows
+        self.blackhole = None
+        self.BlackholeQueue = 10000
+        self.blackhole_hits = {}
+        self.blackhole_flows = deque(maxlen=self.BlackholeQueue)
+        
+        #reputation tables from load_reputation(), reloaded when the files change - flows from whitelist AS# skip the
+        #anomaly, trust and Report work, blacklist AS# and countries in country_file are given ReputationTrust
+        #or the trust on their line, reputation_cache holds the result per AS# until the next reload
+        self.ReputationTrust = 1000
+        self.whitelist = set()
+        self.blacklist = set()
+        self.country_trust = {}
+        self.reputation_cache = {}
+        self.reputation_mtime = None
+        
+        #keep the Report of each load file in archive_dir as a zlib compressed partition, archive_query() reads only the
+        #partitions in its time range whose address range, bloom filter and AS# set can hold a match,
+        #replays of the column cache are not archived again
+        self.Archive = 0
+        self.ArchiveLevel = 6
+        self.archive_index = None
+        self.archive_stats = {}
+        
+        #rolling per AS# totals by 15 minute interval kept for WindowRetention intervals (see WINDOWS for hour, day, week),
+        #load_file_history entries older than HistoryRetention days are dropped, 0 keeps them all
+        self.WindowRetention = WINDOWS['week']
+        self.HistoryRetention = 0
+        self.window_delta = {}
+        self.window_inputs_cache = {}
+        
+        #save_db after each load file, replay() turns this off unless asked to save
+        self.AutoSave = 1
+        
+        #with AutoSave, save a checkpoint of the aggregates and the read position every CheckpointRows rows of a load file,
+        #load() resumes a file left in netflow_dict['Checkpoint'] from its last checkpoint, 0 turns checkpoints off
+        self.CheckpointRows = 0
+        self.read_state = {'rows': 0, 'offset': None}
+        self.read_resume = None
+        self.checkpoint_rows = 0
+        self.loading_file = None
+        
+        #db_file backend - 'pickle' rewrites the whole dict, 'sqlite' writes the records changed since the last save
+        #without a backend argument it is 'sqlite' when sqlite_file is newer than db_file
+        if backend is None:
+            backend = 'pickle'
+            try: 
+                if not os.path.exists(db_file) or os.stat(sqlite_file).st_mtime >= os.stat(db_file).st_mtime: backend = 'sqlite'
+            except OSError: pass
+        self.DbBackend = backend
+        self.db_conn = None
+        
+        #with the sqlite backend only the key index is read at startup and each record is read when it is first used
+        self.DbLazy = 1
+        
+        if db: self.open_db()
+        
+        
+    def new_db(self):
+        """
+        help: start a new empty self.netflow_dict
+        usage: netflow.new_db()
+        """
+        self.netflow_dict = {}
+        self.netflow_dict['load_file_history'] = {}
+        
+        
+        self.netflow_dict['ASN_Stats'] = {}
+        self.netflow_dict['ASN_Stats']['Total_TotalFlowCount'] = 0
+        self.netflow_dict['ASN_Stats']['Total_BytesInVolume'] = 0
+        self.netflow_dict['ASN_Stats']['Avg_BytesPerFlow'] = 0
+        self.netflow_dict['ASN_Stats']['Dist_TotalFlowCount'] = []
+        self.netflow_dict['ASN_Stats']['Dist_BytesInVolume'] = []
+        self.netflow_dict['ASN_Stats']['Dist_FlowCutOff'] = 0.
+        self.netflow_dict['ASN_Stats']['Dist_BytesCutOff'] = 0.
+        
+        #AS# and load_file_history keys changed since the last save, dirty_all forces a full write
+        self.dirty = set()
+        self.dirty_files = set()
+        self.dirty_all = 1
+        
+        #AS# changed since the last get_asn_dist, dist_full forces the distribution lists to be rebuilt
+        self.dist_changed = set()
+        self.dist_full = 1
+        
+        #AS# changed since the last asn_metric, metric_full forces every AS# to be recomputed
+        self.metric_changed = set()
+        self.metric_full = 1
+        self.metric_inputs = None
+        
+        
+
+        
+    def scan_files(self):
+        """
+        list self.path once and push each file that has not been seen or loaded before onto self.file_heap,
+        ordered by mtime with a single stat per new file
+        a file modified in the last FileSettle seconds is not marked as seen so it is stat'ed again on the next scan
+        """
+        keys = self.netflow_dict['load_file_history']
+        #files from before HistoryRetention are not loaded again once their history has been dropped
+        now = time.time()
+        horizon = 0
+        if self.HistoryRetention: horizon = now - self.HistoryRetention * 86400
+        for cfile in os.listdir(self.path):
+            if cfile in self.scanned: continue
+            if cfile in keys: 
+                self.scanned.add(cfile)
+                continue
+            try: age = os.stat(self.path + cfile).st_mtime
+            except OSError: continue
+            if now - age < self.FileSettle: continue
+            self.scanned.add(cfile)
+            if age < horizon: continue
+            heapq.heappush(self.file_heap, (age, cfile))
+            
+            
+    def get_next_file(self):
+        """
+        Get the oldest file that has not loaded before.
+        the directory is only scanned again once the queued files have been used
+        raises IndexError when there is no new file
+        """
+        if not self.file_heap: self.scan_files()
+        age, out = heapq.heappop(self.file_heap)
+        
+        #out is the oldest cfile not previously loaded so add it to the load history
+        self.netflow_dict['load_file_history'][out] = {}
+        #save the age now as we have the value
+        self.netflow_dict['load_file_history'][out]['age'] = age
+        return out
+        
+        
+    def load(self):
+        """
+        help: load each new file in self.path oldest first then refresh the ASN trust metrics
+        usage: netflow.load()
+        returns the number of files loaded
+        """
+        loaded = 0
+        #a file stopped by an error in this session has the rows after its checkpoint in memory, start from the saved db
+        if self.loading_file in self.netflow_dict.get('Checkpoint', {}): self.open_db()
+        self.loading_file = None
+        
+        #files interrupted after a checkpoint carry on from it, a file that can no longer be read keeps the
+        #totals up to its checkpoint and is marked partial in its history
+        for cfile, resume in sorted(self.netflow_dict.get('Checkpoint', {}).items()):
+            try: self.load_one(cfile, resume)
+            except IOError:
+                print '##### cannot resume ', self.path + cfile
+                self.read_resume = None
+                del self.netflow_dict['Checkpoint'][cfile]
+                self.netflow_dict['load_file_history'][cfile]['status'] = 'partial'
+                self.dirty.add('Checkpoint')
+                self.dirty_files.add(cfile)
+                if self.AutoSave: self.save_db()
+                continue
+            loaded += 1
+        while 1:
+            try: cfile = self.get_next_file()
+            except IndexError: break
+            self.load_one(cfile)
+            loaded += 1
+            
+        #no new file to parse, refresh the ASN trust metrics
+        ignore = self.asn_metric()
+        print 'All file stats'
+        self.view_stats()
+        return loaded
+        
+        
+    def follow(self, interval=60):
+        """
+        help: keep loading new files as they land in self.path, polling every interval seconds
+        files already seen are not stat'ed again, a file is loaded once it has not changed for FileSettle seconds, stop with ctrl-c
+        usage: netflow.follow()    or netflow.follow(300)
+        """
+        try:
+            while 1:
+                self.scan_files()
+                if self.file_heap: self.load()
+                time.sleep(interval)
+        except KeyboardInterrupt: pass
+        
+        
+    def load_one(self, cfile, resume=None):
+        """
+        load a single netflow file from self.path, update the distribution stats and save the db
+        resume is the netflow_dict['Checkpoint'] entry of a file to carry on from its last checkpoint
+        """
+        self.load_file = self.path + cfile
+        if resume is None: print '##### loading ', self.load_file
+        else: print '##### resuming ', self.load_file, 'from row', resume['rows']
+        
+        self.load_reputation()
+        t0 = self.inst.start()
+        self.loading_file = cfile
+        self.read_resume = resume
+        if resume is None: 
+            self.init_file(cfile)
+            self.checkpoint_rows = 0
+        else:
+            self.get_online()
+            self.window_delta = dict(resume['window_delta'])
+            self.checkpoint_rows = resume['rows']
+            self.restore_events(resume.get('events'))
+        
+        #field_map of the rows from read_rows
+        if self.netflow_kind(cfile): self.row_map = FLOW_FIELDS
+        else: self.row_map = self.field_map
+        
+        #the column cache needs the whole file so it is not written for a resumed file
+        self.column_writer = None
+        if self.ColumnCache and self.IngestMode != 'replay' and resume is None: self.column_writer = ColumnWriter(self.row_map)
+        
+        if self.IngestMode == 'replay': self.load_cached(cfile)
+        elif self.IngestMode == 'columnar': self.load_columnar(cfile)
+        elif self.IngestMode == 'stream': self.load_stream(cfile)
+        else: self.load_rows(cfile)
+        
+        if self.column_writer: self.save_columns(cfile)
+        self.read_resume = None
+        self.inst.stop('ingest', t0)
+        
+        #end of file
+        self.finish_file(cfile)
+        self.loading_file = None
+        
+        
+    def finish_file(self, cfile):
+        """
+        end of a load file - update the file and distribution stats, show the reports and save the db if self.AutoSave
+        """
+        self.window_push(cfile)
+        if self.anomaly_log is not None: self.anomaly_log.flush()
+        #a checkpoint save clears dirty_files, the history record is written again with its final totals
+        self.dirty_files.add(cfile)
+        if cfile in self.netflow_dict.get('Checkpoint', {}):
+            del self.netflow_dict['Checkpoint'][cfile]
+            self.netflow_dict['load_file_history'][cfile].pop('status', None)
+            self.dirty.add('Checkpoint')
+        try: 
+            self.netflow_dict['ASN_Stats']['Avg_BytesPerFlow'] = self.netflow_dict['ASN_Stats']['Total_BytesInVolume'] / self.netflow_dict['ASN_Stats']['Total_TotalFlowCount']
+            
+            
+            self.netflow_dict['load_file_history'][cfile]['Avg_BytesPerFlow'] = self.netflow_dict['load_file_history'][cfile]['Total_BytesInVolume'] / self.netflow_dict['load_file_history'][cfile]['Total_TotalFlowCount']
+            
+        except: self.inst.error('file_stats')
+        self.file_done(cfile)
+        
+        #get the distribution stats
+        t0 = self.inst.start()
+        self.get_asn_dist()
+        
+        #get the standard deviation and avg for the loaded files
+        res = self.flow_dist()
+        self.netflow_dict['load_file_history']['StdDevBytesPerFlow'] = res[0][0]
+        self.netflow_dict['load_file_history']['StdDevBytesPerFlowAvg'] = res[0][1]
+        self.inst.stop('dist', t0)
+        
+        #display the Asn Load Stats
+        self.cfile = cfile
+        self.asn_stats()
+        
+        #display result above self.TrustThreshold
+        t0 = self.inst.start()
+        self.report_trust('v')
+        self.inst.stop('report_trust', t0)
+        
+        #display the IP address with the highest number of flows
+        t0 = self.inst.start()
+        self.view_flows()
+        
+        #display the IP address with the highest number of Bytes
+        self.view_bytes()
+        self.inst.stop('views', t0)
+
+
+        #self.view_db()
+        self.netflow_dict['Report'].compact()
+        if self.Archive and self.IngestMode != 'replay': 
+            t0 = self.inst.start()
+            try: self.archive_add(self.archive_report(cfile, [self.netflow_dict['Report']] + list(self.iter_spill())))
+            except: self.inst.error('archive')
+            self.inst.stop('archive', t0)
+        if self.AutoSave: self.save_db()
+        
+        
+    def checkpoint_due(self, cfile):
+        """
+        save a checkpoint once CheckpointRows rows have been read since the last one
+        """
+        if not self.CheckpointRows or not self.AutoSave: return
+        if self.read_state['rows'] - self.checkpoint_rows < self.CheckpointRows: return
+        self.checkpoint(cfile)
+        
+        
+    def checkpoint(self, cfile):
+        """
+        mark cfile as loading in its history and save the db with the rows read so far, the byte offset of the next row,
+        the window totals not yet pushed, the size of the stream spill file and the anomaly and blackhole events
+        in netflow_dict['Checkpoint'][cfile]
+        """
+        t0 = self.inst.start()
+        spill = 0
+        if self.IngestMode == 'stream':
+            try: spill = os.path.getsize(self.spill_file)
+            except OSError: pass
+        log = None
+        if self.anomaly_log is not None:
+            self.anomaly_log.flush()
+            log = self.anomaly_log.tell()
+        events = {'anomaly_count': self.anomaly_count, 'anomalies': list(self.anomalies), 'anomaly_log': log,
+            'blackhole_hits': dict(self.blackhole_hits), 'blackhole_flows': list(self.blackhole_flows)}
+        if 'Checkpoint' not in self.netflow_dict: self.netflow_dict['Checkpoint'] = {}
+        self.netflow_dict['Checkpoint'][cfile] = {'rows': self.read_state['rows'], 'offset': self.read_state['offset'], 
+            'window_delta': dict((key, list(value)) for key, value in self.window_delta.iteritems()), 'spill': spill, 'events': events}
+        self.netflow_dict['load_file_history'][cfile]['status'] = 'loading'
+        self.dirty.add('Checkpoint')
+        self.dirty_files.add(cfile)
+        self.checkpoint_rows = self.read_state['rows']
+        self.save_db()
+        self.inst.stop('checkpoint', t0)
+        
+        
+    def restore_events(self, events):
+        """
+        put the anomaly and blackhole events back as they were at a checkpoint so the rows read again after it
+        do not repeat them, anomaly_file is cut back to its size at the checkpoint
+        """
+        if not events: return
+        self.anomaly_count = events['anomaly_count']
+        self.anomalies = deque(events['anomalies'], maxlen=self.AnomalyQueue)
+        self.blackhole_hits = dict(events['blackhole_hits'])
+        self.blackhole_flows = deque(events['blackhole_flows'], maxlen=self.BlackholeQueue)
+        if events['anomaly_log'] is None: return
+        if self.anomaly_log is not None: 
+            self.anomaly_log.close()
+            self.anomaly_log = None
+        try:
+            log = open(anomaly_file, 'r+b')
+            log.truncate(events['anomaly_log'])
+            log.close()
+        except IOError: pass
+        
+        
+    def init_file(self, cfile):
+        """
+        initialise stats for the current load_file and start a new Report
+        """
+        self.get_online()
+        self.window_delta = {}
+        self.dirty_files.add(cfile)
+        self.netflow_dict['load_file_history'][cfile]['Total_TotalFlowCount'] = 0
+        self.netflow_dict['load_file_history'][cfile]['Total_BytesInVolume'] = 0
+        self.netflow_dict['load_file_history'][cfile]['Avg_BytesPerFlow'] = 0
+        self.netflow_dict['load_file_history'][cfile]['Avg_AsnMetric'] = 0
+        
+        #create a store for recording the flows above self.TrustThreshold, the sections of the last file are dropped
+        self.netflow_dict['Report'] = FlowStore()
+        self.clear_spill()
+        
+        
+    def load_rows(self, cfile):
+        """
+        row by row ingest of self.load_file
+        """
+        batch = []
+        raws = []
+        t0 = self.inst.start()
+        for raw in self.read_rows():
+            try: batch.append(parse_flow(raw, self.row_map, self.SourceFilter))
+            except: self.inst.error('parse')
+            if self.column_writer: raws.append(raw)
+            
+            #GeoIP enrichment and the dict updates are done a batch of rows at a time
+            if len(batch) >= self.BatchSize:
+                self.inst.stop('parse', t0, len(batch))
+                self.add_batch(cfile, batch)
+                batch = []
+                if raws: self.column_writer.append(raws)
+                raws = []
+                self.checkpoint_due(cfile)
+                t0 = self.inst.start()
+                
+        self.inst.stop('parse', t0, len(batch))
+        if batch: self.add_batch(cfile, batch)
+        if raws: self.column_writer.append(raws)
+        
+        
+    def load_columnar(self, cfile):
+        """
+        columnar ingest of self.load_file
+        rows are converted ColumnChunk at a time into typed column arrays and the AS# counters are updated
+        with one grouped reduction per AS# rather than a dict update per row
+        """
+        for rows in chunk_rows(self.read_rows(), self.ColumnChunk):
+            t0 = self.inst.start()
+            cols = to_columns(rows, self.row_map, self.SourceFilter)
+            self.inst.stop('parse', t0, len(rows))
+            if self.column_writer: self.column_writer.append(rows)
+            self.add_columns(cfile, cols)
+            self.checkpoint_due(cfile)
+        
+        
+    def load_stream(self, cfile):
+        """
+        bounded memory ingest of self.load_file
+        
+        the file passes through a generator pipeline of read_rows, chunk_rows and to_columns so only StreamChunk
+        rows are held at once, each chunk is aggregated with add_columns and released before the next is read
+        
+        when the Report rows reach the StreamMemory budget the Report is flushed to report_spill_file and restarted,
+        with StreamFilter set only flows from AS# with a trust above self.TrustThreshold (or not yet scored) are kept
+        """
+        self.stream_stats = {'rows': 0, 'report_rows': 0, 'flushes': 0, 'peak_mb': 0}
+        resume = self.read_resume
+        if resume is not None:
+            #drop the Report sections flushed after the checkpoint
+            try:
+                spill = open(self.spill_file, 'r+b')
+                spill.truncate(resume.get('spill', 0))
+                spill.close()
+            except IOError: pass
+        
+        budget = self.StreamMemory * 1048576 / self.ReportRowBytes
+        threshold = self.TrustThreshold if self.StreamFilter else None
+        chunks = chunk_rows(self.read_rows(), self.StreamChunk)
+        for rows in chunks:
+            t0 = self.inst.start()
+            cols = to_columns(rows, self.row_map, self.SourceFilter)
+            self.inst.stop('parse', t0, len(rows))
+            if self.column_writer: self.column_writer.append(rows)
+            self.stream_stats['rows'] += len(cols['SourceAddress'])
+            self.stream_stats['report_rows'] += self.add_columns(cfile, cols, threshold)
+            if self.stream_stats['report_rows'] >= budget: self.flush_report()
+            self.checkpoint_due(cfile)
+        
+        self.stream_stats['peak_mb'] = peak_rss()
+        print 'streamed %d rows, Report flushed %d times, peak memory %d MB' % (self.stream_stats['rows'], self.stream_stats['flushes'], self.stream_stats['peak_mb'])
+        
+        
+    def netflow_kind(self, cfile):
+        """
+        'pcap' or 'datagram' for a binary NetFlow load file, None for a NetQoS csv file
+        a .gz, .bz2 or .xz extension is passed over
+        """
+        name, ext = os.path.splitext(cfile)
+        if ext.lower() in ('.gz', '.bz2', '.xz'): ext = os.path.splitext(name)[1]
+        ext = ext.lower()
+        if ext in self.PcapExt: return 'pcap'
+        if ext in self.DatagramExt: return 'datagram'
+        return None
+        
+        
+    def read_rows(self):
+        """
+        generator of the rows of self.load_file, split csv rows for a NetQoS file or raw flow tuples for a NetFlow file
+        either way the fields are found with self.row_map
+        with CheckpointRows set or when resuming, the rows read are counted in self.read_state with the byte offset
+        for a plain csv file, a resumed file starts at the checkpoint offset or skips the rows already read
+        """
+        resume = self.read_resume
+        track = self.CheckpointRows or resume
+        state = self.read_state = {'rows': 0, 'offset': None}
+        kind = self.netflow_kind(self.load_file)
+        file = None
+        if kind: rows = self.iter_netflow(self.load_file, kind)
+        else:
+            codec = compressed_kind(self.load_file)
+            if codec: 
+                file = DecompressReader(self.load_file, codec, self.DecompressBlock, self.DecompressQueue)
+                rows = iter_rows(file, self.field_map)
+            elif track:
+                file = open(self.load_file, 'rb')
+                rows = iter_rows_offset(file, self.field_map, state, resume and resume['offset'])
+            else: 
+                file = open(self.load_file, 'rU')
+                rows = iter_rows(file, self.field_map)
+        try:
+            if not track:
+                for raw in rows: yield raw
+                return
+            if resume:
+                state['rows'] = resume['rows']
+                if resume['offset'] is None: rows = itertools.islice(rows, resume['rows'], None)
+            for raw in rows:
+                state['rows'] += 1
+                yield raw
+        finally: 
+            if file is not None: file.close()
+        
+        
+    def iter_netflow(self, fname, kind):
+        """
+        generator of raw flow tuples from a NetFlow v5/v9/IPFIX file, the file is memory mapped and decoded in place
+        a compressed file is decompressed into memory first
+        """
+        codec = compressed_kind(fname)
+        if codec:
+            reader = DecompressReader(fname, codec, self.DecompressBlock, self.DecompressQueue)
+            try: buf = reader.read()
+            finally: reader.close()
+            file = None
+        else:
+            file = open(fname, 'rb')
+            if not os.fstat(file.fileno()).st_size:
+                file.close()
+                return
+            buf = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        decoder = self.nf_decoder
+        try:
+            if kind == 'pcap':
+                for exporter, offset, length in iter_pcap(buf):
+                    try: flows = decoder.decode(buf, offset, length, exporter)[0]
+                    except: 
+                        self.inst.error('netflow')
+                        continue
+                    for flow in flows: yield flow
+            else:
+                pos = 0
+                while pos < len(buf):
+                    try: flows, pos = decoder.decode(buf, pos)
+                    except: 
+                        #the packet boundaries are lost, the rest of the file can not be read
+                        self.inst.error('netflow')
+                        break
+                    for flow in flows: yield flow
+        finally:
+            if file is not None:
+                buf.close()
+                file.close()
+            
+            
+    def view_netflow(self):
+        """
+        help: view the NetFlow decoder counters and the cached v9/IPFIX templates
+        usage: netflow.view_netflow()
+        """
+        pprint.pprint(self.nf_decoder.stats)
+        print 'templates cached:', len([key for key in self.nf_decoder.templates if self.nf_decoder.templates[key]])
+        
+        
+    def ingest_rows(self, cfile, rows):
+        """
+        add a list of rows found with self.row_map, by row or as columns according to self.IngestMode
+        """
+        if self.IngestMode == 'row':
+            batch = []
+            for raw in rows:
+                try: batch.append(parse_flow(raw, self.row_map, self.SourceFilter))
+                except: self.inst.error('parse')
+            self.add_batch(cfile, batch)
+        else: self.add_columns(cfile, to_columns(rows, self.row_map, self.SourceFilter))
+        
+        
+    def collect(self, seconds=None):
+        """
+        help: listen for NetFlow v5/v9/IPFIX export packets on CollectorHost:CollectorPort and aggregate them as they arrive
+        runs until interrupted or for seconds, the flows of each CollectorBucket period are recorded as a load file
+        named collector_YYYYmmdd_HHMM, the db is saved every CollectorCheckpoint seconds and when the collector stops,
+        the open bucket is finished when the collector stops and a bucket left open by a collector that did not stop
+        cleanly is finished when the next one starts
+        usage: netflow.collect()    or netflow.collect(600)
+        test with replay_sender('capture.pcap') from another process
+        returns the collector counters
+        """
+        self.collector_queue = deque()
+        self.collector_stats = {'received': 0, 'dropped': 0, 'flows': 0, 'errors': 0, 'checkpoints': 0, 'queue_peak': 0}
+        self.collector_file = None
+        self.collector_metric = self.collector_checkpoint_time = time.time()
+        row_map = self.row_map
+        self.row_map = FLOW_FIELDS
+        autosave = self.AutoSave
+        self.AutoSave = 0
+        for cfile, history in sorted(self.netflow_dict['load_file_history'].items()):
+            if isinstance(history, dict) and history.get('status') == 'collecting': 
+                self.collector_file = cfile
+                self.collector_finish()
+        print 'collecting on %s:%d' % (self.CollectorHost, self.CollectorPort)
+        try:
+            if asyncio is not None: self.collect_asyncio(seconds)
+            else: self.collect_select(seconds)
+        except KeyboardInterrupt: pass
+        finally:
+            while self.collector_queue: self.collector_tick()
+            if self.collector_file is not None: self.collector_finish()
+            self.row_map = row_map
+            self.AutoSave = autosave
+            self.collector_checkpoint()
+        return self.collector_stats
+        
+        
+    def collect_asyncio(self, seconds):
+        loop = asyncio.get_event_loop()
+        listen = loop.create_datagram_endpoint(lambda: CollectorProtocol(self), local_addr=(self.CollectorHost, self.CollectorPort))
+        transport, protocol = loop.run_until_complete(listen)
+        try: transport.get_extra_info('socket').setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.CollectorRecvBuffer)
+        except: pass
+        
+        def tick():
+            try: self.collector_tick()
+            except: self.collector_stats['errors'] += 1
+            #go straight round again while packets are waiting, reading the socket in between
+            if self.collector_queue: loop.call_soon(tick)
+            else: loop.call_later(self.CollectorTick, tick)
+            
+        loop.call_soon(tick)
+        if seconds: loop.call_later(seconds, loop.stop)
+        try: loop.run_forever()
+        finally: transport.close()
+        
+        
+    def collect_select(self, seconds):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try: sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.CollectorRecvBuffer)
+        except: pass
+        sock.bind((self.CollectorHost, self.CollectorPort))
+        sock.setblocking(0)
+        end = None
+        if seconds: end = time.time() + seconds
+        next_tick = time.time()
+        try:
+            while end is None or time.time() < end:
+                if self.collector_queue: timeout = 0
+                else: timeout = max(0, min(next_tick, end or next_tick) - time.time())
+                if select.select([sock], [], [], timeout)[0]:
+                    for n in xrange(self.CollectorQueue):
+                        try: data, addr = sock.recvfrom(65535)
+                        except socket.error: break
+                        self.collector_receive(data, addr)
+                if self.collector_queue or time.time() >= next_tick:
+                    self.collector_tick()
+                    next_tick = time.time() + self.CollectorTick
+        finally: sock.close()
+        
+        
+    def collector_receive(self, data, addr):
+        """
+        queue a received export packet, it is dropped and counted if the queue is full
+        """
+        if len(self.collector_queue) >= self.CollectorQueue:
+            self.collector_stats['dropped'] += 1
+            return
+        self.collector_queue.append((exporter_key(addr), data))
+        self.collector_stats['received'] += 1
+        if len(self.collector_queue) > self.collector_stats['queue_peak']: self.collector_stats['queue_peak'] = len(self.collector_queue)
+        
+        
+    def collector_tick(self):
+        """
+        decode and aggregate up to CollectorBatch flows from the queue, start a new bucket, refresh the trust
+        metrics and save a checkpoint when they are due
+        """
+        now = time.time()
+        start = now - now % self.CollectorBucket
+        if self.collector_file is None or start != self.collector_start: self.collector_roll(start)
+        
+        flows = []
+        decoder = self.nf_decoder
+        while self.collector_queue and len(flows) < self.CollectorBatch:
+            exporter, data = self.collector_queue.popleft()
+            try: flows.extend(decoder.decode(data, 0, len(data), exporter)[0])
+            except: self.collector_stats['errors'] += 1
+        if flows:
+            self.ingest_rows(self.collector_file, flows)
+            self.collector_stats['flows'] += len(flows)
+            
+        if now - self.collector_metric >= self.CollectorMetric:
+            self.load_reputation()
+            self.get_asn_dist()
+            ignore = self.asn_metric()
+            self.collector_metric = now
+        if now - self.collector_checkpoint_time >= self.CollectorCheckpoint: self.collector_checkpoint()
+        
+        
+    def collector_roll(self, start):
+        """
+        finish the current collector bucket as a load file and start the bucket for the period from start
+        a finished bucket is not reopened, the flows after a restart in the same period go to collector_YYYYmmdd_HHMM_2
+        """
+        if self.collector_file is not None: 
+            self.collector_finish()
+            self.collector_checkpoint()
+        cfile = name = 'collector_' + time.strftime('%Y%m%d_%H%M', time.localtime(start))
+        history = self.netflow_dict['load_file_history']
+        n = 1
+        while name in history:
+            n += 1
+            name = '%s_%d' % (cfile, n)
+        history[name] = {'age': start, 'status': 'collecting'}
+        self.init_file(name)
+        self.collector_file = name
+        self.collector_start = start
+        
+        
+    def collector_finish(self):
+        """
+        finish the current collector bucket as a load file
+        """
+        self.finish_file(self.collector_file)
+        self.netflow_dict['load_file_history'][self.collector_file].pop('status', None)
+        self.dirty_files.add(self.collector_file)
+        self.collector_file = None
+        
+        
+    def collector_checkpoint(self):
+        """
+        refresh the trust metrics and windows and save the db
+        """
+        if self.collector_file is not None: self.window_push(self.collector_file)
+        ignore = self.asn_metric()
+        self.save_db()
+        self.collector_checkpoint_time = time.time()
+        self.collector_stats['checkpoints'] += 1
+        print time.strftime('%H:%M:%S'), 'checkpoint', ' '.join(['%s %d' % item for item in sorted(self.collector_stats.items())])
+        
+        
+    def view_collector(self):
+        """
+        help: view the collector counters
+        usage: netflow.view_collector()
+        """
+        pprint.pprint(self.collector_stats)
+        print 'queued:', len(self.collector_queue)
+        
+        
+    def column_file(self, cfile):
+        return column_dir + cfile + '.nfc'
+        
+        
+    def save_columns(self, cfile):
+        """
+        write the columns collected for cfile with the GeoIP cache records of its addresses to column_dir
+        addresses not yet in the cache are resolved first so replay with another SourceFilter needs no lookups
+        """
+        t0 = self.inst.start()
+        if not os.path.exists(column_dir): os.makedirs(column_dir)
+        ips = [int2ip(num) for num in self.column_writer.addresses()]
+        self.geo_prime(ips)
+        geo = []
+        for ip in ips:
+            try: geo.append((ip, self.geo_cache.cache[ip]))
+            except KeyError: pass
+        self.column_writer.write(self.column_file(cfile), self.netflow_dict['load_file_history'][cfile]['age'], geo)
+        self.column_writer = None
+        self.inst.stop('columns', t0)
+        
+        
+    def load_cached(self, cfile):
+        """
+        replay ingest of cfile from its column cache file, ColumnChunk rows at a time through add_columns
+        the cached GeoIP records are added to the GeoIP cache so there are no GeoIP lookups
+        """
+        cols_file = ColumnFile(self.column_file(cfile))
+        for ip, rec in cols_file.geo:
+            if ip not in self.geo_cache.cache: self.geo_cache.put(ip, rec)
+        names = {}
+        for start in xrange(0, cols_file.rows, self.ColumnChunk):
+            t0 = self.inst.start()
+            cols = cols_file.to_columns(start, start + self.ColumnChunk, self.SourceFilter, names)
+            self.inst.stop('parse', t0, len(cols['SourceAddress']))
+            self.add_columns(cfile, cols)
+        cols_file.close()
+        
+        
+    def cached_files(self):
+        """
+        list of (age, cfile) for each load file in column_dir, oldest first
+        """
+        out = []
+        try: names = os.listdir(column_dir)
+        except OSError: return out
+        for name in names:
+            if not name.endswith('.nfc'): continue
+            try: 
+                cols_file = ColumnFile(column_dir + name)
+                out.append((cols_file.age, name[:-4]))
+                cols_file.close()
+            except: pass
+        out.sort()
+        return out
+        
+        
+    def replay(self, files=None, save=0):
+        """
+        help: rebuild netflow_dict from the column cache with the current settings, no csv parsing or GeoIP lookups
+        use it to see the effect of a new SourceFilter, TrustThreshold or cut off factor on the stored load files
+        files is an optional list of cfile names, with save set netflow_dict is replaced and the db saved,
+        otherwise the replay runs in a separate Inetflow kept in self.replayed and netflow_dict is not touched
+        usage: netflow.replay()    or netflow.replay(save=1)
+        returns the number of files replayed
+        """
+        if save: return self.replay_files(files, save)
+        self.replayed = self.spawn()
+        return self.replayed.replay_files(files)
+        
+        
+    def replay_files(self, files=None, save=0):
+        """
+        replace netflow_dict with the replay of the cached files
+        """
+        cached = self.cached_files()
+        if files is not None: cached = [item for item in cached if item[1] in files]
+        self.new_db()
+        mode, autosave = self.IngestMode, self.AutoSave
+        self.IngestMode = 'replay'
+        self.AutoSave = save
+        try:
+            for age, cfile in cached:
+                self.netflow_dict['load_file_history'][cfile] = {'age': age}
+                self.load_one(cfile)
+        finally:
+            self.IngestMode, self.AutoSave = mode, autosave
+        ignore = self.asn_metric()
+        print 'All file stats'
+        self.view_stats()
+        if save: self.save_db()
+        return len(cached)
+        
+        
+    def whatif(self, **settings):
+        """
+        help: replay the column cache into a separate Inetflow with some settings changed, self.netflow_dict is not touched
+        usage: res = netflow.whatif(TrustThreshold=100, DistFlowCutOffFactor=0.001)
+        returns the new Inetflow
+        """
+        other = self.spawn(**settings)
+        other.replay_files()
+        return other
+        
+        
+    def spawn(self, **settings):
+        """
+        an Inetflow without a db that has the settings of this one, the GeoIP cache and range index are shared,
+        it does not append to anomaly_file
+        """
+        other = Inetflow(self.verbose, db=0)
+        for key, value in self.__dict__.items():
+            if key[:1].isupper(): setattr(other, key, value)
+        other.AnomalyLog = 0
+        other.path = self.path
+        other.field_map = dict(self.field_map)
+        other.home_city = self.home_city
+        other.geo_cache = self.geo_cache
+        other.geo_index = self.geo_index
+        other.inst = self.inst
+        if self.spill_file: other.spill_file = self.spill_file + '.replay'
+        for key, value in settings.items(): setattr(other, key, value)
+        return other
+        
+        
+    def flush_report(self):
+        """
+        append the Report to report_spill_file and start a new Report
+        """
+        cfile = open(self.spill_file, 'ab')
+        self.netflow_dict['Report'].compact()
+        pickle.dump(self.netflow_dict['Report'], cfile, -1)
+        cfile.close()
+        self.netflow_dict['Report'] = FlowStore()
+        self.stream_stats['report_rows'] = 0
+        self.stream_stats['flushes'] += 1
+        
+        
+    def iter_spill(self):
+        """
+        generator of the Report sections flushed to report_spill_file by the last stream load
+        """
+        if not self.spill_file: return
+        try: cfile = open(self.spill_file, 'rb')
+        except IOError: return
+        while 1:
+            try: yield pickle.load(cfile)
+            except EOFError: break
+        cfile.close()
+        
+        
+    def clear_spill(self):
+        """
+        remove the Report sections flushed by the last stream load
+        """
+        if not self.spill_file: return
+        try: os.remove(self.spill_file)
+        except OSError: pass
+        
+        
+    def report_sections(self):
+        """
+        generator of the Report followed by the sections flushed by a stream load
+        """
+        yield self.get_report()
+        for report in self.iter_spill(): yield report
+        
+        
+    def report_totals(self):
+        """
+        the TotalFlowCount and BytesInVolume per DestinationAddress of the Report and the flushed sections as two TopK
+        """
+        report = self.get_report()
+        flows, volume = report.dst_flows, report.dst_bytes
+        for section in self.iter_spill():
+            if flows is report.dst_flows:
+                flows, volume = TopK(), TopK()
+                flows.merge(report.dst_flows)
+                volume.merge(report.dst_bytes)
+            flows.merge(section.dst_flows)
+            volume.merge(section.dst_bytes)
+        return flows, volume
+        
+        
+    def add_columns(self, cfile, cols, threshold=None):
+        """
+        add a dict of columns from to_columns, returns the number of rows added to the Report
+        
+        the per AS# sums are taken in row order starting from the stored totals so the AS# entries
+        and ASN_Stats come out the same as the row by row path
+        Avg_AsnMetric and the Report TrustMetric use one trust value per AS# for the chunk
+        if threshold is set flows from AS# with a trust at or below it are left out of the Report
+        """
+        SourceAddress = cols['SourceAddress']
+        self.geo_prime(SourceAddress)
+        
+        #group the row numbers by AS#, keeping the first SourceAddress seen for new AS# entries
+        t0 = self.inst.start()
+        groups = {}
+        for i, ip in enumerate(SourceAddress):
+            try: AS_Number = self.geo_lookup(ip)['AS_Number']
+            except: 
+                self.inst.error('aggregate')
+                continue
+            try: groups[AS_Number].append(i)
+            except KeyError: groups[AS_Number] = [i]
+            
+        BytesInVolume = cols['BytesInVolume']
+        PacketsInRatePerDuration = cols['PacketsInRatePerDuration']
+        history = self.netflow_dict['load_file_history'][cfile]
+        
+        digest = self.get_online()['FlowBytes']
+        for rows in groups.itervalues():
+            for i in rows: digest.push(BytesInVolume[i])
+        
+        FlowDuration = cols['FlowDuration']
+        warmup, limit = self.AnomalyWarmup, self.AnomalyZ
+        trust = {}
+        white = set()
+        for AS_Number in groups:
+            rows = groups[AS_Number]
+            try: self.netflow_dict[AS_Number]
+            except: self.new_asn(AS_Number, SourceAddress[rows[0]])
+            asn = self.netflow_dict[AS_Number]
+            try: reputation = self.reputation_cache[AS_Number]
+            except KeyError: reputation = self.reputation_of(AS_Number)
+            if reputation is WHITELIST: white.add(AS_Number)
+            
+            #compare the flows to the AS# baseline before they are added, in row order
+            if self.AnomalyScore and reputation is not WHITELIST:
+                try: score = asn['Baseline'].score
+                except KeyError: score = asn.setdefault('Baseline', self.new_baseline(AS_Number)).score
+                for i in rows:
+                    z = score(BytesInVolume[i], FlowDuration[i], PacketsInRatePerDuration[i], warmup, limit)
+                    if z is not None: self.anomaly((cfile, AS_Number, SourceAddress[i], cols['DestinationAddress'][i], cols['Protocol'][i], cols['DestinationPort'][i],
+                        int(BytesInVolume[i]), FlowDuration[i], PacketsInRatePerDuration[i]) + z)
+            if self.blackhole is not None:
+                for i in rows: self.blackhole_check(cfile, AS_Number, SourceAddress[i], cols['DestinationAddress'][i], cols['Protocol'][i], cols['DestinationPort'][i], int(BytesInVolume[i]))
+            
+            flows = len(rows)
+            byts = int(sum([BytesInVolume[i] for i in rows]))
+            packets = [round(PacketsInRatePerDuration[i], 4) for i in rows]
+            asn['TotalFlowCount'] += flows
+            asn['BytesInVolume'] += byts
+            asn['PacketsInRatePerDuration'] = sum(packets, asn['PacketsInRatePerDuration'])
+            try: delta = self.window_delta[AS_Number]
+            except KeyError: delta = self.window_delta[AS_Number] = [0, 0, 0.]
+            delta[0] += flows
+            delta[1] += byts
+            delta[2] = sum(packets, delta[2])
+            asn['Avg_BytesPerFlow'] = asn['BytesInVolume'] / asn['TotalFlowCount']
+            asn['Avg_PacketsInRatePerDuration'] = asn['PacketsInRatePerDuration'] / asn['TotalFlowCount']
+            self.dirty.add(AS_Number)
+            self.dist_changed.add(AS_Number)
+            self.metric_changed.add(AS_Number)
+            
+            if reputation is WHITELIST: trust[AS_Number] = 1
+            elif reputation is not None: trust[AS_Number] = reputation
+            else:
+                try: trust[AS_Number] = self.netflow_dict['ASN_Metrics']['Trust'][AS_Number]
+                except: trust[AS_Number] = self.trust_as(AS_Number)
+            try: history['Avg_AsnMetric'] += int(trust[AS_Number]) * flows
+            except: self.inst.error('aggregate')
+            
+            self.netflow_dict['ASN_Stats']['Total_TotalFlowCount'] += flows
+            history['Total_TotalFlowCount'] += flows
+            self.netflow_dict['ASN_Stats']['Total_BytesInVolume'] += byts
+            history['Total_BytesInVolume'] += byts
+        self.inst.stop('aggregate', t0, len(SourceAddress))
+            
+        t0 = self.inst.start()
+        DestinationAddress = cols['DestinationAddress']
+        Protocol = cols['Protocol']
+        DestinationPort = cols['DestinationPort']
+        SourcePort = cols['SourcePort']
+        added = 0
+        for AS_Number in groups:
+            if AS_Number in white: continue
+            if threshold is not None and trust[AS_Number] is not None and trust[AS_Number] <= threshold: continue
+            for i in groups[AS_Number]:
+                try: self.add_report(DestinationAddress[i], Protocol[i], DestinationPort[i], SourceAddress[i], SourcePort[i], int(BytesInVolume[i]), FlowDuration[i], PacketsInRatePerDuration[i], trust[AS_Number], AS_Number)
+                except: self.inst.error('report')
+            added += len(groups[AS_Number])
+        self.inst.stop('report', t0, added)
+        return added
+                
+                
+    def add_batch(self, cfile, batch):
+        """
+        resolve the SourceAddress of a batch of parsed flows in one GeoIP call then add each flow,
+        the flows are added to the Report after the batch is aggregated so the two are timed as separate stages
+        """
+        self.geo_prime([flow[2] for flow in batch])
+        t0 = self.inst.start()
+        report = []
+        for flow in batch:
+            try: row = self.add_flow(cfile, flow)
+            except: 
+                self.inst.error('aggregate')
+                continue
+            if row is not None: report.append(row)
+        self.inst.stop('aggregate', t0, len(batch))
+        
+        t0 = self.inst.start()
+        for row in report:
+            try: self.add_report(*row)
+            except: self.inst.error('report')
+        self.inst.stop('report', t0, len(report))
+            
+            
+    def add_flow(self, cfile, flow):
+        """
+        add a flow tuple from parse_flow to the AS# dict entries and the load_file stats
+        returns the add_report arguments for the flow, None for a whitelist AS#
+        """
+        DestinationAddress, Protocol, SourceAddress, SourcePort, DestinationPort, BytesInVolume, BytesInRatePerDuration, FlowDuration, PacketsInRatePerDuration = flow
+        
+        #AS lookup via the enrichment cache, the row is skipped if the address can not be resolved
+        geo_res = self.geo_lookup(SourceAddress)
+        AS_Number = geo_res['AS_Number']
 
-                           
-                except: pass
+        #FlowDuration and TotalFlowCount are not being added as 15 min data will not give anything meaningfull
+        #data will be added to the lists and will form a baseline, once there is sufficient data statistical anylsis can 
+        #be perfomred to compare the base data to new flows.
+
+        #check if the AS_Number dict exists, if not then create the entries for it
+        try: self.netflow_dict[AS_Number]
+        except: self.new_asn(AS_Number, SourceAddress)
+        
+        try: self.netflow_dict[AS_Number]['TotalFlowCount'] += 1
+        except: self.inst.error('aggregate')
+
+        try: self.netflow_dict[AS_Number]['BytesInVolume'] += BytesInVolume
+        except: self.inst.error('aggregate')
+
+        try: self.netflow_dict[AS_Number]['Avg_BytesPerFlow'] = self.netflow_dict[AS_Number]['BytesInVolume'] / self.netflow_dict[AS_Number]['TotalFlowCount']
+        except: self.inst.error('aggregate')
+
+        try: self.netflow_dict[AS_Number]['PacketsInRatePerDuration'] += round(PacketsInRatePerDuration, 4)
+        except: self.inst.error('aggregate')
+
+        try: self.netflow_dict[AS_Number]['Avg_PacketsInRatePerDuration'] = self.netflow_dict[AS_Number]['PacketsInRatePerDuration'] / self.netflow_dict[AS_Number]['TotalFlowCount']
+        except: self.inst.error('aggregate')
+        self.dirty.add(AS_Number)
+        self.dist_changed.add(AS_Number)
+        self.metric_changed.add(AS_Number)
+        self.get_online()['FlowBytes'].push(BytesInVolume)
+        try: delta = self.window_delta[AS_Number]
+        except KeyError: delta = self.window_delta[AS_Number] = [0, 0, 0.]
+        delta[0] += 1
+        delta[1] += BytesInVolume
+        delta[2] += round(PacketsInRatePerDuration, 4)
+        
+        try: reputation = self.reputation_cache[AS_Number]
+        except KeyError: reputation = self.reputation_of(AS_Number)
+        
+        #compare the flow to the AS# baseline before it is added
+        if self.AnomalyScore and reputation is not WHITELIST:
+            try: baseline = self.netflow_dict[AS_Number]['Baseline']
+            except KeyError: baseline = self.netflow_dict[AS_Number]['Baseline'] = self.new_baseline(AS_Number)
+            z = baseline.score(BytesInVolume, FlowDuration, PacketsInRatePerDuration, self.AnomalyWarmup, self.AnomalyZ)
+            if z is not None: self.anomaly((cfile, AS_Number, SourceAddress, DestinationAddress, Protocol, DestinationPort, BytesInVolume, FlowDuration, PacketsInRatePerDuration) + z)
+        if self.blackhole is not None: self.blackhole_check(cfile, AS_Number, SourceAddress, DestinationAddress, Protocol, DestinationPort, BytesInVolume)
+
+        #update the Avg_AsnMetric for the file history, whitelist AS# count as the best trust of 1
+        #self.netflow_dict['ASN_Metrics']['Trust'][ASN]
+        if reputation is WHITELIST: trust_res = 1
+        elif reputation is not None: trust_res = reputation
+        else:
+            try: trust_res = self.netflow_dict['ASN_Metrics']['Trust'][AS_Number]
+            except: trust_res = self.trust_as(AS_Number)
+        try: self.netflow_dict['load_file_history'][cfile]['Avg_AsnMetric'] += int(trust_res)
+        except: self.inst.error('aggregate')
+
+        #global and load_file ASN stats
+        try: 
+            self.netflow_dict['ASN_Stats']['Total_TotalFlowCount'] += 1
+            self.netflow_dict['load_file_history'][cfile]['Total_TotalFlowCount'] += 1
+        except: self.inst.error('aggregate')
+
+        try: 
+            self.netflow_dict['ASN_Stats']['Total_BytesInVolume'] += BytesInVolume
+            self.netflow_dict['load_file_history'][cfile]['Total_BytesInVolume'] += BytesInVolume
+        except: self.inst.error('aggregate')
+
+
+        if reputation is not WHITELIST: return (DestinationAddress, Protocol, DestinationPort, SourceAddress, SourcePort, BytesInVolume, FlowDuration, PacketsInRatePerDuration, trust_res, AS_Number)
+        
+        
+    def new_baseline(self, AS_Number):
+        """
+        the Baseline for an AS# record, a copy of the baseline_seed for the AS# if there is one
+        """
+        baseline = FlowBaseline()
+        try: baseline.merge(self.baseline_seed[AS_Number])
+        except KeyError: pass
+        return baseline
+        
+        
+    def new_asn(self, AS_Number, SourceAddress):
+        """
+        create the dict entry for a new AS#, the city lookup of SourceAddress gives the country and distance
+        """
+        geo_res = self.geo_lookup(SourceAddress, city=1)
+        print AS_Number, geo_res['ASN_Org']
+
+        self.netflow_dict[AS_Number] = {}
+        self.netflow_dict[AS_Number]['CountryCode'] = geo_res['CountryCode']
+        self.netflow_dict[AS_Number]['ASN_Org'] = geo_res['ASN_Org']
+        self.netflow_dict[AS_Number]['SourceAddressDistance'] = geo_res['SourceAddressDistance']
+        self.netflow_dict[AS_Number]['BytesInVolume'] = 0
+        self.netflow_dict[AS_Number]['PacketsInRatePerDuration'] = 0.0
+        self.netflow_dict[AS_Number]['TotalFlowCount'] = 0
+        self.netflow_dict[AS_Number]['Avg_BytesPerFlow'] = 0
+        self.netflow_dict[AS_Number]['Avg_PacketsInRatePerDuration'] = 0
+        self.dirty.add(AS_Number)
+        self.dist_changed.add(AS_Number)
+        self.metric_changed.add(AS_Number)
+        
+        
+    def add_report(self, DestinationAddress, Protocol, DestinationPort, SourceAddress, SourcePort, BytesInVolume, FlowDuration, PacketsInRatePerDuration, trust_res, AS_Number=None):
+        """
+        add a flow to the Report FlowStore for the current load_file
+        flows are stored one record per DestinationAddress, Protocol, DestinationPort, SourceAddress, SourcePort
+        with the TotalFlowCount, BytesInVolume, FlowDuration and PacketsInRatePerDuration totals, the TrustMetric of the first flow
+        and the source AS#
+        """
+        self.netflow_dict['Report'].add(DestinationAddress, Protocol, DestinationPort, SourceAddress, SourcePort, BytesInVolume, FlowDuration, PacketsInRatePerDuration, trust_res, AS_Number)
+        
+        
+    def anomaly(self, event):
+        """
+        keep an anomaly event (file, AS#, SourceAddress, DestinationAddress, Protocol, DestinationPort, BytesInVolume, FlowDuration,
+        PacketsInRatePerDuration, bytes z, duration z, packets z) in self.anomalies and anomaly_file if AnomalyLog is set
+        """
+        self.anomaly_count += 1
+        if self.anomalies.maxlen != self.AnomalyQueue: self.anomalies = deque(self.anomalies, maxlen=self.AnomalyQueue)
+        self.anomalies.append(event)
+        if self.AnomalyLog:
+            try:
+                if self.anomaly_log is None: self.anomaly_log = open(anomaly_file, 'a')
+                self.anomaly_log.write(','.join([str(value) for value in event]) + '\n')
+            except: self.inst.error('anomaly')
+            
+            
+    def load_reputation(self, force=0):
+        """
+        help: load the AS# in whitelist.txt and blacklist.txt and the country codes in country.txt, one per line
+        a country line may give the trust for the country, 'CN 800', otherwise it is ReputationTrust
+        the files are read again only when one has changed, returns 1 if the tables were loaded
+        usage: netflow.load_reputation()    or netflow.load_reputation(1) to force a reload
+        """
+        mtime = []
+        for cfile in (whitelist_file, blacklist_file, country_file):
+            try: mtime.append(os.stat(cfile).st_mtime)
+            except OSError: mtime.append(None)
+        if not force and mtime == self.reputation_mtime: return 0
+        self.reputation_mtime = mtime
+        
+        tables = []
+        for cfile in (whitelist_file, blacklist_file, country_file):
+            rows = []
+            try:
+                file = open(cfile, 'rU')
+                for row in file:
+                    try: rows.append(row.split())
+                    except: pass
+                file.close()
+            except IOError: pass
+            tables.append([row for row in rows if row and not row[0].startswith('#')])
+            
+        self.whitelist = set()
+        self.blacklist = set()
+        for table, rows in ((self.whitelist, tables[0]), (self.blacklist, tables[1])):
+            for row in rows:
+                AS_Number = row[0].upper()
+                if AS_Number.isdigit(): AS_Number = 'AS' + AS_Number
+                table.add(intern(AS_Number))
+        self.country_trust = {}
+        for row in tables[2]:
+            try: self.country_trust[intern(row[0].upper())] = float(row[1])
+            except (IndexError, ValueError): self.country_trust[intern(row[0].upper())] = float(self.ReputationTrust)
+            
+        self.reputation_cache = {}
+        self.metric_full = 1
+        print 'reputation whitelist', len(self.whitelist), 'blacklist', len(self.blacklist), 'countries', len(self.country_trust)
+        return 1
+        
+        
+    def reputation_of(self, AS_Number):
+        """
+        the fixed trust of an AS# from the reputation tables and keep it in reputation_cache,
+        WHITELIST for a whitelist AS#, None if the AS# is in none of the tables
+        """
+        if AS_Number in self.whitelist: reputation = WHITELIST
+        elif AS_Number in self.blacklist: reputation = float(self.ReputationTrust)
+        else:
+            try: reputation = self.country_trust.get(self.netflow_dict[AS_Number]['CountryCode'])
+            except KeyError: return None
+        self.reputation_cache[AS_Number] = reputation
+        return reputation
+        
+        
+    def blackhole_check(self, cfile, AS_Number, SourceAddress, DestinationAddress, Protocol, DestinationPort, BytesInVolume):
+        """
+        count a flow with a source or destination in the blackhole prefixes
+        """
+        match = self.blackhole.match
+        for side, ip in (('src', SourceAddress), ('dst', DestinationAddress)):
+            try: prefix = match(ip2int(ip))
+            except: 
+                self.inst.error('blackhole')
+                continue
+            if prefix is None: continue
+            try: self.blackhole_hits[prefix] += 1
+            except KeyError: self.blackhole_hits[prefix] = 1
+            if self.blackhole_flows.maxlen != self.BlackholeQueue: self.blackhole_flows = deque(self.blackhole_flows, maxlen=self.BlackholeQueue)
+            self.blackhole_flows.append((cfile, AS_Number, SourceAddress, DestinationAddress, Protocol, DestinationPort, BytesInVolume, side, prefix))
+            
+            
+    def view_blackhole(self, cmd=10):
+        """
+        help: view the blackhole prefixes with the most flows and the newest matching flows
+        usage: netflow.view_blackhole()    or netflow.view_blackhole(20)
+        """
+        if self.blackhole is None: return
+        print
+        print 'Blackhole prefixes:', '{:0,d}'.format(len(self.blackhole)), '  with flows:', len(self.blackhole_hits), '  flows:', '{:0,d}'.format(sum(self.blackhole_hits.values()))
+        print 'Showing the top   ', cmd
+        print
+        for prefix, count in heapq.nlargest(cmd, self.blackhole_hits.iteritems(), key=lambda item: item[1]):
+            print '%-18s %8s' % (prefix, '{:0,d}'.format(count))
+        print
+        for event in list(self.blackhole_flows)[-cmd:]:
+            print '%-8s %-15s -> %-15s %3s %5s  bytes %12s  %s %s' % (event[1], event[2], event[3], event[4], event[5], '{:0,d}'.format(event[6]), event[7], event[8])
+        print
+        
+        
+    def view_anomalies(self, cmd=20):
+        """
+        help: view the newest anomaly events, the z-scores are against the AS# baseline before the flow was added
+        usage: netflow.view_anomalies()    or netflow.view_anomalies(50)
+        """
+        print
+        print 'Anomaly events:', '{:0,d}'.format(self.anomaly_count), '  z-score limit', self.AnomalyZ, '  warmup', self.AnomalyWarmup, 'flows'
+        print 'Showing the newest', cmd
+        print
+        for event in list(self.anomalies)[-cmd:]:
+            print '%-8s %-15s -> %-15s %3s %5s  bytes %12s  duration %6s  pkts/s %8.2f   z %6.2f %6.2f %6.2f' % (event[1], event[2], event[3],
+                event[4], event[5], '{:0,d}'.format(event[6]), event[7], event[8], event[9], event[10], event[11])
+        print
+        
+        
+    def get_report(self):
+        """
+        the Report FlowStore, a Report dict from an older db is converted on first use
+        """
+        report = self.netflow_dict.get('Report')
+        if report is None: report = self.netflow_dict['Report'] = FlowStore()
+        elif isinstance(report, dict): report = self.netflow_dict['Report'] = FlowStore.from_tree(report)
+        return report
         
-        #end of file
         
+    def new_files(self):
+        """
+        help: take all the files queued by scan_files as (age, file) oldest first
+        usage: netflow.new_files()
+        """
+        self.scan_files()
+        out = []
+        while self.file_heap: out.append(heapq.heappop(self.file_heap))
+        return out
         
         
-        try: 
-            self.netflow_dict['ASN_Stats']['Avg_BytesPerFlow'] = self.netflow_dict['ASN_Stats']['Total_BytesInVolume'] / self.netflow_dict['ASN_Stats']['Total_TotalFlowCount']
-            
+    def backfill(self, processes=None):
+        """
+        help: load every new file in self.path using a pool of worker processes
+        each worker runs a columnar load of one file into an empty netflow_dict and returns it as a partial aggregate,
+        the partials are merged oldest file first so the result does not depend on the order the workers finish,
+        then get_asn_dist, flow_dist and asn_metric run once and the db is saved once
+        each file is scored for anomalies against the AS# baselines of the db before the backfill, not the other files loaded with it
+        usage: netflow.backfill()    or netflow.backfill(4) to set the number of processes
+        """
+        files = self.new_files()
+        if not files: return 'nothing to load'
+        print '##### backfill of %d files' % len(files)
+        
+        self.load_reputation()
+        
+        #the workers score the flows against the AS# baselines of the db rather than starting from empty ones
+        seed = {}
+        if self.AnomalyScore:
+            for AS_Number in self.get_asn():
+                try: seed[AS_Number] = self.netflow_dict[AS_Number]['Baseline']
+                except KeyError: pass
+        settings = {'baseline_seed': seed, 'path': self.path, 'field_map': self.field_map, 'SourceFilter': self.SourceFilter, 'home_city': self.home_city, 'GeoIndex': self.GeoIndex, 'ColumnChunk': self.ColumnChunk,
+            'AnomalyScore': self.AnomalyScore, 'AnomalyZ': self.AnomalyZ, 'AnomalyWarmup': self.AnomalyWarmup, 'AnomalyQueue': self.AnomalyQueue,
+            'blackhole': self.blackhole, 'BlackholeQueue': self.BlackholeQueue,
+            'whitelist': self.whitelist, 'blacklist': self.blacklist, 'country_trust': self.country_trust, 'ReputationTrust': self.ReputationTrust,
+            'Archive': self.Archive, 'ArchiveLevel': self.ArchiveLevel}
+        jobs = []
+        for age, cfile in files: jobs.append((cfile, age, cfile == files[-1][1]))
+        
+        pool = multiprocessing.Pool(processes, init_backfill_worker, (settings,))
+        try: partials = pool.map(backfill_worker, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
             
-            self.netflow_dict['load_file_history'][cfile]['Avg_BytesPerFlow'] = self.netflow_dict['load_file_history'][cfile]['Total_BytesInVolume'] / self.netflow_dict['load_file_history'][cfile]['Total_TotalFlowCount']
+        #merge in file age order, the Report is only kept for the newest file
+        self.clear_spill()
+        file_asn = {}
+        for cfile, partial in partials:
+            file_asn[cfile] = self.merge_partial(cfile, partial)
             
+        try: self.netflow_dict['ASN_Stats']['Avg_BytesPerFlow'] = self.netflow_dict['ASN_Stats']['Total_BytesInVolume'] / self.netflow_dict['ASN_Stats']['Total_TotalFlowCount']
         except: pass
         
-        #get the distribution stats
         self.get_asn_dist()
-        
-        #get the standard deviation and avg for the loaded files
         res = self.flow_dist()
         self.netflow_dict['load_file_history']['StdDevBytesPerFlow'] = res[0][0]
         self.netflow_dict['load_file_history']['StdDevBytesPerFlowAvg'] = res[0][1]
+        self.asn_metric()
         
-        #display the Asn Load Stats
-        self.cfile = cfile
+        #score each file and the Report with the merged trust metrics
+        trust = self.netflow_dict['ASN_Metrics']['Trust']
+        for cfile in file_asn:
+            total = 0
+            for AS_Number, flows in file_asn[cfile].items():
+                try: total += trust[AS_Number] * flows
+                except KeyError: pass
+            self.netflow_dict['load_file_history'][cfile]['Avg_AsnMetric'] = total
+        self.get_report().fill_trust(lambda ip: trust.get(self.as_lookup(ip)))
+                        
+        self.cfile = files[-1][1]
         self.asn_stats()
+        self.save_db()
+        print 'All file stats'
+        self.view_stats()
         
-        #display result above self.TrustThreshold
-        self.report_trust('v')
-        
-        #display the IP address with the highest number of flows
-        self.view_flows()
         
-        #display the IP address with the highest number of Bytes
-        self.view_bytes()
-
-
-        #self.view_db()
-        self.save_db()
-        self.load()
+    def merge_partial(self, cfile, partial):
+        """
+        add a partial netflow_dict from backfill_worker to self.netflow_dict
+        returns the flow count per AS# for the file
+        """
+        self.get_online()
+        asn_flows = {}
+        self.window_delta = {}
+        for event in partial.pop('Anomalies', []): self.anomaly(event)
+        if 'Archive' in partial:
+            entry = partial.pop('Archive')
+            if entry is None: self.inst.error('archive')
+            else: self.archive_add(entry)
+        hits, flows = partial.pop('Blackhole', ({}, []))
+        for prefix, count in hits.iteritems(): self.blackhole_hits[prefix] = self.blackhole_hits.get(prefix, 0) + count
+        self.blackhole_flows.extend(flows)
+        for key, rec in partial.items():
+            if 'AS' not in key or 'ASN' in key: continue
+            asn_flows[key] = rec['TotalFlowCount']
+            self.window_delta[key] = [rec['TotalFlowCount'], rec['BytesInVolume'], rec['PacketsInRatePerDuration']]
+            self.dirty.add(key)
+            self.dist_changed.add(key)
+            self.metric_changed.add(key)
+            try: asn = self.netflow_dict[key]
+            except KeyError:
+                self.netflow_dict[key] = rec
+                continue
+            asn['TotalFlowCount'] += rec['TotalFlowCount']
+            asn['BytesInVolume'] += rec['BytesInVolume']
+            asn['PacketsInRatePerDuration'] += rec['PacketsInRatePerDuration']
+            asn['Avg_BytesPerFlow'] = asn['BytesInVolume'] / asn['TotalFlowCount']
+            asn['Avg_PacketsInRatePerDuration'] = asn['PacketsInRatePerDuration'] / asn['TotalFlowCount']
+            if 'Baseline' in rec:
+                try: asn['Baseline'].merge(rec['Baseline'])
+                except KeyError: asn['Baseline'] = rec['Baseline']
+            
+        self.netflow_dict['ASN_Stats']['Total_TotalFlowCount'] += partial['ASN_Stats']['Total_TotalFlowCount']
+        self.netflow_dict['ASN_Stats']['Total_BytesInVolume'] += partial['ASN_Stats']['Total_BytesInVolume']
+        self.netflow_dict['load_file_history'][cfile] = partial['load_file_history'][cfile]
+        self.dirty_files.add(cfile)
+        self.file_done(cfile)
+        self.window_push(cfile)
+        self.get_online()['FlowBytes'].merge(partial['ASN_Stats']['Online']['FlowBytes'])
+        if 'Report' in partial: self.netflow_dict['Report'] = partial['Report']
+        return asn_flows
         
         
     def asn_stats(self):
@@ -469,14 +3432,107 @@ class Inetflow(Tools):
             pprint.pprint(self.netflow_dict['load_file_history'][self.cfile])
             print
             print 'Average Trust per flow:   ', int(self.netflow_dict['load_file_history'][self.cfile]['Avg_AsnMetric'] / self.netflow_dict['load_file_history'][self.cfile]['Total_TotalFlowCount'])
-        except: pass
+        except: self.inst.error('asn_stats')
+        if self.inst.enabled: 
+            print
+            self.inst.view()
         
         
     def as_lookup(self, ip):
-        asn_res = geoip_asn.asn_by_addr(ip)
-        #print asn_res
-        asn_raw = asn_res.split(' ')
-        return asn_raw[0]
+        return self.geo_lookup(ip)['AS_Number']
+        
+        
+    def geo_lookup(self, ip, city=0):
+        """
+        help: GeoIP enrichment of an IP address through the shared lookup cache
+        returns a dict with AS_Number and ASN_Org, city=1 adds CountryCode, Latitude, Longitude and SourceAddressDistance
+        raises KeyError if the address has no AS# record
+        usage: netflow.geo_lookup('8.8.8.8', 1)
+        """
+        try: rec = self.geo_cache.get(ip)
+        except KeyError:
+            rec = None
+            t0 = self.inst.start()
+            try:
+                asn_res = geoip_asn.asn_by_addr(ip)
+                AS_Number = asn_res.split(' ')[0]
+                rec = {'AS_Number': AS_Number, 'ASN_Org': asn_res[len(AS_Number) + 1:]}
+            except: self.inst.error('geoip')
+            self.geo_cache.put(ip, rec)
+            self.inst.stop('geoip', t0)
+        if rec is None: raise KeyError(ip)
+        
+        if city and 'SourceAddressDistance' not in rec:
+            t0 = self.inst.start()
+            try:
+                if 'Latitude' not in rec:
+                    city_res = geoip_city.record_by_addr(ip)
+                    rec['CountryCode'] = city_res['country_code']
+                    rec['Latitude'] = city_res['latitude']
+                    rec['Longitude'] = city_res['longitude']
+                #calculate distance from self.home_city to the ip in Miles
+                rec['SourceAddressDistance'] = int(vincenty(self.home_city, (rec['Latitude'], rec['Longitude'])).miles)
+            except:
+                rec['CountryCode'] = 'unknown'
+                rec['Latitude'] = None
+                rec['Longitude'] = None
+                rec['SourceAddressDistance'] = 100
+                self.inst.error('distance')
+            self.inst.stop('distance', t0)
+        return rec
+        
+        
+    def get_geo_index(self):
+        """
+        build the GeoRangeIndex on first use, returns None if GeoIndex is off or the csv editions are not present
+        """
+        if not self.GeoIndex: return None
+        if self.geo_index is None:
+            if not os.path.exists(self.asn_csv): 
+                self.GeoIndex = 0
+                return None
+            print 'loading GeoIP range index'
+            self.geo_index = GeoRangeIndex(self.asn_csv, self.blocks_csv, self.location_csv)
+        return self.geo_index
+        
+        
+    def geo_prime(self, ips):
+        """
+        help: resolve a list of IP addresses with one batch lookup and add them to the GeoIP cache
+        addresses already cached are skipped, does nothing when the range index is not available
+        usage: netflow.geo_prime(['8.8.8.8', '4.2.2.2'])
+        """
+        index = self.get_geo_index()
+        if index is None: return
+        new_ips = []
+        seen = set()
+        for ip in ips:
+            if ip in seen or ip in self.geo_cache.cache: continue
+            seen.add(ip)
+            new_ips.append(ip)
+        if not new_ips: return
+        
+        t0 = self.inst.start()
+        asn_ids, city_ids = index.lookup_batch(new_ips)
+        for ip, asn_id, city_id in zip(new_ips, asn_ids, city_ids):
+            if asn_id < 0: 
+                self.geo_cache.put(ip, None)
+                continue
+            asn_res = index.asn_names[asn_id]
+            AS_Number = asn_res.split(' ')[0]
+            rec = {'AS_Number': AS_Number, 'ASN_Org': asn_res[len(AS_Number) + 1:]}
+            if city_id >= 0: rec['CountryCode'], rec['Latitude'], rec['Longitude'] = index.locations[city_id]
+            self.geo_cache.put(ip, rec)
+        self.inst.stop('geoip', t0, len(new_ips))
+            
+            
+    def view_cache(self):
+        """
+        help: view the GeoIP lookup cache counters
+        usage: netflow.view_cache()
+        """
+        try: pprint.pprint(self.geo_cache.stats())
+        except: pass
         
     
     def report_trust(self, cmd=''):
@@ -493,163 +3549,462 @@ class Inetflow(Tools):
         print
         print 'Report of IP address above the TrustThreshold of', self.TrustThreshold
         
+        #only the flows of the source AS# over the threshold are read, through the AS# index of each Report section
         try: 
-            for ip in self.netflow_dict['Report']: 
-                try:
-                    asn = self.as_lookup(ip)
-                    res = int(self.metric_as(asn, 0))
-                    if res > self.TrustThreshold: 
-                        print
-                        print ip
-                        if 'v' in cmd:
-                            print 'trust %d' % res
-                            print geoip_asn.asn_by_addr(ip)
-                        if 'list' in cmd: pprint.pprint(self.netflow_dict['Report'][ip])
-                except: pass
-        except: pass
+            shown = set()
+            for report in self.report_sections():
+                if 0 in report.by_asn: report.fill_asn(self.as_lookup)
+                for asn, res in sorted(self.trust_batch(report.asns()).items()):
+                    try:
+                        reputation = self.reputation_of(asn)
+                        if reputation is WHITELIST: res = 1
+                        elif reputation is not None: res = reputation
+                        res = int(res)
+                        if res <= self.TrustThreshold: continue
+                        for n in report.find(asn=asn):
+                            if report.dst[n] in shown: continue
+                            shown.add(report.dst[n])
+                            ip = int2ip(report.dst[n])
+                            print
+                            print ip
+                            if 'v' in cmd:
+                                print 'trust %d' % res
+                                print asn, self.netflow_dict[asn]['ASN_Org']
+                            if 'list' in cmd: pprint.pprint(report[ip])
+                    except: self.inst.error('report_trust')
+        except: self.inst.error('report_trust')
+        
+        
+    def query(self, dst=None, src=None, dport=None, proto=None, asn=None):
+        """
+        help: find the flows in the Report and the sections flushed by a stream load matching every key given
+        returns a list of (DestinationAddress, Protocol, DestinationPort, SourceAddress, SourcePort, TotalFlowCount,
+        BytesInVolume, FlowDuration, PacketsInRatePerDuration, TrustMetric), also in self.out
+        usage: netflow.query(dport=3389)    or netflow.query(asn='AS4134', proto=6)    or netflow.query(src='1.2.3.4')
+        """
+        if asn is not None: asn = asn.upper()
+        self.out = []
+        for report in self.report_sections():
+            if asn is not None and 0 in report.by_asn: report.fill_asn(self.as_lookup)
+            self.out.extend([report.record(n) for n in report.find(dst, src, dport, proto, asn)])
+        return self.out
+        
+        
+    def view_query(self, dst=None, src=None, dport=None, proto=None, asn=None):
+        """
+        help: view the flows returned by query()
+        usage: netflow.view_query(dport=3389)
+        """
+        print
+        for flow in self.query(dst, src, dport, proto, asn):
+            print '%-15s <- %-15s:%-5s %3s %5s  flows %6s  bytes %12s  trust %s' % (flow[0], flow[3], flow[4], flow[1], flow[2], flow[5], '{:0,d}'.format(flow[6]), flow[9])
+        print 'flows', len(self.out)
+        print
         
         
     def view_ip(self, ip):
         """
         help: view the IP record for the Report dict section, the last loaded netflow file
+        sections flushed by a stream load are shown as well
         """
-        try: pprint.pprint(self.netflow_dict['Report'][ip])
-        except: pass
+        for report in self.report_sections():
+            if ip not in report: continue
+            try: pprint.pprint(report[ip])
+            except: self.inst.error('views')
         
         
     def gen_flows(self):
         """
-        
+        TotalFlowCount per IP address in the Report and the sections flushed by a stream load, result is self.out
         """
         self.out = {}
-        
-        try:
-            for ip in self.netflow_dict['Report']:
-                try:
-                    for protocol in self.netflow_dict['Report'][ip]:
-                        count = len(self.netflow_dict['Report'][ip][protocol].keys())
-                        try: 
-                            #check if record exists for another protocol
-                            sum = self.out[ip] + count
-                            self.out[ip] = sum
-                        except: self.out[ip] = count      
-                except: pass
-                
-        except: pass
+        try: self.out = dict((int2ip(dst), total) for dst, total in self.report_totals()[0].totals.iteritems())
+        except: self.inst.error('views')
 
 
     def view_flows(self, cmd=10):
         """
-        help: view the IP address with the most flows
+        help: view the IP address with the most flows, the IP tied with the last one shown are shown too
+        the per IP totals are kept as flows are added so only the top entries are sorted,
+        the totals of the sections flushed by a stream load are merged in
+        usage: netflow.view_flows()    or netflow.view_flows(20)
         """
-        flow_sum = 0
-        self.gen_flows()
-        total_flows = len(self.out)
+        flows = self.report_totals()[0]
+        total_flows = len(flows.totals)
+        if not total_flows: return
+        top = [(int2ip(dst), total) for dst, total in flows.top(max(cmd, 1), ties=1)]
         print
         print 'Total unique IP addr with flows:', total_flows
-        dist = []
-        for ip in self.out:
-            dist.append(self.out[ip])
-            flow_sum += self.out[ip]
-        dist.sort()
-        #print dist
-        print 'Maximum flow count for a single IP addr:   ', dist[-1]
-        print 'Average flow count per IP addr:    ', int(flow_sum / total_flows)
+        print 'Maximum flow count for a single IP addr:   ', top[0][1]
+        print 'Average flow count per IP addr:    ', int(flows.sum / total_flows)
         print 'Showing the top   ', cmd
         print
-        sum = 0 - cmd
-        filter = dist[sum]
-        for ip in self.out:
-            if self.out[ip] >= filter:
-                print ip, '   ', self.out[ip]
+        for ip, count in (top if cmd > 0 else []):
+            print ip, '   ', count
                 
         print
        
        
     def gen_bytes(self):
         """
-        self.netflow_dict['Report'][DestinationAddress][Protocol]['IPBytesInVolume']
+        BytesInVolume per IP address in the Report and the sections flushed by a stream load, result is self.out
         """
         self.out = {}
-        try:
-            for ip in self.netflow_dict['Report']:
-                try:
-                    for protocol in self.netflow_dict['Report'][ip]:
-                        try: 
-                            #check if record exists for another protocol
-                            sum = self.out[ip] + self.netflow_dict['Report'][ip][protocol]['IPBytesInVolume']
-                            self.out[ip] = sum
-                        except: self.out[ip] = self.netflow_dict['Report'][ip][protocol]['IPBytesInVolume']
-                except: pass        
-        except: pass
+        try: self.out = dict((int2ip(dst), total) for dst, total in self.report_totals()[1].totals.iteritems())
+        except: self.inst.error('views')
         
     
     def view_bytes(self, cmd=10):
         """
-        help: view the IP address with the most Bytes
+        help: view the IP address with the most Bytes, the IP tied with the last one shown are shown too
+        usage: netflow.view_bytes()    or netflow.view_bytes(20)
         """
-        self.gen_bytes()
-        flows = 0
-        total = 0
+        volume = self.report_totals()[1]
+        flows = len(volume.totals)
+        if not flows: return
+        top = [(int2ip(dst), total) for dst, total in volume.top(max(cmd, 1), ties=1)]
         print
-        dist = []
-        for ip in self.out:
-            dist.append(self.out[ip])
-            flows += 1
-            total += self.out[ip]
-        dist.sort()
-        #print dist
-        avgBytes = int(total / flows)
-        print 'Maximum Bytes for a single IP addr:   ', '{:0,d}'.format(dist[-1])
+        avgBytes = int(volume.sum / flows)
+        print 'Maximum Bytes for a single IP addr:   ', '{:0,d}'.format(top[0][1])
         print 'Average flow count per IP addr:    ', '{:0,d}'.format(avgBytes)
         print 'Showing the top   ', cmd
         print
-        sum = 0 - cmd
-        filter = dist[sum]
-        for ip in self.out:
-            if self.out[ip] >= filter:
-                print ip, '   ', '{:0,d}'.format(self.out[ip])
+        for ip, total in (top if cmd > 0 else []):
+            print ip, '   ', '{:0,d}'.format(total)
                 
         print
     
-    def get_asn_dist(self):
+    def archive_report(self, cfile, reports):
         """
-        get a distribution list of TotalFlowCount per ASN
-        get a distribution of BytesInVolume per ASN
+        write the Report sections of cfile to a partition in archive_dir and return its index entry
+        the partition is a pickled header with the address and DestinationPort ranges, a bloom filter of the
+        addresses and the AS# set, followed by each section as a zlib compressed pickle
         """
-        #TotalFlowCount
-        #reset the list
-        self.netflow_dict['ASN_Stats']['Dist_TotalFlowCount'] = []
-        for ASN_key in self.netflow_dict:
+        #backfill workers can reach here together, one of them creating archive_dir is not an error for the others
+        if not os.path.isdir(archive_dir):
+            try: os.makedirs(archive_dir)
+            except OSError:
+                if not os.path.isdir(archive_dir): raise
+        age = self.netflow_dict['load_file_history'][cfile]['age']
+        name = time.strftime('%Y%m%d%H%M', time.localtime(age)) + '_' + cfile + '.nfa'
+        reports = [report for report in reports if len(report.flows)]
+        
+        addrs = set()
+        asns = set()
+        rows = 0
+        for report in reports:
+            addrs.update(report.src)
+            addrs.update(report.by_dst)
+            asns.update(report.asns())
+            rows += len(report.flows)
+        bloom = BloomFilter(len(addrs))
+        for addr in addrs: bloom.add(addr)
+        entry = {'name': name, 'file': cfile, 'age': age, 'rows': rows, 'sections': len(reports)}
+        if reports:
+            entry['src'] = (min([min(report.src) for report in reports]), max([max(report.src) for report in reports]))
+            entry['dst'] = (min([min(report.dst) for report in reports]), max([max(report.dst) for report in reports]))
+            entry['dport'] = (min([min(report.dport) for report in reports]), max([max(report.dport) for report in reports]))
+            
+        cfile = open(archive_dir + name, 'wb')
+        pickle.dump({'entry': entry, 'bloom': bloom, 'asns': asns}, cfile, -1)
+        for report in reports: pickle.dump(zlib.compress(pickle.dumps(report, -1), self.ArchiveLevel), cfile, -1)
+        cfile.close()
+        return entry
+        
+        
+    def archive_add(self, entry):
+        """
+        append a partition index entry to archive_dir index.pkl
+        """
+        index = self.get_archive_index()
+        index[entry['name']] = entry
+        cfile = open(archive_dir + 'index.pkl', 'ab')
+        pickle.dump(entry, cfile, -1)
+        cfile.close()
+        
+        
+    def get_archive_index(self):
+        """
+        the partition index entries by name, read from index.pkl on first use
+        """
+        if self.archive_index is None:
+            self.archive_index = {}
+            try: cfile = open(archive_dir + 'index.pkl', 'rb')
+            except IOError: return self.archive_index
+            while 1:
+                try: entry = pickle.load(cfile)
+                except EOFError: break
+                self.archive_index[entry['name']] = entry
+            cfile.close()
+        return self.archive_index
+        
+        
+    def archive_prune(self, horizon):
+        """
+        remove the partitions older than horizon and rewrite index.pkl
+        """
+        index = self.get_archive_index()
+        gone = [name for name, entry in index.items() if entry['age'] < horizon]
+        if not gone: return 0
+        for name in gone:
+            del index[name]
+            try: os.remove(archive_dir + name)
+            except OSError: pass
+        cfile = open(archive_dir + 'index.pkl', 'wb')
+        for name in sorted(index): pickle.dump(index[name], cfile, -1)
+        cfile.close()
+        return len(gone)
+        
+        
+    def archive_query(self, dst=None, src=None, dport=None, proto=None, asn=None, days=7, end=None):
+        """
+        help: find the archived flows of the last days matching every key given, days=None searches all partitions
+        partitions are skipped on the index ranges first, then on the bloom filter and AS# set in their header,
+        only the sections of the remaining partitions are decompressed
+        returns a list of (load file,) + the query() flow tuple, also in self.out
+        usage: netflow.archive_query(src='1.2.3.4')    or netflow.archive_query(dport=3389, days=1)
+        """
+        if end is None: end = time.time()
+        start = None
+        if days is not None: start = end - days * 86400
+        if asn is not None: asn = asn.upper()
+        keys = []
+        if src is not None: keys.append(('src', ip2int(src)))
+        if dst is not None: keys.append(('dst', ip2int(dst)))
+        if dport is not None: keys.append(('dport', dport))
+        
+        self.out = []
+        self.archive_stats = {'partitions': 0, 'read': 0, 'decompressed': 0}
+        for name, entry in sorted(self.get_archive_index().items()):
+            self.archive_stats['partitions'] += 1
+            if start is not None and entry['age'] < start or entry['age'] > end: continue
+            if not entry['rows']: continue
+            if [key for key, value in keys if not entry[key][0] <= value <= entry[key][1]]: continue
             
+            self.archive_stats['read'] += 1
+            cfile = open(archive_dir + name, 'rb')
+            try:
+                header = pickle.load(cfile)
+                if [key for key, value in keys if key != 'dport' and value not in header['bloom']]: continue
+                if asn is not None and asn not in header['asns']: continue
+                self.archive_stats['decompressed'] += 1
+                for i in xrange(entry['sections']):
+                    report = pickle.loads(zlib.decompress(pickle.load(cfile)))
+                    self.out.extend([(entry['file'],) + report.record(n) for n in report.find(dst, src, dport, proto, asn)])
+            finally: cfile.close()
+        return self.out
+        
+        
+    def view_archive(self, ip, days=7):
+        """
+        help: view the archived flows from or to an IP address over the last days
+        usage: netflow.view_archive('1.2.3.4')    or netflow.view_archive('1.2.3.4', 30)
+        """
+        flows = self.archive_query(src=ip, days=days) + self.archive_query(dst=ip, days=days)
+        print
+        for flow in sorted(flows):
+            print '%-20s %-15s <- %-15s:%-5s %3s %5s  flows %6s  bytes %12s' % (flow[0], flow[1], flow[4], flow[5], flow[2], flow[3], flow[6], '{:0,d}'.format(flow[7]))
+        print 'flows', len(flows)
+        print
+        
+        
+    def window_push(self, cfile):
+        """
+        add the AS# totals counted since the last push to the AsnWindow of each AS# and to ASN_Stats['Window'],
+        in the 15 minute interval of the cfile age
+        """
+        interval = int(self.netflow_dict['load_file_history'][cfile]['age'] // WINDOW_INTERVAL)
+        size = self.WindowRetention
+        total = [0, 0, 0.]
+        for AS_Number, delta in self.window_delta.iteritems():
+            try: asn = self.netflow_dict[AS_Number]
+            except KeyError: continue
+            try: window = asn['Window']
+            except KeyError: window = asn['Window'] = AsnWindow(size)
+            window.push(interval, delta[0], delta[1], delta[2], size)
+            self.dirty.add(AS_Number)
+            total[0] += delta[0]
+            total[1] += delta[1]
+            total[2] += delta[2]
+        try: window = self.netflow_dict['ASN_Stats']['Window']
+        except KeyError: window = self.netflow_dict['ASN_Stats']['Window'] = AsnWindow(size)
+        window.push(interval, total[0], total[1], total[2], size)
+        self.window_delta = {}
+        self.window_inputs_cache = {}
+        if self.HistoryRetention: self.prune_history(cfile)
+        
+        
+    def prune_history(self, current=None):
+        """
+        help: drop the load_file_history entries older than HistoryRetention days
+        the per file running statistics are rebuilt from the entries kept, current is a file being finished
+        that file_done has not added yet
+        usage: netflow.HistoryRetention = 30; netflow.prune_history()
+        returns the number of entries dropped
+        """
+        horizon = time.time() - self.HistoryRetention * 86400
+        history = self.netflow_dict['load_file_history']
+        gone = []
+        for cfile in history.keys():
             try: 
-                if 'AS' in ASN_key:
-                    res = self.netflow_dict[ASN_key]['TotalFlowCount']
-                    self.netflow_dict['ASN_Stats']['Dist_TotalFlowCount'].append(res)
-                    
+                if history[cfile]['age'] < horizon: gone.append(cfile)
             except: pass
+        for cfile in gone:
+            del history[cfile]
+            self.dirty_files.add(cfile)
+        if gone: 
+            self.rebuild_file_stats(current)
+            res = self.flow_dist()
+            if res and res[0]: 
+                history['StdDevBytesPerFlow'] = res[0][0]
+                history['StdDevBytesPerFlowAvg'] = res[0][1]
+        if self.Archive: self.archive_prune(horizon)
+        return len(gone)
         
-        #sort the list for easier viewing
-        self.netflow_dict['ASN_Stats']['Dist_TotalFlowCount'].sort()
         
-        #find the flow value that is insignificant compared to Total_TotalFlowCount
-        self.netflow_dict['ASN_Stats']['Dist_FlowCutOff'] = self.netflow_dict['ASN_Stats']['Total_TotalFlowCount'] * self.DistFlowCutOffFactor
+    def rebuild_file_stats(self, current=None):
+        """
+        start BytesPerFlow and FileBytesPerFlow in ASN_Stats['Online'] again from the completed files in load_file_history
+        """
+        online = self.get_online()
+        online['BytesPerFlow'] = RunningStats()
+        online['FileBytesPerFlow'] = TDigest()
+        for cfile, history in self.netflow_dict['load_file_history'].items():
+            if cfile == current or not isinstance(history, dict) or 'status' in history: continue
+            try: self.file_done(cfile)
+            except: pass
         
         
-        #BytesInVolume
-        #reset the list
-        self.netflow_dict['ASN_Stats']['Dist_BytesInVolume'] = []
-        for ASN_key in self.netflow_dict:
-            
+    def window_size(self, window):
+        """
+        number of intervals for 'hour', 'day', 'week' or a count of intervals
+        """
+        try: return WINDOWS[window]
+        except KeyError: return int(window)
+        
+        
+    def window_now(self):
+        """
+        newest interval in ASN_Stats['Window']
+        """
+        return self.netflow_dict['ASN_Stats']['Window'].ring[-1][0]
+        
+        
+    def window_inputs(self, intervals):
+        """
+        (StdDevBytesPerFlow, StdDevBytesPerFlowAvg, Dist_FlowCutOff) for the load files and flows of the last intervals
+        """
+        now = self.window_now()
+        try: return self.window_inputs_cache[intervals]
+        except KeyError: pass
+        stats = RunningStats()
+        for cfile, history in self.netflow_dict['load_file_history'].items():
             try: 
-                if 'AS' in ASN_key:
-                    res = self.netflow_dict[ASN_key]['BytesInVolume']
-                    self.netflow_dict['ASN_Stats']['Dist_BytesInVolume'].append(res)
-                    
+                if now - intervals < int(history['age'] // WINDOW_INTERVAL) <= now and history['Total_TotalFlowCount']: stats.push(history['Avg_BytesPerFlow'])
+            except: pass
+        StdDev, StdDevAvg = stats.legacy()
+        flows = self.netflow_dict['ASN_Stats']['Window'].totals(now, intervals)[0]
+        self.window_inputs_cache[intervals] = (StdDev, StdDevAvg, flows * self.DistFlowCutOffFactor)
+        return self.window_inputs_cache[intervals]
+        
+        
+    def metric_values(self, asn, window=None):
+        """
+        (SourceAddressDistance, Avg_BytesPerFlow, TotalFlowCount, StdDevBytesPerFlow, StdDevBytesPerFlowAvg, Dist_FlowCutOff)
+        for the trust metric of an AS#, from all time totals or from the last window ('hour', 'day', 'week' or intervals)
+        """
+        rec = self.netflow_dict[asn]
+        if window is None: return (rec['SourceAddressDistance'], rec['Avg_BytesPerFlow'], rec['TotalFlowCount']) + self.metric_inputs_now()
+        intervals = self.window_size(window)
+        flows, byts, packets = rec['Window'].totals(self.window_now(), intervals)
+        return (rec['SourceAddressDistance'], byts / flows, flows) + self.window_inputs(intervals)
+        
+        
+    def view_window(self, asn):
+        """
+        help: view the hour, day and week totals for an AS#
+        usage: netflow.view_window('AS2856')
+        """
+        try:
+            asn = asn.upper()
+            now = self.window_now()
+            print asn, 'to', time.strftime('%Y-%m-%d %H:%M', time.localtime((now + 1) * WINDOW_INTERVAL))
+            for name in ('hour', 'day', 'week'):
+                flows, byts, packets = self.netflow_dict[asn]['Window'].totals(now, WINDOWS[name])
+                print '%-5s flows %12s  bytes %16s  trust %s' % (name, '{:0,d}'.format(flows), '{:0,d}'.format(byts), self.trust_as(asn, name))
+        except: pass
+        
+        
+    def get_online(self):
+        """
+        the running statistics kept in ASN_Stats['Online'], built from load_file_history for an older db
+        BytesPerFlow     RunningStats of Avg_BytesPerFlow per load file
+        FileBytesPerFlow TDigest of Avg_BytesPerFlow per load file
+        FlowBytes        TDigest of BytesInVolume per flow
+        AsnValues        the TotalFlowCount and BytesInVolume per AS# held in the Dist lists
+        AsnPending       the AS# changed but not yet in the Dist lists when the sqlite db was saved
+        """
+        try: return self.netflow_dict['ASN_Stats']['Online']
+        except KeyError: pass
+        online = {'BytesPerFlow': RunningStats(), 'FileBytesPerFlow': TDigest(), 'FlowBytes': TDigest(), 'AsnValues': {}}
+        self.netflow_dict['ASN_Stats']['Online'] = online
+        history = self.netflow_dict['load_file_history']
+        for cfile in history:
+            try: self.file_done(cfile)
             except: pass
+        self.dist_full = 1
+        return online
+        
+        
+    def file_done(self, cfile):
+        """
+        add the Avg_BytesPerFlow of a completed load file to the running statistics
+        """
+        online = self.get_online()
+        Avg_BytesPerFlow = self.netflow_dict['load_file_history'][cfile]['Avg_BytesPerFlow']
+        online['BytesPerFlow'].push(Avg_BytesPerFlow)
+        online['FileBytesPerFlow'].push(Avg_BytesPerFlow)
+        
+        
+    def get_asn_dist(self):
+        """
+        get a distribution list of TotalFlowCount per ASN
+        get a distribution of BytesInVolume per ASN
+        
+        the sorted lists are updated in place for the AS# changed since the last call, each change is a
+        bisect removal of the old value and insertion of the new one
+        """
+        online = self.get_online()
+        values = online['AsnValues']
+        flows_dist = self.netflow_dict['ASN_Stats']['Dist_TotalFlowCount']
+        bytes_dist = self.netflow_dict['ASN_Stats']['Dist_BytesInVolume']
+        
+        if self.dist_full:
+            #rebuild the lists from every AS# entry
+            values.clear()
+            for ASN_key in self.netflow_dict:
+                try: 
+                    if 'AS' in ASN_key: values[ASN_key] = (self.netflow_dict[ASN_key]['TotalFlowCount'], self.netflow_dict[ASN_key]['BytesInVolume'])
+                except: pass
+            flows_dist[:] = sorted([value[0] for value in values.itervalues()])
+            bytes_dist[:] = sorted([value[1] for value in values.itervalues()])
+            self.dist_full = 0
+        else:
+            for ASN_key in self.dist_changed:
+                try: new = (self.netflow_dict[ASN_key]['TotalFlowCount'], self.netflow_dict[ASN_key]['BytesInVolume'])
+                except: continue
+                old = values.get(ASN_key)
+                if old == new: continue
+                if old is not None:
+                    del flows_dist[bisect.bisect_left(flows_dist, old[0])]
+                    del bytes_dist[bisect.bisect_left(bytes_dist, old[1])]
+                bisect.insort(flows_dist, new[0])
+                bisect.insort(bytes_dist, new[1])
+                values[ASN_key] = new
+        self.dist_changed = set()
         
-        #sort the list for easier viewing
-        self.netflow_dict['ASN_Stats']['Dist_BytesInVolume'].sort()
+        #find the flow value that is insignificant compared to Total_TotalFlowCount
+        self.netflow_dict['ASN_Stats']['Dist_FlowCutOff'] = self.netflow_dict['ASN_Stats']['Total_TotalFlowCount'] * self.DistFlowCutOffFactor
         
         #find the flow value that is insignificant compared to Total_TotalFlowCount
         self.netflow_dict['ASN_Stats']['Dist_BytesCutOff'] = self.netflow_dict['ASN_Stats']['Total_BytesInVolume'] * self.DistBytesCutOffFactor
@@ -658,17 +4013,34 @@ class Inetflow(Tools):
     def flow_dist(self):
         """
         get the distribution of Avg_BytesPerFlow per load file
+        returns (std_dev, avg) from the running statistics and the TDigest of the per file values
         """
         try:
-            out = []
-            keys = self.netflow_dict['load_file_history']
-            for cfile in keys:
-                try:
-                    Avg_BytesPerFlow = self.netflow_dict['load_file_history'][cfile]['Avg_BytesPerFlow']
-                    #print cfile, Avg_BytesPerFlow
-                    out.append(Avg_BytesPerFlow)
-                except: pass
-            return self.std_dev(out), out
+            online = self.get_online()
+            return online['BytesPerFlow'].legacy(), online['FileBytesPerFlow']
+        except: pass
+        
+        
+    def dist_percentile(self, percent, key='TotalFlowCount'):
+        """
+        help: percentile of the TotalFlowCount or BytesInVolume distribution per AS# from the sorted Dist lists
+        usage: netflow.dist_percentile(0.95)    or netflow.dist_percentile(0.5, 'BytesInVolume')
+        """
+        self.get_asn_dist()
+        return self.percentile(self.netflow_dict['ASN_Stats']['Dist_' + key], percent, presorted=1)
+        
+        
+    def view_dist(self):
+        """
+        help: view the quantiles of the per file Avg_BytesPerFlow and the per flow BytesInVolume
+        usage: netflow.view_dist()
+        """
+        try:
+            online = self.get_online()
+            std, avg = online['BytesPerFlow'].legacy()
+            print 'Avg_BytesPerFlow per file:  avg %s  std_dev %s' % ('{:0,d}'.format(avg), '{:0,.0f}'.format(std))
+            for name in ('FileBytesPerFlow', 'FlowBytes'):
+                print name, ' '.join(['p%d %s' % (q * 100, '{:0,.0f}'.format(online[name].quantile(q))) for q in (0.5, 0.9, 0.99)])
         except: pass
         
         
@@ -700,18 +4072,22 @@ class Inetflow(Tools):
         except: pass
         
         
-    def percentile(self, N, percent, key=lambda x:x):
+    def percentile(self, N, percent, key=lambda x:x, presorted=0):
         """
         help: Find the percentile of a list of values.
         http://code.activestate.com/recipes/511478-finding-the-percentile-of-the-values/
-        @parameter N - is a list of values. Note N MUST BE already sorted.
+        @parameter N - is a list of values, or a TDigest which is queried directly
         @parameter percent - a float value from 0.0 to 1.0.
         @parameter key - optional key function to compute value from each element of N.
+        @parameter presorted - set if N is already sorted so it is not sorted again
         usage: netflow.percentile(percent)    pass the list in as netflow.out
         output will be netflow.out
         """
-        try: N.sort()
-        except: N = self.out.sort()
+        if isinstance(N, TDigest):
+            self.out = N.quantile(percent)
+            return self.out
+        if not N: N = self.out
+        if not presorted: N.sort()
         k = (len(N)-1) * percent
         f = math.floor(k)
         c = math.ceil(k)
@@ -724,24 +4100,142 @@ class Inetflow(Tools):
     
     def save_db(self):
         """
-        help: save self.netflow_dict to db_file
+        help: save self.netflow_dict to db_file, or to sqlite_file when self.DbBackend = 'sqlite'
         usage: netflow.save_db()
         note: the dictionary gets saved automatically
         """
-        cfile = open(db_file, 'wb')
-        pickle.dump(self.netflow_dict, cfile, -1)
-        cfile.close()
+        t0 = self.inst.start()
+        if self.DbBackend == 'sqlite': self.save_sqlite()
+        else:
+            #written to a temp file and renamed so a crash while saving leaves the previous db
+            cfile = open(db_file + '.tmp', 'wb')
+            pickle.dump(self.netflow_dict, cfile, -1)
+            cfile.close()
+            try: os.rename(db_file + '.tmp', db_file)
+            except OSError:
+                os.remove(db_file)
+                os.rename(db_file + '.tmp', db_file)
+        if self.GeoCachePersist: self.geo_cache.save()
+        self.inst.stop('save_db', t0)
         
         
     def open_db(self):
         """
-        help: open self.netflow_dict from db_file
+        help: open self.netflow_dict from db_file, or from sqlite_file when self.DbBackend = 'sqlite'
         usage: netflow.open_db()
         note: the dictionary gets opened automatically
         """
+        if self.DbBackend == 'sqlite' and os.path.exists(sqlite_file): return self.open_sqlite()
+        #start with an empty dict if there is no db yet
+        if not os.path.exists(db_file): 
+            self.new_db()
+            return
         cfile = open(db_file, 'rb')
         self.netflow_dict = pickle.load(cfile)
         cfile.close()
+        self.dirty_all = 1
+        self.dist_full = 1
+        self.metric_full = 1
+        
+        
+    def db_connect(self):
+        """
+        open sqlite_file, one row per AS# or top level key in section 'top' and one row per load_file_history key in section 'file'
+        """
+        if self.db_conn is None:
+            self.db_conn = sqlite3.connect(sqlite_file)
+            self.db_conn.text_factory = str
+            self.db_conn.execute('PRAGMA synchronous = FULL')
+            self.db_conn.execute('CREATE TABLE IF NOT EXISTS records (section TEXT, key TEXT, data BLOB, PRIMARY KEY (section, key))')
+            self.db_conn.commit()
+        return self.db_conn
+        
+        
+    def save_sqlite(self):
+        """
+        write the AS# and load_file_history records changed since the last save in one transaction,
+        ASN_Stats, ASN_Metrics, Report and the StdDev history keys are written every time, after new_db() or open_db()
+        from the pickle db every record is replaced
+        a crash before the commit leaves sqlite_file as it was after the previous save
+        """
+        history = self.netflow_dict['load_file_history']
+        #with the AS# not yet in the Dist lists saved, open_sqlite does not have to read every AS# to rebuild them
+        self.get_online()['AsnPending'] = set(self.dist_changed)
+        if self.dirty_all:
+            top = set(self.netflow_dict.keys())
+            files = set(history.keys())
+        else:
+            top = self.dirty | set(['ASN_Stats', 'ASN_Metrics', 'Report'])
+            files = self.dirty_files | set(['StdDevBytesPerFlow', 'StdDevBytesPerFlowAvg'])
+        top.discard('load_file_history')
+        
+        rows = []
+        gone = []
+        for key in top:
+            try: rows.append(('top', key, sqlite3.Binary(pickle.dumps(self.netflow_dict[key], -1))))
+            except KeyError: gone.append(('top', key))
+        for key in files:
+            try: rows.append(('file', key, sqlite3.Binary(pickle.dumps(history[key], -1))))
+            except KeyError: gone.append(('file', key))
+            
+        conn = self.db_connect()
+        with conn:
+            #a full save replaces every record so AS# and files no longer in netflow_dict are dropped
+            if self.dirty_all: conn.execute('DELETE FROM records')
+            conn.executemany('INSERT OR REPLACE INTO records VALUES (?, ?, ?)', rows)
+            conn.executemany('DELETE FROM records WHERE section = ? AND key = ?', gone)
+        self.dirty = set()
+        self.dirty_files = set()
+        self.dirty_all = 0
+        
+        
+    def open_sqlite(self):
+        """
+        rebuild self.netflow_dict from sqlite_file
+        with self.DbLazy set only the keys are read and the records are read on demand through LazyDict
+        """
+        conn = self.db_connect()
+        if self.DbLazy:
+            keys = {'top': [], 'file': []}
+            for section, key in conn.execute('SELECT section, key FROM records'): keys[section].append(key)
+            self.netflow_dict = LazyDict(keys['top'], lambda key: self.fetch_record('top', key))
+            self.netflow_dict['load_file_history'] = LazyDict(keys['file'], lambda key: self.fetch_record('file', key))
+        else:
+            self.netflow_dict = {'load_file_history': {}}
+            for section, key, data in conn.execute('SELECT section, key, data FROM records'):
+                if section == 'file': self.netflow_dict['load_file_history'][key] = pickle.loads(str(data))
+                else: self.netflow_dict[key] = pickle.loads(str(data))
+        self.dirty = set()
+        self.dirty_files = set()
+        self.dirty_all = 0
+        self.dist_full = 1
+        self.metric_full = 1
+        try:
+            self.dist_changed = set(self.netflow_dict['ASN_Stats']['Online']['AsnPending'])
+            self.dist_full = 0
+        except KeyError: pass
+        
+        
+    def fetch_record(self, section, key):
+        row = self.db_connect().execute('SELECT data FROM records WHERE section = ? AND key = ?', (section, key)).fetchone()
+        if row is None: raise KeyError(key)
+        return pickle.loads(str(row[0]))
+        
+        
+    def compact_db(self):
+        """
+        help: remove sqlite_file records no longer in self.netflow_dict and reclaim the free space
+        usage: netflow.compact_db()
+        """
+        self.save_sqlite()
+        conn = self.db_connect()
+        gone = []
+        for section, key in conn.execute('SELECT section, key FROM records').fetchall():
+            if section == 'file' and key not in self.netflow_dict['load_file_history']: gone.append((section, key))
+            if section == 'top' and key not in self.netflow_dict: gone.append((section, key))
+        with conn: conn.executemany('DELETE FROM records WHERE section = ? AND key = ?', gone)
+        conn.execute('VACUUM')
+        print 'removed %d records, %s bytes' % (len(gone), '{:0,d}'.format(os.path.getsize(sqlite_file)))
         
         
     def view_db(self): 
@@ -769,32 +4263,110 @@ class Inetflow(Tools):
         except: pass
         
         
-    def asn_metric(self):
+    def metric_inputs_now(self):
+        """
+        the global inputs of the trust metric (StdDevBytesPerFlow, StdDevBytesPerFlowAvg, Dist_FlowCutOff)
+        """
+        return (self.netflow_dict['load_file_history']['StdDevBytesPerFlow'], self.netflow_dict['load_file_history']['StdDevBytesPerFlowAvg'],
+            self.netflow_dict['ASN_Stats']['Dist_FlowCutOff'])
+            
+            
+    def trust_as(self, asn, window=None):
+        """
+        TrustMetric of an AS without the output of metric_as, None if it can not be calculated
+        window scores the AS# on the totals of the last 'hour', 'day', 'week' or number of intervals
+        """
+        try: return trust_metric(*self.metric_values(asn, window))
+        except: pass
+        
+        
+    def trust_batch(self, keys):
+        """
+        TrustMetric for a list of AS#, returns a dict of AS# to metric, None where it can not be calculated
+        the counters are copied to float arrays and evaluated together by trust_columns
+        """
+        out = {}
+        try: inputs = self.metric_inputs_now()
+        except: return dict.fromkeys(keys)
+        batch = []
+        distance = array('d')
+        avg_bpf = array('d')
+        flows = array('d')
+        for ASN in keys:
+            try:
+                rec = self.netflow_dict[ASN]
+                row = (float(rec['SourceAddressDistance']), float(rec['Avg_BytesPerFlow']), float(rec['TotalFlowCount']))
+                if row[2] <= 0: raise ValueError
+            except:
+                #left to trust_as so a bad entry gives the same result as metric_as
+                out[ASN] = self.trust_as(ASN)
+                continue
+            batch.append(ASN)
+            distance.append(row[0])
+            avg_bpf.append(row[1])
+            flows.append(row[2])
+        if batch:
+            for ASN, trust in zip(batch, trust_columns(distance, avg_bpf, flows, *inputs)): out[ASN] = trust
+        return out
+        
+        
+    def asn_metric(self, full=0, window=None):
         """
         help: Calculate the Trust metric for each AS
         Store the result in dict key self.netflow_dict['ASN_Metrics']
+        only the AS# changed since the last call are recalculated unless StdDevBytesPerFlow, StdDevBytesPerFlowAvg
+        or Dist_FlowCutOff have moved
+        with a window the metric uses the totals of the last 'hour', 'day' or 'week' and is stored in ['Trust_' + window]
         return a sorted list of metrics
-        usage: netflow.asn_metric()
+        usage: netflow.asn_metric()    or netflow.asn_metric(1) to recalculate every AS    or netflow.asn_metric(window='day')
         result list of sorted matrics in netflow.out
         """
+        if window is not None: return self.asn_metric_window(window)
         try:
-            self.out = []
-            self.netflow_dict['ASN_Metrics'] = {}
-            self.netflow_dict['ASN_Metrics']['Trust'] = {}
-            keys = self.get_asn()
-            for ASN in keys: 
-                try: 
-                    trust = int(self.metric_as(ASN, verbose=0))
-                    if not trust: continue
-                    self.netflow_dict['ASN_Metrics']['Trust'][ASN] = trust
-                    self.out.append(trust)                        
-                except: pass
-                
+            try: inputs = self.metric_inputs_now()
+            except: inputs = None
+            try: metrics = self.netflow_dict['ASN_Metrics']['Trust']
+            except KeyError:
+                self.netflow_dict['ASN_Metrics'] = {'Trust': {}}
+                metrics = self.netflow_dict['ASN_Metrics']['Trust']
+                full = 1
+            
+            if full or self.metric_full or inputs != self.metric_inputs:
+                metrics.clear()
+                keys = self.get_asn()
+            else: keys = list(self.metric_changed)
+            
+            t0 = self.inst.start()
+            for ASN, trust in self.trust_batch(keys).iteritems():
+                reputation = self.reputation_of(ASN)
+                if reputation is WHITELIST: trust = 1
+                elif reputation is not None: trust = reputation
+                try: trust = int(trust)
+                except: trust = 0
+                if trust: metrics[ASN] = trust
+                else: metrics.pop(ASN, None)
+            self.metric_changed = set()
+            self.metric_inputs = inputs
+            self.metric_full = 0
+            self.inst.stop('asn_metric', t0, len(keys))
+            
             #pprint.pprint(self.netflow_dict['ASN_Metrics']['Trust'])
-            self.out.sort()
+            self.out = sorted(metrics.values())
             return self.out
             
-        except: pass
+        except: self.inst.error('asn_metric')
+        
+        
+    def asn_metric_window(self, window):
+        metrics = {}
+        for ASN in self.get_asn():
+            try: trust = int(self.trust_as(ASN, window))
+            except: continue
+            if trust: metrics[ASN] = trust
+        try: self.netflow_dict['ASN_Metrics']['Trust_' + str(window)] = metrics
+        except KeyError: self.netflow_dict['ASN_Metrics'] = {'Trust': {}, 'Trust_' + str(window): metrics}
+        self.out = sorted(metrics.values())
+        return self.out
         
         
     def run(self, cmd):
@@ -854,7 +4426,33 @@ class Inetflow(Tools):
             sum = 1000000 * self.DistFlowCutOffFactor
             print 'DistFlowCutOffFactor: %f or %d in 1,000,000' % (self.DistFlowCutOffFactor, sum)
             
-        except: pass
+        except: self.inst.error('view_stats')
+        if self.inst.enabled: 
+            print
+            self.inst.view()
+        
+        
+    def instrument(self, on=1):
+        """
+        help: turn the per stage timing and swallowed exception counters on or off, the counters start from zero
+        usage: netflow.instrument()    or netflow.instrument(0) to turn off
+        the totals are shown by view_stats and asn_stats and saved with dump_stats
+        ingest is the whole of each file and includes parse, geoip, distance, aggregate and report
+        """
+        self.inst.enabled = on
+        self.inst.reset()
+        
+        
+    def dump_stats(self, fname=None):
+        """
+        help: save the per stage totals as JSON to stats_file, returns the totals
+        usage: netflow.dump_stats()    or netflow.dump_stats('c:\\stats.json')
+        """
+        totals = self.inst.totals()
+        cfile = open(fname or stats_file, 'w')
+        json.dump(totals, cfile, indent=1, sort_keys=True)
+        cfile.close()
+        return totals
         
         
     def view_as(self, asn):
@@ -869,34 +4467,31 @@ class Inetflow(Tools):
         except: pass
         
         
-    def metric_as(self, asn, verbose=1):
+    def metric_as(self, asn, verbose=1, window=None):
         """
         Help: Metric to define how trustworthy the AS is
         DistanceMetric = (SourceAddressDistance / 2500.)
         TotalByteMetric = difference between AS BytesPerFlow and ALL AS AVG BytesPerFlow
         FlowCountMetric = (Dist_FlowCutOff / TotalFlowCount) limited to a max of 10
         TrustMetric = ((FlowCountMetric) * TotalByteMetric) * DistanceMetric
-        usage: netflow.metric_as('AS2856')
+        window uses the totals of the last 'hour', 'day', 'week' or number of 15 minute intervals instead of all time
+        usage: netflow.metric_as('AS2856')    or netflow.metric_as('AS2856', window='day')
         """
         try:
             asn = asn.upper()
             if verbose > 0:
                 print
-                print 'Calculating trust metric for', asn
+                if window is None: print 'Calculating trust metric for', asn
+                else: print 'Calculating trust metric for', asn, 'over the last', window
+            SourceAddressDistance, Avg_BytesPerFlow, TotalFlowCount, StdDev, StdDevAvg, Dist_FlowCutOff = self.metric_values(asn, window)
             
             #Calculate the metric for distance
-            SourceAddressDistance = self.netflow_dict[asn]['SourceAddressDistance']
             self.DistanceMetric = (SourceAddressDistance / 2500.)
             if self.DistanceMetric < 1: self.DistanceMetric = 1.
             if self.DistanceMetric > 2: self.DistanceMetric = 2.
             if verbose > 0: print 'DistanceMetric = ', '{:0,.2f}'.format(self.DistanceMetric)
             
             #Calculate the metric for BytesPerFlow
-            Avg_BytesPerFlow = self.netflow_dict[asn]['Avg_BytesPerFlow']
-            Dist_Avg_BytesPerFlow = self.netflow_dict['ASN_Stats']['Avg_BytesPerFlow']
-            
-            StdDev = self.netflow_dict['load_file_history']['StdDevBytesPerFlow']
-            StdDevAvg = self.netflow_dict['load_file_history']['StdDevBytesPerFlowAvg']
             if verbose > 0: print 'StdDevAvg', '{:0,d}'.format(StdDevAvg), 'StdDev', '{:0,.0f}'.format(StdDev)
             
             #NegByteMetric = float(Dist_Avg_BytesPerFlow) - Avg_BytesPerFlow
@@ -913,9 +4508,6 @@ class Inetflow(Tools):
             if verbose > 0: print 'TotalByteMetric = ', '{:0,.0f}'.format(self.TotalByteMetric)
             
             #Calculate the metric for FlowCount
-            TotalFlowCount = self.netflow_dict[asn]['TotalFlowCount']
-            Dist_FlowCutOff = self.netflow_dict['ASN_Stats']['Dist_FlowCutOff']
-            
             self.FlowCountMetric = (Dist_FlowCutOff / TotalFlowCount)
             if self.FlowCountMetric > 5: self.FlowCountMetric = 5.
             if verbose > 0: print 'FlowCountMetric = ', '{:0,.2f}'.format(self.FlowCountMetric)
@@ -929,35 +4521,91 @@ class Inetflow(Tools):
         except: pass
     
 
-    def load_blackhole(self):
+    def load_blackhole(self, cfile=None):
         """
-        help: load a list of IP address loacted in blackhole.txt and score each IP based AS trust metric
-        usage: netflow.load_blackhole()
+        help: load a list of IP address and CIDR prefixes loacted in blackhole.txt and score each IP based AS trust metric
+        the prefixes are matched against the source and destination of each flow loaded after this, see view_blackhole()
+        every AS# announcing part of a prefix is scored, without the GeoIP csv range index only the AS# of each network address
+        usage: netflow.load_blackhole()    or netflow.load_blackhole('feed.txt')
         """
         self.BlackTrustMetric = 0
         self.BlackCount = 0
-        AS_List = []
-        cfile = path + 'blackhole.txt'
-        #print cfile
+        if cfile is None: cfile = blackhole_file
+        prefixes = PrefixSet()
         file = open(cfile, 'rU')
         for row in file:
-            if row:
-                try:
-                    ipAddr = row.split()[0]
-                    #AS lookup
-                    #print 'asn lookup', ipAddr
-                    asn_res = geoip_asn.asn_by_addr(ipAddr)
-                    #print asn_res
-                    asn_raw = asn_res.split(' ')
-                    AS_Number = asn_raw[0]
-                    if AS_Number not in AS_List: AS_List.append(AS_Number)
-                    else: continue
-                    res = self.metric_as(AS_Number)
-                    if res:
-                        self.BlackCount += 1
-                        self.BlackTrustMetric += res
-                except: pass
+            try: prefixes.add(row.split()[0])
+            except: pass
+        file.close()
+        self.blackhole = prefixes
+        self.blackhole_hits = {}
+        self.blackhole_flows.clear()
+        
+        #the AS# overlapping each prefix range in one range index search that leaves the GeoIP cache alone, then each AS# once
+        ranges = prefixes.ranges()
+        AS_Set = set()
+        index = self.get_geo_index()
+        if index is not None:
+            for asn_id in index.search_ranges(ranges, index.asn_start, index.asn_end, index.asn_id):
+                AS_Set.add(index.asn_names[asn_id].split(' ')[0])
+        else:
+            for first, last in ranges:
+                try: AS_Set.add(self.as_lookup(int2ip(first)))
+                except KeyError: pass
+                except: self.inst.error('geoip')
+        for AS_Number, res in self.trust_batch(sorted(AS_Set)).iteritems():
+            if res:
+                self.BlackCount += 1
+                self.BlackTrustMetric += res
                     
-        print 'BlackCount =', self.BlackCount, 'BlackTrustMetric =', self.BlackTrustMetric, 'AvgBlackTrustMetric =', self.BlackTrustMetric / self.BlackCount
+        print 'Blackhole prefixes =', len(prefixes), 'AS# =', len(AS_Set)
+        if self.BlackCount: print 'BlackCount =', self.BlackCount, 'BlackTrustMetric =', self.BlackTrustMetric, 'AvgBlackTrustMetric =', self.BlackTrustMetric / self.BlackCount
+
+
+#backfill worker state, one Inetflow without a db per worker process
+backfill_nf = None
+
+
+def init_backfill_worker(settings):
+    global backfill_nf
+    backfill_nf = Inetflow(db=0)
+    backfill_nf.GeoCachePersist = 0
+    backfill_nf.spill_file = None
+    for key in settings: setattr(backfill_nf, key, settings[key])
+    backfill_nf.AnomalyLog = 0
     
-                    
+    
+def backfill_worker(job):
+    """
+    columnar load of one file into an empty netflow_dict
+    job is (file, age, keep_report), returns (file, partial netflow_dict)
+    """
+    cfile, age, keep_report = job
+    nf = backfill_nf
+    nf.new_db()
+    nf.anomalies.clear()
+    nf.blackhole_hits = {}
+    nf.blackhole_flows.clear()
+    nf.netflow_dict['load_file_history'][cfile] = {'age': age}
+    nf.init_file(cfile)
+    nf.load_file = nf.path + cfile
+    if nf.netflow_kind(cfile): nf.row_map = FLOW_FIELDS
+    else: nf.row_map = nf.field_map
+    nf.load_columnar(cfile)
+    
+    history = nf.netflow_dict['load_file_history'][cfile]
+    try: history['Avg_BytesPerFlow'] = history['Total_BytesInVolume'] / history['Total_TotalFlowCount']
+    except: pass
+    
+    #only the flows of the file are returned in each Baseline, the parent already holds the seed
+    for AS_Number, seed in nf.baseline_seed.iteritems():
+        try: nf.netflow_dict[AS_Number]['Baseline'].unmerge(seed)
+        except KeyError: pass
+    #an archive that cannot be written is returned as None and counted by the parent
+    if nf.Archive: 
+        try: nf.netflow_dict['Archive'] = nf.archive_report(cfile, [nf.netflow_dict['Report']])
+        except: nf.netflow_dict['Archive'] = None
+    if not keep_report: del nf.netflow_dict['Report']
+    nf.netflow_dict['Anomalies'] = list(nf.anomalies)
+    nf.netflow_dict['Blackhole'] = (nf.blackhole_hits, list(nf.blackhole_flows))
+    return cfile, nf.netflow_dict
@@ -0,0 +1,270 @@
+"""
+Benchmarks for netflow.py
+
+bench_store    - memory per tracked flow of the Report FlowStore against the old nested Report dict
+bench_pipeline - load, save_db, open_db, asn_metric, report_trust and view_flows/view_bytes over generated NetQoS csv files
+                 with stand-in GeoIP csv editions, timed per stage with rows per second and peak RSS,
+                 the load stage is also broken down with the Inetflow instrumentation
+
+results are saved as JSON so runs from different versions can be compared
+
+usage: python netflow_bench.py [rows per file] [files] [results.json]
+       python netflow_bench.py compare old.json new.json
+"""
+import os
+import sys
+import json
+import random
+import shutil
+import socket
+import struct
+import time
+import tempfile
+import netflow
+
+NETQOS_HEADER = 'RouterAddress,InterfaceIn,Protocol,SourceAddress,SourcePort,DestinationAddress,DestinationPort,TypeOfService,BytesInVolume,BytesInRatePerDuration,BytesInPercentOfTotalTraffic,FlowCount,FlowDuration,PacketsInVolume,PacketsInRatePerDuration,PacketsInPercentOfTotalTraffic'
+
+
+def deep_size(obj, seen=None):
+    """
+    size in bytes of obj and everything it references, each object is counted once
+    """
+    if seen is None: seen = set()
+    if id(obj) in seen: return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.iteritems(): size += deep_size(key, seen) + deep_size(value, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for value in obj: size += deep_size(value, seen)
+    elif hasattr(obj, '__dict__'): size += deep_size(obj.__dict__, seen)
+    return size
+
+
+def random_flows(rows, dests=50, sources=20000, seed=1):
+    """
+    list of Report flows (DestinationAddress, Protocol, DestinationPort, SourceAddress, SourcePort, BytesInVolume, FlowDuration, PacketsInRatePerDuration)
+    """
+    rnd = random.Random(seed)
+    dst_ips = ['193.127.210.%d' % (n % 254 + 1) for n in range(dests)]
+    src_ips = ['%d.%d.%d.%d' % (rnd.randint(1, 223), rnd.randint(0, 255), rnd.randint(0, 255), rnd.randint(1, 254)) for n in range(sources)]
+    out = []
+    for n in xrange(rows):
+        out.append((rnd.choice(dst_ips), rnd.choice((6, 17)), rnd.choice((25, 53, 80, 443, 3389)), rnd.choice(src_ips), rnd.randint(1024, 65535), rnd.randint(40, 1500000), rnd.randint(1, 900), rnd.random() * 50))
+    return out
+
+
+def bench_store(rows=200000, seed=1):
+    """
+    build a FlowStore from random flows, compare its size to the same flows in the old nested Report dict
+    returns a dict of the results
+    """
+    flows = random_flows(rows, seed=seed)
+
+    start = time.time()
+    store = netflow.FlowStore()
+    for flow in flows: store.add(*flow)
+    add_time = time.time() - start
+    ingest_bytes = deep_size(store)
+    store.compact()
+    store_bytes = deep_size(store)
+    records = len(store.flows)
+
+    #the old Report format, built from the nested view of each destination
+    tree = {}
+    for ip in store: tree[ip] = store[ip]
+    tree_bytes = deep_size(tree)
+
+    res = {'flows': records, 'rows': rows, 'add_rows_per_sec': int(rows / add_time),
+        'tree_bytes_per_flow': tree_bytes / records, 'store_bytes_per_flow': store_bytes / records, 'store_ingest_bytes_per_flow': ingest_bytes / records,
+        'reduction': round(float(tree_bytes) / store_bytes, 1)}
+    print 'Report flows:                 ', '{:0,d}'.format(records)
+    print 'nested dict bytes per flow:   ', res['tree_bytes_per_flow']
+    print 'FlowStore bytes per flow:     ', res['store_bytes_per_flow'], '(%d while loading)' % res['store_ingest_bytes_per_flow']
+    print 'reduction:                    ', '%.1fx' % res['reduction']
+    return res
+
+
+def asn_block(n):
+    """
+    first and last address of the /16 assigned to stand-in AS number n
+    """
+    start = ((11 + n // 256) << 24) | ((n % 256) << 16)
+    return start, start + 65535
+
+
+def write_geo(gdir, asns=200, seed=1):
+    """
+    write stand-in GeoIPASNum2.csv, GeoLiteCity-Blocks.csv and GeoLiteCity-Location.csv for GeoRangeIndex
+    each AS gets one /16 and a location spread over a few countries
+    """
+    rnd = random.Random(seed)
+    fasn = open(os.path.join(gdir, 'GeoIPASNum2.csv'), 'w')
+    fblocks = open(os.path.join(gdir, 'GeoLiteCity-Blocks.csv'), 'w')
+    floc = open(os.path.join(gdir, 'GeoLiteCity-Location.csv'), 'w')
+    fblocks.write('Copyright (c) stand-in\nstartIpNum,endIpNum,locId\n')
+    floc.write('Copyright (c) stand-in\nlocId,country,region,city,postalCode,latitude,longitude,metroCode,areaCode\n')
+    for n in xrange(asns):
+        start, end = asn_block(n)
+        fasn.write('%d,%d,"AS%d Stand-in Org %d"\n' % (start, end, n + 1, n + 1))
+        fblocks.write('"%d","%d","%d"\n' % (start, end, n + 1))
+        floc.write('%d,"%s","","","",%.4f,%.4f,,\n' % (n + 1, rnd.choice(('GB', 'US', 'DE', 'CN', 'RU', 'BR')), rnd.uniform(-60, 70), rnd.uniform(-180, 180)))
+    fasn.close()
+    fblocks.close()
+    floc.close()
+
+
+def write_netqos(fname, rows, asns=200, skew=1.1, sources=5000, dests=20, outbound=0.2, seed=1):
+    """
+    write a NetQoS csv export of rows flows
+    source addresses come from a pool of unique sources spread over the AS numbers with a zipf skew,
+    a share of rows are outbound with the SourceFilter address as the source
+    """
+    rnd = random.Random(seed)
+    weights = [1. / (n + 1) ** skew for n in xrange(asns)]
+    total = sum(weights)
+    cumulative = []
+    acc = 0.
+    for w in weights:
+        acc += w / total
+        cumulative.append(acc)
+    pool = []
+    for n in xrange(sources):
+        asn = min(netflow.bisect.bisect_left(cumulative, rnd.random()), asns - 1)
+        start = asn_block(asn)[0]
+        pool.append(socket.inet_ntoa(struct.pack('!I', start + rnd.randint(1, 65534))))
+    dst_ips = ['193.127.210.%d' % (n % 254 + 1) for n in xrange(dests)]
+
+    out = open(fname, 'w')
+    out.write(NETQOS_HEADER + '\n')
+    for n in xrange(rows):
+        src = rnd.choice(pool)
+        dst = rnd.choice(dst_ips)
+        if rnd.random() < outbound: src, dst = dst, src
+        byts = int(rnd.paretovariate(1.2) * 400)
+        duration = rnd.randint(1, 900)
+        packets = byts / 500 + 1
+        out.write('10.0.0.1,1,%d,%s,%d,%s,%d,0,%d,%.3f,0.1,1,%d,%d,%.5f,0.1\n' % (rnd.choice((6, 6, 6, 17)), src, rnd.randint(1024, 65535), dst,
+            rnd.choice((25, 53, 80, 443, 3389)), byts, byts / float(duration), duration, packets, packets / float(duration)))
+    out.close()
+
+
+def make_dataset(wdir, files=4, rows=50000, asns=200, skew=1.1, sources=5000, seed=1):
+    """
+    create wdir with the stand-in GeoIP csv editions and a netflow folder of files csv exports, oldest first by mtime
+    """
+    if os.path.exists(wdir): shutil.rmtree(wdir)
+    os.makedirs(os.path.join(wdir, 'netflow'))
+    write_geo(wdir, asns, seed)
+    now = time.time()
+    for n in xrange(files):
+        fname = os.path.join(wdir, 'netflow', 'netqos_%03d.csv' % n)
+        write_netqos(fname, rows, asns, skew, sources, seed=seed + n)
+        age = now - (files - n) * 900
+        os.utime(fname, (age, age))
+
+
+def use_dir(wdir):
+    """
+    point the netflow module globals at wdir so the db, geo cache and spill files stay inside it
+    """
+    netflow.path = wdir + os.sep
+    netflow.db_file = os.path.join(wdir, 'netflow.db')
+    netflow.sqlite_file = os.path.join(wdir, 'netflow.sqlite')
+    netflow.geo_cache_file = os.path.join(wdir, 'netflow_geo.db')
+    netflow.report_spill_file = os.path.join(wdir, 'netflow_report.spill')
+
+
+def make_inetflow(wdir, mode, backend, db=1):
+    nf = netflow.Inetflow(db=0)
+    nf.path = os.path.join(wdir, 'netflow') + os.sep
+    nf.asn_csv = os.path.join(wdir, 'GeoIPASNum2.csv')
+    nf.blocks_csv = os.path.join(wdir, 'GeoLiteCity-Blocks.csv')
+    nf.location_csv = os.path.join(wdir, 'GeoLiteCity-Location.csv')
+    nf.IngestMode = mode
+    nf.DbBackend = backend
+    if db: nf.open_db()
+    return nf
+
+
+def timed(res, name, func, *args):
+    """
+    run func with its output discarded, record the seconds taken and the peak RSS after it in res['stages'][name]
+    """
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    start = time.time()
+    try: out = func(*args)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    res['stages'][name] = {'seconds': round(time.time() - start, 4), 'peak_rss_mb': netflow.peak_rss()}
+    return out
+
+
+def bench_pipeline(wdir, mode='row', backend='pickle', rows=50000, files=4):
+    """
+    run every scenario against the dataset in wdir, returns a dict of the results
+    """
+    use_dir(wdir)
+    for name in ('netflow.db', 'netflow.sqlite', 'netflow_geo.db', 'netflow_report.spill'):
+        try: os.remove(os.path.join(wdir, name))
+        except OSError: pass
+    res = {'mode': mode, 'backend': backend, 'rows': rows * files, 'files': files, 'stages': {}}
+    nf = make_inetflow(wdir, mode, backend)
+    nf.instrument()
+    timed(res, 'load', nf.load)
+    res['load_stages'] = nf.inst.totals()
+    timed(res, 'save_db', nf.save_db)
+    nf.db_conn = None
+    nf = timed(res, 'open_db', make_inetflow, wdir, mode, backend)
+    timed(res, 'asn_metric', nf.asn_metric, 1)
+    timed(res, 'report_trust', nf.report_trust, 'v')
+    timed(res, 'view_flows', nf.view_flows)
+    timed(res, 'view_bytes', nf.view_bytes)
+    res['rows_per_sec'] = int(res['rows'] / max(res['stages']['load']['seconds'], 1e-6))
+    res['peak_rss_mb'] = netflow.peak_rss()
+    print '%-9s %-7s %10s rows/s  peak RSS %d MB' % (mode, backend, '{:0,d}'.format(res['rows_per_sec']), res['peak_rss_mb'])
+    for name in ('load', 'save_db', 'open_db', 'asn_metric', 'report_trust', 'view_flows', 'view_bytes'):
+        print '    %-14s %8.3fs' % (name, res['stages'][name]['seconds'])
+    return res
+
+
+def compare(old_file, new_file):
+    """
+    print the change in seconds per stage between two saved results
+    """
+    old = json.load(open(old_file))
+    new = json.load(open(new_file))
+    old_runs = dict(((run['mode'], run['backend']), run) for run in old['pipeline'])
+    for run in new['pipeline']:
+        key = (run['mode'], run['backend'])
+        if key not in old_runs: continue
+        base = old_runs[key]
+        print '%s %s  rows/s %s -> %s' % (key[0], key[1], '{:0,d}'.format(base['rows_per_sec']), '{:0,d}'.format(run['rows_per_sec']))
+        for name in sorted(run['stages']):
+            if name not in base['stages']: continue
+            was = base['stages'][name]['seconds']
+            now = run['stages'][name]['seconds']
+            change = (now - was) / was * 100 if was else 0.
+            print '    %-14s %8.3fs -> %8.3fs  %+.1f%%' % (name, was, now, change)
+
+
+def main(rows=50000, files=4, out_file='netflow_bench.json'):
+    wdir = os.path.join(tempfile.gettempdir(), 'netflow_bench')
+    make_dataset(wdir, files, rows)
+    results = {'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'python': sys.version.split()[0], 'rows': rows, 'files': files, 'pipeline': []}
+    for mode, backend in (('row', 'pickle'), ('columnar', 'pickle'), ('stream', 'pickle'), ('row', 'sqlite')):
+        results['pipeline'].append(bench_pipeline(wdir, mode, backend, rows, files))
+    results['store'] = bench_store()
+    json.dump(results, open(out_file, 'w'), indent=1, sort_keys=True)
+    print 'results saved to', out_file
+    shutil.rmtree(wdir, True)
+    return results
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'compare': compare(sys.argv[2], sys.argv[3])
+    else:
+        args = sys.argv[1:]
+        main(int(args[0]) if args else 50000, int(args[1]) if len(args) > 1 else 4, args[2] if len(args) > 2 else 'netflow_bench.json')